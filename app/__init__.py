@@ -4,13 +4,12 @@ import os
 
 # Third party libraries
 from flask import Flask
-from mongoengine import connect
+from mongoengine import connect, disconnect
 from flask_login import LoginManager
 #from oauthlib.oauth2 import WebApplicationClient
 import certifi
 from app.utils.secrets import getSecrets
 from flask_moment import Moment
-import base64
 
 # Flask app setup
 app = Flask(__name__)
@@ -25,15 +24,35 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+# Database setup. Every process needs its own client: Gunicorn forks the workers
+# after this runs, so gunicorn.conf.py calls connectDb() again in each one.
+# Pool size and timeouts can be set in the secrets; times are in milliseconds.
+def connectDb():
+    disconnect()
+    # Atlas needs TLS with certifi's list of CAs. Set MONGO_TLS to False for a
+    # local mongod, like the one the tests use.
+    tls = {'tlsCAFile': certifi.where()} if secrets.get('MONGO_TLS', True) else {}
+    return connect(
+        secrets['MONGO_DB_NAME'],
+        host=secrets['MONGO_HOST'],
+        **tls,
+        maxPoolSize=int(secrets.get('MONGO_MAX_POOL_SIZE', 20)),
+        minPoolSize=int(secrets.get('MONGO_MIN_POOL_SIZE', 0)),
+        maxIdleTimeMS=int(secrets.get('MONGO_MAX_IDLE_TIME_MS', 60000)),
+        # fail fast instead of piling up requests when the cluster can't be reached
+        serverSelectionTimeoutMS=int(secrets.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+        connectTimeoutMS=int(secrets.get('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+        socketTimeoutMS=int(secrets.get('MONGO_SOCKET_TIMEOUT_MS', 30000)),
+        waitQueueTimeoutMS=int(secrets.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+    )
+
+connectDb()
 moment = Moment(app)
 
-def base64encode(img):
-    image = base64.b64encode(img)
-    image = image.decode('utf-8')
-    return image
-
-app.jinja_env.globals.update(base64encode=base64encode)
-
 from .routes import *
+from .utils import assets
+from .utils import commands
+
+# Make sure every collection has the indexes its routes rely on
+from .classes.data import ensureIndexes
+ensureIndexes()
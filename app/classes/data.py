@@ -14,13 +14,59 @@ from wtforms import SelectField
 from app import app
 from flask import flash
 from flask_login import UserMixin
-from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, CASCADE
-from flask_mongoengine import Document
+from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, BinaryField, ListField, DictField, PointField, CASCADE
+from flask_mongoengine import Document, BaseQuerySet
+from flask import g, has_request_context
 import datetime as dt
 import jwt
 from time import time
 from bson.objectid import ObjectId
 
+# Students who have agreed to share their sleep. Teachers can tick consent too,
+# but they are never counted as students.
+CONSENTING_STUDENTS = {'consent': True, 'role': {'$ne': 'Teacher'}}
+
+def consentingStudents():
+    return User.objects(__raw__=CONSENTING_STUDENTS)
+
+# Whose records a user may see: their own, every consenting student's if they are
+# a teacher, and any consenting student who listed their email as the adult to
+# share with. Worked out once per request.
+def visibleOwners(viewer):
+    cacheKey = f'visibleOwners-{viewer.id}'
+    if has_request_context() and cacheKey in g:
+        return g.get(cacheKey)
+    owners = {viewer.id}
+    if viewer.role == 'Teacher':
+        owners.update(consentingStudents().distinct('id'))
+    if viewer.email:
+        owners.update(User.objects(adult_email=viewer.email, consent=True).distinct('id'))
+    owners = list(owners)
+    if has_request_context():
+        setattr(g, cacheKey, owners)
+    return owners
+
+# A user's sleep_version straight from the database. Cached copies of the user (like
+# current_user) can be a little behind, and anything versioned on it has to match
+# the data exactly.
+def sleepVersion(userId):
+    return User.objects(id=userId).scalar('sleep_version').first() or 0
+
+# The query set for collections that belong to a user. The Document names the
+# field that holds the owner in 'ownerField', then
+#     Sleep.objects.for_user(current_user)
+# only finds the records that user may see, filtered in MongoDB so it can use the
+# (owner, date) indexes.
+class OwnedQuerySet(BaseQuerySet):
+    def for_user(self, viewer):
+        if viewer is None or not viewer.is_authenticated:
+            return self.none()
+        field = self._document.ownerField
+        owners = visibleOwners(viewer)
+        if len(owners) == 1:
+            return self.filter(**{field: owners[0]})
+        return self.filter(**{f'{field}__in': owners})
+
 class User(UserMixin, Document):
     role = StringField()
     createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
@@ -32,15 +78,25 @@ class User(UserMixin, Document):
     lname = StringField()
     email = EmailField()
     image = FileField()
+    # small copy of 'image' made by app/utils/avatars.py
+    thumbnail = FileField()
     prononuns = StringField()
     adult_fname = StringField()
     adult_lname = StringField()
     adult_email = StringField()
     consent = BooleanField(default=False)
     rating = IntField()
+    # goes up by one every time one of this user's Sleep documents changes. Cached
+    # things built from their sleep data (like the sleep graph) are keyed on it.
+    sleep_version = IntField(default=0)
 
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        'indexes': [
+            # visibleOwners() looks students up by these
+            'adult_email',
+            ('consent', 'role'),
+        ]
     }
 
 class Sleep(Document):
@@ -53,21 +109,39 @@ class Sleep(Document):
     hours = FloatField()
     minstosleep = IntField()
 
+    ownerField = 'sleeper'
+
+    # sleepNew() and sleepEdit() always fill in 'start' but never 'sleep_date', so
+    # nights are sorted and looked up on 'start'
     meta = {
-        'ordering': ['sleep_date']
+        'queryset_class': OwnedQuerySet,
+        'ordering': ['-start'],
+        'indexes': [
+            ('sleeper', '-start', '-id'),
+            ('-start', '-id'),
+        ]
     }
     
 class Emoji(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
     emote = StringField()
     location = StringField()
+    # Typed in by hand on older emojis. The day and time now come from create_date,
+    # see app/utils/emojitimeline.py
     dow = StringField()
     time = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
+    ownerField = 'author'
+
     meta = {
-        'ordering': ['-createdate']
+        'queryset_class': OwnedQuerySet,
+        'ordering': ['-create_date'],
+        'indexes': [
+            ('author', '-create_date', '-id'),
+            ('-create_date', '-id'),
+        ]
     }
 class Meditation(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
@@ -78,11 +152,55 @@ class Meditation(Document):
     name = StringField()
     meditationfile = FileField()
     meditationUrl = StringField()
+    # filled in by app/utils/audio.py once the recording has been converted to Opus
+    audio_format = StringField()
+    duration = FloatField()
+    peaks = ListField(FloatField())
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
 
+    ownerField = 'author'
+
     meta = {
-        'ordering': ['-createdate']
+        'queryset_class': OwnedQuerySet,
+        'ordering': ['-create_date'],
+        'indexes': [
+            ('author', '-create_date', '-id'),
+            ('-create_date', '-id'),
+        ]
+    }
+
+# A recording that is being uploaded a piece at a time while the user records it.
+# The pieces are kept in MeditationUploadChunk until the meditation form is
+# submitted, then they are joined into Meditation.meditationfile.
+# See app/utils/uploads.py
+class MeditationUpload(Document):
+    author = ReferenceField('User',reverse_delete_rule=CASCADE)
+    content_type = StringField()
+    # how many bytes have arrived so far. The next piece has to start here.
+    received = IntField(default=0)
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            # uploads that are never finished are cleaned up by MongoDB after a day
+            {'fields': ['modify_date'], 'expireAfterSeconds': 24*60*60},
+        ]
+    }
+
+class MeditationUploadChunk(Document):
+    upload = ReferenceField('MeditationUpload',reverse_delete_rule=CASCADE)
+    offset = IntField()
+    data = BinaryField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            # a piece that is sent twice (a retry after a dropped connection) is only stored once
+            {'fields': ['upload', 'offset'], 'unique': True},
+            {'fields': ['create_date'], 'expireAfterSeconds': 24*60*60},
+        ]
     }
 # class Adoption(Document):
 #     # Line 63 is a way to access all the information in Course and Teacher w/o storing it in this class
@@ -126,7 +244,121 @@ class Clinic(Document):
     description = StringField()
     lat = FloatField()
     lon = FloatField()
+    # the same spot as lat/lon stored as a GeoJSON point [lon, lat] so the map can
+    # ask MongoDB for just the clinics on screen
+    location = PointField()
+    # "file name:row" for clinics loaded by 'flask clinics import' so that running
+    # the same import again never adds the same row twice
+    import_key = StringField()
     
     meta = {
-        'ordering': ['-createdate']
-    }
\ No newline at end of file
+        'ordering': ['-createdate'],
+        'indexes': [
+            ('author', '-createdate', '-id'),
+            ('-createdate', '-id'),
+            # '(' makes this a 2dsphere index
+            '(location',
+            {'fields': ['import_key'], 'unique': True, 'sparse': True},
+        ]
+    }
+
+# One address lookup waiting to be done for a clinic. These are worked through by
+# background threads in app/utils/geocode.py so the clinic pages don't wait on the
+# maps website.
+class GeocodeJob(Document):
+    clinic = ReferenceField('Clinic',reverse_delete_rule=CASCADE)
+    # pending -> running -> done, or back to pending to try again, or failed
+    status = StringField(default='pending')
+    attempts = IntField(default=0)
+    # don't try before this time, used to wait longer after each failure
+    next_run = DateTimeField(default=dt.datetime.utcnow)
+    # a running job whose worker died is picked up again after this
+    lease_until = DateTimeField()
+    last_error = StringField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField()
+
+    meta = {
+        'indexes': [
+            ('status', 'next_run'),
+            ('clinic', 'status'),
+        ]
+    }
+
+# Remembers what the maps website said about an address so it only gets asked
+# once. 'key' is the normalized address from app/utils/geocode.py. Addresses it
+# couldn't find are remembered too (found=False), just for less time. MongoDB
+# deletes entries once 'expires' has passed.
+class GeocodeCache(Document):
+    key = StringField(primary_key=True)
+    found = BooleanField()
+    lat = FloatField()
+    lon = FloatField()
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    expires = DateTimeField()
+
+    meta = {
+        'indexes': [
+            {'fields': ['expires'], 'expireAfterSeconds': 0},
+        ]
+    }
+
+# Lets every worker process share one "next request allowed at" time for an
+# outside service, so together they stay under its rate limit.
+class RateGate(Document):
+    name = StringField(primary_key=True)
+    next_allowed = DateTimeField()
+
+# Running totals of one user's sleep, kept up to date by app/utils/sleepsummary.py
+# every time a Sleep is added, edited or deleted so pages don't have to read the
+# user's whole sleep history.
+class SleepSummary(Document):
+    sleeper = ReferenceField('User',reverse_delete_rule=CASCADE)
+    count = IntField(default=0)
+    total_hours = FloatField(default=0)
+    # how many nights got each rating, keyed '1' to '5'
+    ratings = DictField()
+    # the newest 30 nights, newest first: {'start', 'hours', 'rating'}
+    recent = ListField(DictField())
+    # streaks count nights in a row with a sleep logged
+    last_night = DateTimeField()
+    current_streak = IntField(default=0)
+    longest_streak = IntField(default=0)
+    modify_date = DateTimeField()
+
+    meta = {
+        'indexes': [
+            {'fields': ['sleeper'], 'unique': True},
+        ]
+    }
+
+# One row per consenting student with their sleep averages for the teacher
+# dashboard. The whole collection is rewritten by 'flask cohort build' (see
+# app/utils/cohort.py); nothing else writes to it. _id is the student's User id.
+class CohortSleep(Document):
+    fname = StringField()
+    lname = StringField()
+    email = StringField()
+    nights = IntField()
+    mean_hours = FloatField()
+    mean_rating = FloatField()
+    mean_feel = FloatField()
+    mean_minstosleep = FloatField()
+    # the same for the week before the build
+    recent_nights = IntField()
+    recent_hours = FloatField()
+    last_sleep = DateTimeField()
+    build_date = DateTimeField()
+
+    meta = {
+        'ordering': ['lname', 'fname'],
+        'indexes': [
+            ('lname', 'fname'),
+        ]
+    }
+
+# Builds the indexes declared in each collection's meta. This is called once when
+# the app starts so that the first request doesn't pay for it.
+def ensureIndexes():
+    for collection in [User, Sleep, Emoji, Meditation, MeditationUpload, MeditationUploadChunk, Clinic, GeocodeJob, GeocodeCache, SleepSummary, CohortSleep]:
+        collection.ensure_indexes()
@@ -3,10 +3,11 @@
 # Flask-WTForms library.
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileAllowed
 import mongoengine.errors
 from wtforms.validators import URL, Email, DataRequired, NumberRange
 from wtforms.fields.html5 import URLField, DateField, IntegerRangeField, EmailField
-from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, RadioField
+from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, RadioField, HiddenField
 from wtforms_components import TimeField
 
 
@@ -14,7 +15,7 @@ class ProfileForm(FlaskForm):
     role = SelectField('Role',choices=[("Teacher","Teacher"),("Student","Student")])
     fname = StringField('First Name', validators=[DataRequired()])
     lname = StringField('Last Name', validators=[DataRequired()]) 
-    image = FileField("Image") 
+    image = FileField("Image", validators=[FileAllowed(['jpg', 'jpeg', 'png', 'gif'], 'Pictures only (jpg, png or gif).')])
     submit = SubmitField('Post')
 
 class ConsentForm(FlaskForm):
@@ -37,12 +38,12 @@ class SleepForm(FlaskForm):
 class EmojiForm(FlaskForm):
     emote = SelectField('Pick an emoji', choices=[("😄","😄"),("😔","😔"),("😡","😡"),("🤓","🤓"),("😎","😎"),("🤐","🤐"),("😈","😈"),("🤤","🤤"),("🤭","🤭"),("🤔","🤔"),("😛","😛"),("😱","😱"),("👽","👽"),("🥱","🥱"),("🥴","🥴"),("🥰","🥰"),("🤒","🤒"),("😺","😺")], validators=[DataRequired()])
     location = TextAreaField('Where are you located?', validators=[DataRequired()])
-    dow = StringField('What day of the week is it?', validators=[DataRequired()])
-    time = StringField('What time of day is it?', validators=[DataRequired()] )
     submit = SubmitField('Emoji')
 
 class MeditationForm(FlaskForm):
     meditationfile = FileField("download then attach your meditation")
+    # filled in by the recorder on the page once it has finished uploading
+    uploadId = HiddenField()
     meditationUrl = StringField("copy paste the url here")
     starttime = TimeField("Start Time of Meditation") 
     name = StringField("Name your meditation")
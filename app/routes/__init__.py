@@ -4,4 +4,5 @@ from .emoji import *
 from .user import *
 from .sleep import *
 from .clinic import *
-from .meditation import *
\ No newline at end of file
+from .meditation import *
+from .teacher import *
\ No newline at end of file
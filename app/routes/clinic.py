@@ -1,11 +1,13 @@
 from app import app
-from app.utils.secrets import getSecrets
-import requests
-from flask import render_template, flash, redirect, url_for
-import requests
+from flask import render_template, flash, redirect, url_for, request, jsonify
 from flask_login import current_user
 from app.classes.data import Clinic
 from app.classes.forms import ClinicForm
+from app.utils.pagination import paginate
+from app.utils.clinicmap import clinicGeoJson, parseBbox
+from app.utils.nearest import nearestClinics
+from app.utils.geocode import enqueueGeocode, cachedGeocode, clinicKey, saveLatLon, NOT_FOUND
+from app.utils.pagecache import cachedPage, invalidate
 from flask_login import login_required
 import datetime as dt
 
@@ -14,17 +16,47 @@ import datetime as dt
 @login_required
 def clinicMap():
 
-    clinics = Clinic.objects()
+    # the map loads the clinics itself from /clinic/geojson as you move around
+    return render_template('cliniclocator.html')
 
-    return render_template('cliniclocator.html',clinics=clinics)
+# The clinics inside the part of the map that is on screen, as GeoJSON.
+# example: /clinic/geojson?bbox=-122.3,37.8,-122.2,37.9&zoom=13
+# When zoomed out, clinics that are close together come back as one cluster point.
+@app.route('/clinic/geojson')
+@login_required
+def clinicGeoJsonFeed():
+    try:
+        bbox = parseBbox(request.args.get('bbox', ''))
+    except ValueError:
+        return jsonify(error="bbox must look like minLon,minLat,maxLon,maxLat"), 400
+    zoom = min(max(request.args.get('zoom', 13, type=int), 0), 22)
+
+    response = jsonify(clinicGeoJson(bbox, zoom))
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response
+
+# The k clinics closest to a point, closest first, each with its distance in meters.
+# example: /clinic/nearest?lat=37.8323&lon=-122.2576&k=5
+@app.route('/clinic/nearest')
+@login_required
+def clinicNearest():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    k = request.args.get('k', 5, type=int)
+    if lat is None or lon is None or not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        return jsonify(error="lat and lon are required numbers"), 400
+
+    return jsonify(clinics=nearestClinics(lat, lon, k))
 
 @app.route('/clinic/list')
 @login_required
+@cachedPage('clinic')
 def clinicList():
 
-    clinics = Clinic.objects()
+    page = paginate(Clinic.objects(), 'createdate')
 
-    return render_template('clinics.html',clinics=clinics)
+    return render_template('clinics.html',clinics=page.items,page=page)
 
 
 @app.route('/clinic/<clinicID>')
@@ -42,34 +74,26 @@ def clinicDelete(clinicID):
     deleteClinic = Clinic.objects.get(id=clinicID)
 
     deleteClinic.delete()
+    invalidate('clinic')
     flash('The Clinic was deleted.')
     return redirect(url_for('clinicList'))
 
+# If this address has been looked up before the answer comes straight from the
+# geocode cache. Otherwise the lookup happens in the background (see
+# app/utils/geocode.py) so this just puts the clinic in line and returns right away.
+# The lat/lon show up on the clinic a moment later.
 def updateLatLon(clinic):
-    # get your email address for the secrets file
-    secrets=getSecrets()
-    # call the maps API with the address
-    url = f"https://nominatim.openstreetmap.org/search?street={clinic.streetAddress}&city={clinic.city}&state={clinic.state}&postalcode={clinic.zipcode}&format=json&addressdetails=1&email={secrets['MY_EMAIL_ADDRESS']}"
-    # get the response from the API
-    r = requests.get(url)
-    # Find the lat/lon in the response
-    try:
-        r = r.json()
-    except:
-        flash("unable to retrieve lat/lon")
-        return(clinic)
+    clinic.reload()
+    answer = cachedGeocode(clinicKey(clinic))
+    if answer == NOT_FOUND:
+        flash('unable to retrieve lat/lon')
+    elif answer:
+        saveLatLon(clinic, answer)
+        flash("clinic lat/lon updated")
     else:
-        if len(r) != 0:
-            # update the database
-            clinic.update(
-                lat = float(r[0]['lat']),
-                lon = float(r[0]['lon'])
-            )
-            flash(f"clinic lat/lon updated")
-            return(clinic)
-        else:
-            flash('unable to retrieve lat/lon')
-            return(clinic)
+        enqueueGeocode(clinic)
+        flash("Looking up the clinic's location. It will show on the map shortly.")
+    return(clinic)
 
 @app.route('/clinic/new', methods=['GET', 'POST'])
 @login_required
@@ -89,11 +113,10 @@ def clinicNew():
             modifydate = dt.datetime.utcnow,
         )
         newClinic.save()
+        invalidate('clinic')
 
         newClinic = updateLatLon(newClinic)
 
-        import requests
-
         return redirect(url_for('clinic',clinicID=newClinic.id))
 
     return render_template('clinicform.html',form=form)
@@ -118,6 +141,7 @@ def clinicEdit(clinicID):
             description = form.description.data,
             modifydate = dt.datetime.utcnow,
         )
+        invalidate('clinic')
         editClinic = updateLatLon(editClinic)
         return redirect(url_for('clinic',clinicID=clinicID))
 
@@ -1,15 +1,29 @@
 from app import app
-from flask import render_template
+from flask import render_template, jsonify, abort
+from flask_login import login_required, current_user
+from app.utils.pagecache import cachedPage, pageCache
 
 # This is for rendering the home page
 @app.route('/') #ask why this isnt working
+@cachedPage()
 def index():
     return render_template('index.html')
 
 @app.route('/aboutme')
+@cachedPage()
 def aboutus():
     return render_template('aboutme.html')
 
 @app.route('/aboutme') #ask why this isnt working
+@cachedPage()
 def aboutme():
     return render_template('aboutme.html')
+
+# How well the page cache is doing in this worker process. See app/utils/pagecache.py
+# The route names and counts are for teachers, or anyone when running in debug mode.
+@app.route('/cache/stats')
+@login_required
+def cacheStats():
+    if current_user.role != 'Teacher' and not app.debug:
+        abort(403)
+    return jsonify(pageCache.statsReport())
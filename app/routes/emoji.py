@@ -4,10 +4,15 @@
 
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, request, jsonify, make_response, abort
 from flask_login import current_user
 from app.classes.data import Emoji
 from app.classes.forms import EmojiForm
+from app.utils.pagination import paginate
+from app.utils.prefetch import prefetchUsers
+from app.utils.pagecache import cachedPage, invalidate
+from app.utils.writebehind import saveEmoji, bufferedEmoji, sessionEmoji, forgetSessionEmoji, flushIfPending
+from app.utils.emojitimeline import emojiTimeline, emojiHeatmapPng, invalidateEmojiTimeline, DEFAULT_DAYS
 from flask_login import login_required
 import datetime as dt
 
@@ -16,14 +21,39 @@ import datetime as dt
 @app.route('/emojis')
 # This means the user must be logged in to see this page
 @login_required
+# The rendered page is kept until an emoji is added, changed or deleted.
+@cachedPage('emoji')
 def emojiList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    emojis = Emoji.objects()
-    # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
-    # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('emojis.html',emojis=emojis)
+    # This retrieves one page of the 'emojis' that are stored in MongoDB, newest first.
+    # paginate() reads the page size and the next/previous cursor from the url.
+    # Only the emojis this user is allowed to see: their own, plus their students'
+    # if they are a teacher or parent. See OwnedQuerySet in data.py
+    page = paginate(Emoji.objects.for_user(current_user), 'create_date')
+    # load the authors of every emoji on the page with one query instead of one each
+    prefetchUsers(page.items, 'author')
+    # This renders (shows to the user) the emojis.html template. it also sends the page
+    # of emojis to the template as a variable named emojis and the page itself so the
+    # template can show the next/previous links.
+    return render_template('emojis.html',emojis=page.items,page=page)
+
+# Check-ins by hour of the day and day of the week for every emoji the user can
+# see, counted by MongoDB. See app/utils/emojitimeline.py
+# example: /emoji/timeline?days=90
+@app.route('/emoji/timeline')
+@login_required
+def emojiTimelineJson():
+    days = request.args.get('days', DEFAULT_DAYS, type=int)
+    return jsonify(emojiTimeline(current_user, days))
+
+@app.route('/emoji/timeline.png')
+@login_required
+def emojiTimelineImage():
+    days = request.args.get('days', DEFAULT_DAYS, type=int)
+    response = make_response(emojiHeatmapPng(current_user, days))
+    response.mimetype = 'image/png'
+    response.cache_control.private = True
+    response.cache_control.max_age = 300
+    return response
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -35,7 +65,18 @@ def emojiList():
 @login_required
 def emoji(emojiID):
     # retrieve the blog using the blogID
-    thisEmoji = Emoji.objects.get(id=emojiID)
+    # An emoji that was just made may still be waiting to be written (see
+    # app/utils/writebehind.py). Look in the buffer, then the database, then the
+    # copy kept in the session.
+    thisEmoji = bufferedEmoji(emojiID, current_user)
+    if thisEmoji is None:
+        try:
+            thisEmoji = Emoji.objects.for_user(current_user).get(id=emojiID)
+            forgetSessionEmoji(emojiID)
+        except (mongoengine.errors.DoesNotExist, mongoengine.errors.ValidationError):
+            thisEmoji = sessionEmoji(emojiID, current_user)
+    if thisEmoji is None:
+        abort(404)
     # If there are no comments the 'comments' object will have the value 'None'. Comments are 
     # related to blogs meaning that every comment contains a reference to a blog. In this case
     # there is a field on the comment collection called 'blog' that is a reference the Blog
@@ -44,6 +85,19 @@ def emoji(emojiID):
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('emoji.html',emoji=thisEmoji)
 
+# Editing and deleting need the emoji to be in MongoDB already. One that was just made
+# may still be in the write-behind buffer of another worker process, so tell the user
+# to wait a moment instead of failing. Returns None in that case.
+def savedEmoji(emojiID):
+    flushIfPending(emojiID)
+    try:
+        return Emoji.objects.get(id=emojiID)
+    except (mongoengine.errors.DoesNotExist, mongoengine.errors.ValidationError):
+        if sessionEmoji(emojiID, current_user) is None:
+            abort(404)
+        flash("That check-in is still being saved. Try again in a moment.")
+        return None
+
 # This route will delete a specific blog.  You can only delete the blog if you are the author.
 # <blogID> is a variable sent to this route by the user who clicked on the trash can in the 
 # template 'blog.html'. 
@@ -53,21 +107,23 @@ def emoji(emojiID):
 @login_required
 def emojiDelete(emojiID):
     # retrieve the blog to be deleted using the blogID
-    deleteEmoji = Emoji.objects.get(id=emojiID)
+    deleteEmoji = savedEmoji(emojiID)
+    if deleteEmoji is None:
+        return redirect(url_for('emoji',emojiID=emojiID))
     # check to see if the user that is making this request is the author of the blog.
     # current_user is a variable provided by the 'flask_login' library.
     if current_user == deleteEmoji.author:
         # delete the blog using the delete() method from Mongoengine
         deleteEmoji.delete()
+        invalidateEmojiTimeline(current_user.id)
+        invalidate('emoji')
         # send a message to the user that the blog was deleted.
         flash('The Emoji was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a emoji you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    emojis = Emoji.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('emojis.html',emojis=emojis)
+    # Send the user to the list of remaining emojis.
+    return redirect(url_for('emojiList'))
 
 # This route actually does two things depending on the state of the if statement 
 # 'if form.validate_on_submit()'. When the route is first called, the form has not 
@@ -96,14 +152,15 @@ def emojiNew():
             # the right side is the data the user entered which is held in the form object.
             emote = form.emote.data,
             location = form.location.data,
-            time = form.time.data,
             author = current_user.id,
-            dow = form.dow.data,
             # This sets the modifydate to the current datetime.
             modify_date = dt.datetime.utcnow
         )
-        # This is a method that saves the data to the mongoDB database.
-        newEmoji.save()
+        # This saves the data to the mongoDB database, or queues it to be saved with
+        # other check-ins when EMOJI_WRITE_BEHIND is on. See app/utils/writebehind.py
+        saveEmoji(newEmoji)
+        invalidateEmojiTimeline(current_user.id)
+        invalidate('emoji')
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -127,7 +184,9 @@ def emojiNew():
 @app.route('/emoji/edit/<emojiID>', methods=['GET', 'POST'])
 @login_required
 def emojiEdit(emojiID):
-    editEmoji = Emoji.objects.get(id=emojiID)
+    editEmoji = savedEmoji(emojiID)
+    if editEmoji is None:
+        return redirect(url_for('emoji',emojiID=emojiID))
     # if the user that requested to edit this blog is not the author then deny them and
     # send them back to the blog. If True, this will exit the route completely and none
     # of the rest of the route will be run.
@@ -142,11 +201,9 @@ def emojiEdit(emojiID):
         editEmoji.update(
             emote = form.emote.data,
             location = form.location.data,
-            time = form.time.data,
-            dow = form.dow.data,
-            
             modify_date = dt.datetime.utcnow
         )
+        invalidate('emoji')
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('emoji',emojiID=emojiID))
 
@@ -154,8 +211,6 @@ def emojiEdit(emojiID):
     # and place it in the form object so it will be displayed to the user on the template.
     form.emote.data = editEmoji.emote
     form.location.data = editEmoji.location
-    form.time.data = editEmoji.time
-    form.dow.data = editEmoji.dow
 
 
     # Send the user to the blog form that is now filled out with the current information
@@ -1,25 +1,18 @@
 
-# Python standard libraries
-import json
 from app import app, login_manager
-from flask import redirect, request, url_for, flash
+from flask import redirect, request, url_for, flash, session
 from flask_login import (
     current_user,
     login_required,
     login_user,
     logout_user,
 )
-from oauthlib.oauth2 import WebApplicationClient
-import requests
 from app.classes.data import User
-from app.utils.secrets import getSecrets
+from app.utils.oauth import provider, OAuthError
+from app.utils.usercache import cachedUser, invalidateUser
 import mongoengine.errors
-
-#get all the credentials for google
-secrets = getSecrets()
-
-# OAuth2 client setup
-client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
+from hmac import compare_digest
+from secrets import token_urlsafe
 
 # When a route is decorated with @login_required and fails this code is run
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.unauthorized_handler
@@ -30,70 +23,52 @@ def unauthorized():
 
 # Flask-Login helper to retrieve a user object from our db
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
+# The user is kept in memory for a short time (see app/utils/usercache.py) so most
+# requests don't touch the database at all.
 @login_manager.user_loader
 def load_user(id):
     try:
-        return User.objects.get(pk=id)
+        return cachedUser(id)
     except mongoengine.errors.DoesNotExist:
         flash("Something strange has happened. This user doesn't exist. Please click logout.")
         return redirect(url_for('index'))
 
-def get_google_provider_cfg():
-    return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
-
 @app.route("/login")
 def login():
-    # Find out what URL to hit for Google login
-    google_provider_cfg = get_google_provider_cfg()
-    authorization_endpoint = google_provider_cfg["authorization_endpoint"]
-
-    # Use library to construct the request for login and provide
-    # scopes that let you retrieve user's profile from Google
-    request_uri = client.prepare_request_uri(
-        authorization_endpoint,
-        redirect_uri=request.base_url + "/callback",
-        scope=["openid", "email", "profile"],
-        prompt="select_account"
-    )
+    # Find out what URL to hit for Google login and provide
+    # scopes that let you retrieve user's profile from Google.
+    # Google sends 'state' back to the callback unchanged. Only this browser's
+    # session knows it, so another site can't finish a login it started.
+    state = token_urlsafe(32)
+    session['oauthState'] = state
+    try:
+        request_uri = provider().authorizationUrl(request.base_url + "/callback", state)
+    except OAuthError:
+        app.logger.exception("could not start a Google login")
+        flash("Google login isn't available right now. Please try again in a minute.")
+        return redirect(url_for('index'))
     return redirect(request_uri)
 
 
 @app.route("/login/callback")
 def callback():
-    # Get authorization code Google sent back to you
+    # Get authorization code Google sent back to you and trade it for
+    # the user's profile information, including their Google Profile
+    # Image and Email
+    state = session.pop('oauthState', None)
+    if not state or not compare_digest(state, request.args.get("state", "")):
+        flash("That login didn't start here or has expired. Please log in again.")
+        return redirect(url_for('index'))
     code = request.args.get("code")
-
-    # Find out what URL to hit to get tokens that allow you to ask for
-    # things on behalf of a user
-    google_provider_cfg = get_google_provider_cfg()
-    token_endpoint = google_provider_cfg["token_endpoint"]
-
-    # Prepare and send request to get tokens! Yay tokens!
-    token_url, headers, body = client.prepare_token_request(
-        token_endpoint,
-        authorization_response=request.url,
-        redirect_url=request.base_url,
-        code=code,
-    )
-    token_response = requests.post(
-        token_url,
-        headers=headers,
-        data=body,
-        auth=(secrets['GOOGLE_CLIENT_ID'], secrets['GOOGLE_CLIENT_SECRET']),
-    )
-
-    # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json()))
-
-    # Now that we have tokens (yay) let's find and hit URL
-    # from Google that gives you user's profile information,
-    # including their Google Profile Image and Email
-    userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    try:
+        userinfo = provider().userinfo(request.url, request.base_url, code)
+    except OAuthError:
+        app.logger.exception("Google login failed")
+        flash("Google login didn't work. Please try again.")
+        return redirect(url_for('index'))
 
     ### Example info that comes back from google
-    # userinfo_response.json() --> {
+    # userinfo --> {
     # 'sub': '118043475517321263044', 
     # 'name': 'STEPHEN WRIGHT', 
     # 'given_name': 'STEPHEN', 
@@ -106,20 +81,20 @@ def callback():
     # 'hd': 'ousd.org'
     # }
 
-    # if userinfo_response.json().get("hd") != "ousd.org":
+    # if userinfo.get("hd") != "ousd.org":
     #     flash("You must have an ousd.org email account to access this site.")
     #     return "You must have an ousd.org email account to access this site.", 400
 
     # We want to make sure their email is verified.
     # The user authenticated with Google, authorized our
     # app, and now we've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
-        gid = userinfo_response.json()["sub"]
-        gmail = userinfo_response.json()["email"]
-        gprofile_pic = userinfo_response.json()["picture"]
-        gname = userinfo_response.json()["name"]
-        gfname = userinfo_response.json()["given_name"]
-        glname = userinfo_response.json()["family_name"]
+    if userinfo.get("email_verified"):
+        gid = userinfo["sub"]
+        gmail = userinfo["email"]
+        gprofile_pic = userinfo.get("picture")
+        gname = userinfo.get("name")
+        gfname = userinfo.get("given_name")
+        glname = userinfo.get("family_name")
     else:
         return "User email not available or not verified by Google.", 400
 
@@ -128,7 +103,7 @@ def callback():
         thisUser=User.objects.get(email=gmail)
     # if the user does not exist, create them and make sure they are ousd.org
     except mongoengine.errors.DoesNotExist:
-        # if userinfo_response.json().get("hd") == "ousd.org":
+        # if userinfo.get("hd") == "ousd.org":
         thisUser = User(
             gid=gid, 
             gname=gname, 
@@ -151,6 +126,7 @@ def callback():
             lname = glname
         )
     thisUser.reload()
+    invalidateUser(thisUser.id)
 
     # Begin user session by logging the user in
     login_user(thisUser)
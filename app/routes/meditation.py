@@ -4,10 +4,16 @@
 
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, abort, request, jsonify
 from flask_login import current_user
-from app.classes.data import Meditation
+from app.classes.data import Meditation, MeditationUpload
 from app.classes.forms import MeditationForm
+from app.utils.pagination import paginate
+from app.utils.prefetch import prefetchUsers
+from app.utils.gridfsstream import gridFileResponse
+from app.utils.uploads import startUpload, appendChunk, finishUpload, MAX_CHUNK_SIZE
+from app.utils.audio import queueTranscode
+from app.utils.pagecache import cachedPage, invalidate
 from flask_login import login_required
 import datetime as dt
 
@@ -17,27 +23,41 @@ import datetime as dt
 @app.route('/meditations')
 # This means the user must be logged in to see this page
 @login_required
+# The rendered page is kept until a meditation is added, changed or deleted.
+@cachedPage('meditation')
 def meditationList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    meditations = Meditation.objects()
-    # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
-    # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('meditations.html',meditations=meditations)
+    # This retrieves one page of the meditations that are stored in MongoDB, newest first.
+    # paginate() reads the page size and the next/previous cursor from the url.
+    # Only the meditations this user is allowed to see. See OwnedQuerySet in data.py
+    page = paginate(Meditation.objects.for_user(current_user).exclude('peaks'), 'create_date')
+    # load the authors of every meditation on the page with one query instead of one each
+    prefetchUsers(page.items, 'author')
+    # This renders (shows to the user) the meditations.html template with that page.
+    return render_template('meditations.html',meditations=page.items,page=page)
 
 @app.route('/meditation/<meditationID>')
 # This route will only run if the user is logged in.
 @login_required
 def meditation(meditationID):
     # retrieve the blog using the blogID
-    thismeditation = Meditation.objects.get(id=meditationID)
+    thismeditation = Meditation.objects.for_user(current_user).get_or_404(id=meditationID)
     # If there are no comments the 'comments' object will have the value 'None'. Comments are 
     # related to blogs meaning that every comment contains a reference to a blog. In this case
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('meditation.html',meditation=thismeditation)
+
+# This streams the recording for a meditation straight out of GridFS. The <audio>
+# player on meditation.html asks for pieces of it with Range requests as it plays
+# and when you skip around, so the whole file is never loaded into memory.
+@app.route('/meditation/<meditationID>/audio')
+@login_required
+def meditationAudio(meditationID):
+    thismeditation = Meditation.objects.for_user(current_user).only('meditationfile').get_or_404(id=meditationID)
+    if not thismeditation.meditationfile:
+        abort(404)
+    return gridFileResponse(thismeditation.meditationfile)
 # This route actually does two things depending on the state of the if statement 
 # 'if form.validate_on_submit()'. When the route is first called, the form has not 
 # been submitted yet so the if statement is False and the route renders the form.
@@ -65,18 +85,35 @@ def meditationNew():
         newMeditation = Meditation(
             # the left side is the name of the field from the data table
             # the right side is the data the user entered which is held in the form object.
+            author = current_user.id,
             starttime = startT,
             endtime = endT,
             takeaway = form.takeaway.data,
             pride = form.pride.data,
             name = form.name.data,
-            meditationfile = form.meditationfile.data,
             meditationUrl = form.meditationUrl.data,
             # This sets the modifydate to the current datetime.
             modify_date = dt.datetime.utcnow
         )
+        # This stores the recording in GridFS along with its type so it can be played back.
+        # A recording made on the page was already uploaded in pieces, so those just get
+        # joined together. Otherwise use the file that was attached to the form.
+        recording = form.meditationfile.data
+        if form.uploadId.data:
+            upload = MeditationUpload.objects.get_or_404(id=form.uploadId.data, author=current_user.id)
+            try:
+                finishUpload(upload, newMeditation.meditationfile)
+            except ValueError:
+                flash("Part of your recording didn't make it to the server. Please record it again.")
+                return render_template('meditationform.html',form=form)
+        elif recording:
+            newMeditation.meditationfile.put(recording, content_type=recording.mimetype, filename=recording.filename)
         # This is a method that saves the data to the mongoDB database.
         newMeditation.save()
+        invalidate('meditation')
+        # This shrinks the recording and works out how long it is in the background
+        if newMeditation.meditationfile:
+            queueTranscode(newMeditation.id)
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -94,6 +131,35 @@ def meditationNew():
 
 
 
+# These routes let the recorder on meditationform.html upload a recording in pieces
+# while it records. See app/utils/uploads.py for how the pieces fit together.
+# POST starts an upload, GET asks how much has arrived (for picking up again after
+# the connection drops) and PUT sends the next piece: PUT /meditation/upload/<id>?offset=0
+@app.route('/meditation/upload', methods=['POST'])
+@login_required
+def meditationUploadStart():
+    upload = startUpload(current_user, request.args.get('type'))
+    return jsonify(uploadId=str(upload.id), received=0, maxChunkSize=MAX_CHUNK_SIZE), 201
+
+@app.route('/meditation/upload/<uploadID>', methods=['GET', 'PUT'])
+@login_required
+def meditationUpload(uploadID):
+    upload = MeditationUpload.objects.get_or_404(id=uploadID, author=current_user.id)
+    if request.method == 'GET':
+        return jsonify(uploadId=uploadID, received=upload.received)
+
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify(error="offset is required", received=upload.received), 400
+    if request.content_length is None or request.content_length > MAX_CHUNK_SIZE:
+        return jsonify(error=f"pieces must be at most {MAX_CHUNK_SIZE} bytes", received=upload.received), 413
+
+    accepted, received = appendChunk(upload, offset, request.get_data(cache=False))
+    if not accepted:
+        # 409 tells the recorder to carry on from 'received' instead
+        return jsonify(error="offset does not match", received=received), 409
+    return jsonify(uploadId=uploadID, received=received)
+
 # This route enables a user to edit a blog.  This functions very similar to creating a new 
 # blog except you don't give the user a blank form.  You have to present the user with a form
 # that includes all the values of the original blog. Read and understand the new blog route 
@@ -110,15 +176,14 @@ def meditationDelete(meditationID):
         #DO I NEED PARENT???? BECAUSE I CHANGED IT TO AUTHOR AND GOT RID OF PARENT
         # delete the blog using the delete() method from Mongoengine
         deletemeditation.delete()
+        invalidate('meditation')
         # send a message to the user that the blog was deleted.
         flash('The meditaion was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a meditaion you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    meditations = Meditation.objects()  
-    # Send the user to the list of remaining blogs.
-    return render_template('meditations.html',meditations=meditations)
+    # Send the user to the list of remaining meditations.
+    return redirect(url_for('meditationList'))
 #SHOULD I EDIT '/deer/edit???
 @app.route('/meditation/edit/<meditationID>', methods=['GET', 'POST'])
 @login_required
@@ -144,6 +209,7 @@ def meditationEdit(meditationID):
             submit = form.submit.data,
             modify_date = dt.datetime.utcnow
         )
+        invalidate('meditation')
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('meditation',meditationID=meditationID))
 
@@ -1,13 +1,30 @@
-from matplotlib import pyplot as plt
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, make_response, request, jsonify
 from flask_login import current_user
-from app.classes.data import Sleep, User
+from app.classes.data import Sleep, User, sleepVersion
 from app.classes.forms import SleepForm, ConsentForm
+from app.utils.sleepgraph import sleepGraphPng, sleepGraphEtag, invalidateSleepGraph
+from app.utils.sleepstats import sleepStats, parseStatsDate, BUCKET_FORMATS
+from app.utils.pagination import paginate
+from app.utils.prefetch import prefetchUsers
+from app.utils.usercache import invalidateUser
+from app.utils.visibility import visibilityChanged
+from app.utils.pagecache import cachedPage, invalidate
+from app.utils.sleepanalytics import userAnalytics, schoolAnalytics, invalidateSleepAnalytics
+from app.utils.sleepsummary import summaryAdd, summaryChange, summaryRemove, summaryStats, recentEntry
 from flask_login import login_required
 import datetime as dt
 
+# Call this whenever a Sleep is created, edited or deleted. It moves the user's
+# sleep_version forward and throws away anything cached from their old sleep data.
+def sleepChanged(sleeperId):
+    User.objects(id=sleeperId).update_one(inc__sleep_version=1)
+    invalidateSleepGraph(sleeperId)
+    invalidateSleepAnalytics(sleeperId)
+    invalidateUser(sleeperId)
+    invalidate('sleep')
+
 @app.route('/consent', methods=['GET', 'POST'])
 def consent():
     form = ConsentForm()
@@ -22,6 +39,8 @@ def consent():
             adult_lname = form.adult_lname.data,
             adult_email = form.adult_email.data
         )
+        # teachers and the adult may now see more or fewer of this user's records
+        visibilityChanged(current_user.id)
         return redirect(url_for('myProfile'))
 
     form.consent.process_data(current_user.consent)
@@ -32,8 +51,10 @@ def consent():
 
 
 @app.route('/overview')
+@cachedPage('sleep')
 def overview():
-    return render_template('overview.html')
+    summary = summaryStats(current_user.id) if current_user.is_authenticated else None
+    return render_template('overview.html', summary=summary)
 
 @app.route('/sleep/new', methods=['GET', 'POST'])
 @login_required
@@ -42,8 +63,8 @@ def sleepNew():
     if form.validate_on_submit():
         startDT = dt.datetime.combine(form.sleep_date.data, form.starttime.data)
         endDT = dt.datetime.combine(form.wake_date.data, form.endtime.data)
-        diff = startDT - endDT
-        hours = diff.seconds/60/60
+        diff = endDT - startDT
+        hours = diff.total_seconds()/60/60
         newSleep = Sleep(
             hours = hours,
             sleeper = current_user,
@@ -54,6 +75,8 @@ def sleepNew():
             minstosleep = form.minstosleep.data,
         )
         newSleep.save()
+        summaryAdd(current_user.id, newSleep)
+        sleepChanged(current_user.id)
         return redirect(url_for("sleep",sleepId=newSleep.id))
     
     if form.submit.data:
@@ -79,7 +102,8 @@ def sleepEdit(sleepId):
         startDT = dt.datetime.combine(form.sleep_date.data, form.starttime.data)
         endDT = dt.datetime.combine(form.wake_date.data, form.endtime.data)
         diff = endDT - startDT
-        hours = diff.seconds/60/60
+        hours = diff.total_seconds()/60/60
+        before = recentEntry(editSleep)
 
         editSleep.update(
             hours = hours,
@@ -89,6 +113,9 @@ def sleepEdit(sleepId):
             feel = form.feel.data,
             minstosleep = form.minstosleep.data
         )
+        editSleep.reload()
+        summaryChange(editSleep.sleeper.id, before, recentEntry(editSleep))
+        sleepChanged(editSleep.sleeper.id)
         return redirect(url_for("sleep",sleepId=editSleep.id))
     
     form.sleep_date.process_data(editSleep.start.date())
@@ -104,23 +131,32 @@ def sleepEdit(sleepId):
 @login_required
 
 def sleep(sleepId):
-    thisSleep = Sleep.objects.get(id=sleepId)
+    thisSleep = Sleep.objects.for_user(current_user).get_or_404(id=sleepId)
     return render_template("sleep.html",sleep=thisSleep)
 
 @app.route('/sleeps')
 @login_required
+@cachedPage('sleep')
 
 def sleeps():
-    sleeps = Sleep.objects()
-    return render_template("sleeps.html",sleeps=sleeps)
+    # only the sleeps this user is allowed to see, see OwnedQuerySet in data.py
+    page = paginate(Sleep.objects.for_user(current_user), 'start')
+    prefetchUsers(page.items, 'sleeper')
+    return render_template("sleeps.html",sleeps=page.items,page=page)
 
 @app.route('/sleep/delete/<sleepId>')
 @login_required
 
 def sleepDelete(sleepId):
     delSleep = Sleep.objects.get(id=sleepId)
+    if delSleep.sleeper != current_user:
+        flash("You can't delete a sleep you don't own.")
+        return redirect(url_for('sleeps'))
     sleepDate = delSleep.sleep_date
+    sleeperId = delSleep.sleeper.id
     delSleep.delete()
+    summaryRemove(sleeperId, delSleep)
+    sleepChanged(sleeperId)
     flash(f"sleep with date {sleepDate} has been deleted.")
     return redirect(url_for('sleeps'))
 
@@ -128,32 +164,59 @@ def sleepDelete(sleepId):
 @login_required
 
 def sleepgraph():
-    sleeps = Sleep.objects()
-
-
-    hours = []
-    dates = []
-    colors = []
-    for sleep in sleeps:
-        hours.append(sleep.hours)
-        dates.append(sleep.start.date())   
-        if sleep.rating >=4:
-            colors.append('green')
-        elif sleep.rating == 3:
-            colors.append('yellow')
-        else:
-            colors.append('red')
-    
-    plt.switch_backend('Agg') 
-    fig, ax = plt.subplots()
-    
-    ax.scatter(dates, hours, marker='o', c=colors)
+    return render_template('sleepgraph.html')
 
+# The graph itself is drawn in memory for the logged in user and cached until
+# their sleep data changes. See app/utils/sleepgraph.py
+@app.route('/sleepgraph.png')
+@login_required
+
+def sleepgraphImage():
+    # read fresh, the logged in user kept in memory may not have the latest version
+    version = sleepVersion(current_user.id)
+    response = make_response(sleepGraphPng(current_user.id, version))
+    response.mimetype = 'image/png'
+    # the browser keeps its copy but asks each time; if the data version has not
+    # changed it gets a tiny 304 back instead of the image
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.set_etag(sleepGraphEtag(current_user.id, version))
+    return response.make_conditional(request)
+
+
+# Sleep statistics for the logged in user as JSON. All of the math happens in
+# MongoDB, see app/utils/sleepstats.py
+# example: /sleep/stats?bucket=week&start=2024-01-01&end=2024-06-01
+@app.route('/sleep/stats')
+@login_required
+
+def sleepStatsJson():
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in BUCKET_FORMATS:
+        return jsonify(error=f"bucket must be one of {', '.join(BUCKET_FORMATS)}"), 400
+    try:
+        start = parseStatsDate(request.args.get('start'))
+        end = parseStatsDate(request.args.get('end'))
+    except ValueError:
+        return jsonify(error="start and end must look like YYYY-MM-DD"), 400
+
+    stats = sleepStats(current_user.id, start=start, end=end, bucket=bucket)
+    return jsonify(bucket=bucket, stats=stats)
+
+
+# Sleep debt, weekday effects, bedtime and what goes with falling asleep slowly,
+# worked out with NumPy. See app/utils/sleepanalytics.py
+# /sleep/analytics is the logged in user, /sleep/analytics?scope=school is every
+# student who has consented and can only be seen by teachers.
+@app.route('/sleep/analytics')
+@login_required
 
-    ax.legend()
-    plt.yticks(hours)
-    plt.xticks(dates, rotation=45)
-    plt.gcf().set_size_inches(10, 5)
-    fig.savefig("app/static/graphs/sleep.png", bbox_inches="tight")
-    fig.show()
-    return render_template('sleepgraph.html',images=['sleep.png'])
\ No newline at end of file
+def sleepAnalyticsJson():
+    scope = request.args.get('scope', 'me')
+    if scope == 'school':
+        if current_user.role != 'Teacher':
+            return jsonify(error="only teachers can see the whole school"), 403
+        return jsonify(scope=scope, **schoolAnalytics())
+    if scope != 'me':
+        return jsonify(error="scope must be me or school"), 400
+    return jsonify(scope=scope, **userAnalytics(current_user))
@@ -0,0 +1,15 @@
+from app import app
+from flask import render_template, flash, redirect, url_for
+from flask_login import current_user, login_required
+from app.utils.cohort import cohortDashboard
+
+# Sleep averages for every student who has consented to share them. The numbers
+# are worked out nightly by 'flask cohort build', see app/utils/cohort.py
+@app.route('/teacher/dashboard')
+@login_required
+
+def teacherDashboard():
+    if current_user.role != 'Teacher':
+        flash("Only teachers can see the class dashboard.")
+        return redirect(url_for('index'))
+    return render_template('teacherdashboard.html', cohort=cohortDashboard())
@@ -1,9 +1,15 @@
 from app import app
 from flask_login.utils import login_required
-from flask import render_template, redirect, flash, url_for
+from flask import render_template, redirect, flash, url_for, request, abort, Response
 from app.classes.data import User
 from app.classes.forms import ProfileForm
+from app.utils.avatars import saveThumbnail, makeThumbnail, BAD_IMAGE
+from app.utils.usercache import invalidateUser
+from app.utils.visibility import visibilityChanged
+from app.utils.sleepsummary import summaryStats
+from app.utils.pagecache import cachedPage
 from flask_login import current_user
+import mongoengine.errors
 
 # These routes and functions are for accessing and editing user profiles.
 
@@ -11,10 +17,13 @@ from flask_login import current_user
 @app.route('/myprofile')
 # This line tells the user that they cannot access this without being loggedin
 @login_required
+# The page is kept until the user's profile or sleeps change, see app/utils/pagecache.py
+@cachedPage('sleep')
 # This is the function that is run when the route is triggered
 def myProfile():
     # This sends the user to their profile page which renders the 'profilemy.html' template
-    return render_template('profilemy.html')
+    # the sleep totals come from one small SleepSummary document
+    return render_template('profilemy.html', summary=summaryStats(current_user.id))
 
 # This is the route for editing a profile
 # the methods part is required if you are using a form 
@@ -28,6 +37,16 @@ def profileEdit():
     form = ProfileForm()
     # This asks if the form was valid when it was submitted
     if form.validate_on_submit():
+        # Make the small version of the image first so a file that isn't really a
+        # picture is turned away before anything is saved
+        thumbnail = None
+        if form.image.data:
+            try:
+                thumbnail = makeThumbnail(form.image.data)
+            except BAD_IMAGE:
+                flash("That file couldn't be read as a picture. Please choose a jpg, png or gif.")
+                return render_template('profileform.html', form=form)
+            form.image.data.seek(0)
         # if the form was valid then this gets an object that represents the currUser's data
         currUser = User.objects.get(id=current_user.id)
         # This updates the data on the user record that was collected from the form
@@ -43,6 +62,14 @@ def profileEdit():
             currUser.image.put(form.image.data, content_type = 'image/jpeg')
             # This saves all the updates
             currUser.save()
+            # This stores the small version of the image that the site actually shows
+            saveThumbnail(currUser, thumbnail)
+        # Forget the copy of the user kept for logins so the changes show up. A new
+        # role also changes whose records this user can see and who can see theirs.
+        if form.role.data != currUser.role:
+            visibilityChanged(currUser.id)
+        else:
+            invalidateUser(currUser.id)
         # Then sends the user to their profle page
         return redirect(url_for('myProfile'))
 
@@ -53,3 +80,34 @@ def profileEdit():
     form.role.data = current_user.role
 
     return render_template('profileform.html', form=form)
+
+# This sends a user's profile picture as a small thumbnail. Templates use it like
+# <img src="{{url_for('userAvatar', userID=user.id)}}">
+# The browser keeps a copy for a few minutes and after that only downloads it again
+# if the picture changed (the ETag is the id of the stored thumbnail).
+@app.route('/user/<userID>/avatar')
+@login_required
+def userAvatar(userID):
+    try:
+        user = User.objects.only('image', 'thumbnail').get(id=userID)
+    except (mongoengine.errors.DoesNotExist, mongoengine.errors.ValidationError):
+        abort(404)
+
+    # pictures uploaded before thumbnails existed are sent full size until
+    # 'flask users thumbnails' has made theirs. Nothing is written here.
+    picture = user.thumbnail if user.thumbnail else user.image
+    if not picture:
+        abort(404)
+
+    etag = str(picture.grid_id)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        stored = picture.get()
+        # GridFS hands the file back in chunks so it is never read into memory whole
+        response = Response(stored, mimetype=stored.content_type or 'image/jpeg')
+        response.content_length = stored.length
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 300
+    return response
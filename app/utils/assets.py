@@ -0,0 +1,224 @@
+# Fingerprinted static files that browsers can keep for good.
+#
+#     flask assets build
+#
+# copies every file in app/static to app/static/dist with a hash of its contents in
+# the name (edit.png -> dist/edit.3f9c0a1b2d4e.png) and writes a manifest of the
+# new names. After that url_for('static', filename='edit.png') gives the hashed
+# name, and those files are sent with "Cache-Control: immutable" and a one year
+# max-age. A changed file gets a new name, so a browser that has been here before
+# loads the page without asking for any of its images, css or sound again.
+#
+# The build also makes smaller copies next to each hashed file and the matching
+# one is sent in its place:
+#   - .webp for PNGs and GIFs (animated GIFs stay animated) to browsers that say
+#     they take image/webp,
+#   - .gz, and .br when the brotli package is installed, for text like css and js
+#     to browsers that take that encoding.
+# A copy is only kept when it is actually smaller. Responses carry Vary so caches
+# in between keep the versions apart.
+#
+# Until the build has been run nothing changes: url_for gives the plain names and
+# Flask sends them the way it always has. Old hashed files are left in dist so
+# pages that were cached before a new build still work; --clean removes them.
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+from io import BytesIO
+
+from flask import request, send_from_directory
+from PIL import Image
+
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+app.config.setdefault('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+app.config.setdefault('ASSETS_MANIFEST', os.path.join(app.config['ASSETS_DIR'], 'manifest.json'))
+app.config.setdefault('ASSETS_WEBP_QUALITY', 80)
+
+HASH_LENGTH = 12
+ONE_YEAR = 365 * 24 * 60 * 60
+IMMUTABLE = f'public, max-age={ONE_YEAR}, immutable'
+WEBP_SOURCES = ('.png', '.gif')
+# a smaller copy has to save at least this much to be worth keeping
+MIN_SAVING = 0.05
+# already compressed formats don't get any smaller
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'audio/wav', 'audio/x-wav')
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+manifest = {'files': {}, 'variants': {}}
+
+
+def loadManifest():
+    global manifest
+    try:
+        with open(app.config['ASSETS_MANIFEST']) as manifestFile:
+            manifest = json.load(manifestFile)
+    except FileNotFoundError:
+        manifest = {'files': {}, 'variants': {}}
+    return manifest
+
+
+def distPrefix():
+    # where the hashed files are, relative to the static folder
+    return os.path.relpath(app.config['ASSETS_DIR'], app.static_folder).replace(os.sep, '/') + '/'
+
+
+def staticFiles():
+    # (name used in url_for, full path) for everything in the static folder except dist
+    distDir = os.path.abspath(app.config['ASSETS_DIR'])
+    for root, dirs, files in os.walk(app.static_folder):
+        dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(root, name)) != distDir]
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, app.static_folder).replace(os.sep, '/'), path
+
+
+def hashedName(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    stem, ext = os.path.splitext(name)
+    return f'{distPrefix()}{stem}.{digest}{ext}'
+
+
+def writeFile(name, data):
+    # written to a temporary name and renamed so a worker never sends half a file
+    path = os.path.join(app.static_folder, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as output:
+        output.write(data)
+    os.replace(temporary, path)
+
+
+def worthKeeping(smaller, original):
+    return smaller is not None and len(smaller) <= len(original) * (1 - MIN_SAVING)
+
+
+def webpBytes(path):
+    with Image.open(path) as image:
+        buffer = BytesIO()
+        if getattr(image, 'is_animated', False):
+            # Pillow takes the frame durations and loop count from the GIF
+            image.save(buffer, 'WEBP', save_all=True, quality=app.config['ASSETS_WEBP_QUALITY'])
+        else:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image.save(buffer, 'WEBP', quality=app.config['ASSETS_WEBP_QUALITY'])
+        return buffer.getvalue()
+
+
+def compressible(name):
+    mimetype = mimetypes.guess_type(name)[0] or ''
+    return mimetype.startswith(COMPRESSIBLE)
+
+
+def compressed(data, encoding):
+    if encoding == 'gzip':
+        # mtime=0 so building the same file twice gives the same bytes
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == 'br' and brotli:
+        return brotli.compress(data)
+    return None
+
+
+def buildAssets(clean=False):
+    built = {'files': {}, 'variants': {}}
+    for name, path in staticFiles():
+        with open(path, 'rb') as source:
+            data = source.read()
+        hashed = hashedName(name, data)
+        built['files'][name] = hashed
+        # the name comes from the contents, so a file that is already there is the same
+        if not os.path.exists(os.path.join(app.static_folder, *hashed.split('/'))):
+            writeFile(hashed, data)
+
+        variants = {}
+        if name.lower().endswith(WEBP_SOURCES):
+            try:
+                webp = webpBytes(path)
+            except (OSError, ValueError) as error:
+                app.logger.warning(f"could not make a WebP copy of {name}: {error}")
+                webp = None
+            if worthKeeping(webp, data):
+                writeFile(hashed + '.webp', webp)
+                variants['webp'] = hashed + '.webp'
+        if compressible(name):
+            for encoding, suffix in ENCODINGS:
+                smaller = compressed(data, encoding)
+                if worthKeeping(smaller, data):
+                    writeFile(hashed + suffix, smaller)
+                    variants[encoding] = hashed + suffix
+        if variants:
+            built['variants'][hashed] = variants
+
+    writeFile(os.path.relpath(app.config['ASSETS_MANIFEST'], app.static_folder).replace(os.sep, '/'),
+              json.dumps(built, indent=2, sort_keys=True).encode())
+    removed = removeStale(built) if clean else 0
+    loadManifest()
+    return built, removed
+
+
+def removeStale(built):
+    keep = set(built['files'].values())
+    for variants in built['variants'].values():
+        keep.update(variants.values())
+    removed = 0
+    manifestPath = os.path.abspath(app.config['ASSETS_MANIFEST'])
+    for root, dirs, files in os.walk(app.config['ASSETS_DIR']):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.abspath(path) == manifestPath:
+                continue
+            if os.path.relpath(path, app.static_folder).replace(os.sep, '/') not in keep:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+@app.url_defaults
+def fingerprintStatic(endpoint, values):
+    # url_for('static', filename='edit.png') -> /static/dist/edit.<hash>.png
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = manifest['files'].get(values['filename'], values['filename'])
+
+
+def acceptsWebp():
+    # only an explicit image/webp counts, not */*
+    return any(value == 'image/webp' and quality for value, quality in request.accept_mimetypes)
+
+
+def pickVariant(filename):
+    # the smallest copy of a hashed file this browser can use
+    variants = manifest['variants'].get(filename, {})
+    if 'webp' in variants and acceptsWebp():
+        return variants['webp'], 'image/webp', None
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in ENCODINGS:
+        if encoding in variants and request.accept_encodings[encoding]:
+            return variants[encoding], mimetype, encoding
+    return filename, mimetype, None
+
+
+def serveStatic(filename):
+    if not filename.startswith(distPrefix()):
+        return app.send_static_file(filename)
+    name, mimetype, encoding = pickVariant(filename)
+    response = send_from_directory(app.static_folder, name, mimetype=mimetype, max_age=ONE_YEAR)
+    response.headers['Cache-Control'] = IMMUTABLE
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if filename in manifest['variants']:
+        response.vary.update(['Accept', 'Accept-Encoding'])
+    return response
+
+
+app.view_functions['static'] = serveStatic
+loadManifest()
@@ -0,0 +1,136 @@
+# Background processing for meditation recordings.
+#
+# Browsers upload whatever their recorder makes (webm, wav, mp4...). After a
+# meditation is saved its recording is handed to a background thread that uses
+# a local ffmpeg to:
+#   - re-encode it as Opus in an OGG file, which is a fraction of the size, and
+#   - decode a low-rate mono copy to measure the duration and build a small array
+#     of waveform peaks for drawing.
+# When that works the new file replaces the original in GridFS and the original is
+# deleted. If ffmpeg isn't installed nothing happens and the original is kept.
+
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app import app
+from app.classes.data import Meditation
+from app.utils.pagecache import invalidate
+from app.utils.workers import processLocal
+
+FFMPEG = shutil.which('ffmpeg')
+OPUS_BITRATE = '32k'
+# the decoded copy used for the waveform: mono 16 bit at 8kHz
+PCM_RATE = 8000
+# one peak for every 0.1 seconds while reading, then squeezed to PEAK_COUNT
+WINDOW = PCM_RATE // 10
+PEAK_COUNT = 200
+# how many windows to read from ffmpeg at a time
+READ_WINDOWS = 100
+
+# each worker process makes its own pool, see app/utils/workers.py
+executor = processLocal(lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix='transcode'))
+
+
+def queueTranscode(meditationId):
+    if not FFMPEG:
+        return None
+    return executor().submit(transcodeMeditation, meditationId)
+
+
+def windowPeaks(samples):
+    # the loudest sample in each WINDOW, for a block of int16 samples
+    samples = np.abs(samples.astype(np.int32))
+    full = len(samples) // WINDOW * WINDOW
+    peaks = samples[:full].reshape(-1, WINDOW).max(axis=1)
+    if full < len(samples):
+        peaks = np.append(peaks, samples[full:].max())
+    return peaks
+
+
+def squeezePeaks(peaks, count=PEAK_COUNT):
+    # combine the per-window peaks into 'count' bars scaled 0 to 1
+    if len(peaks) == 0:
+        return []
+    if len(peaks) > count:
+        edges = np.linspace(0, len(peaks), count + 1).astype(int)[:-1]
+        peaks = np.maximum.reduceat(peaks, edges)
+    return np.round(peaks / 32768.0, 3).tolist()
+
+
+def transcode(sourcePath, oggPath):
+    # Makes the Opus file and streams the decoded audio back at the same time so the
+    # source only has to be decoded once. Returns (duration in seconds, peaks).
+    command = [
+        FFMPEG, '-nostdin', '-v', 'error', '-y', '-i', sourcePath,
+        '-map', '0:a:0', '-c:a', 'libopus', '-b:a', OPUS_BITRATE, '-application', 'voip', oggPath,
+        '-map', '0:a:0', '-ac', '1', '-ar', str(PCM_RATE), '-f', 's16le', 'pipe:1',
+    ]
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+        blocks = []
+        samples = 0
+        while True:
+            data = process.stdout.read(WINDOW * READ_WINDOWS * 2)
+            if not data:
+                break
+            block = np.frombuffer(data[:len(data) // 2 * 2], dtype='<i2')
+            samples += len(block)
+            blocks.append(windowPeaks(block))
+        process.stdout.close()
+        if process.wait() != 0:
+            errors.seek(0)
+            raise RuntimeError(errors.read().decode(errors='replace').strip())
+
+    peaks = np.concatenate(blocks) if blocks else np.array([], dtype=np.int32)
+    return samples / PCM_RATE, squeezePeaks(peaks)
+
+
+def transcodeMeditation(meditationId):
+    meditation = Meditation.objects(id=meditationId).only('meditationfile', 'audio_format').first()
+    if not meditation or not meditation.meditationfile or meditation.audio_format == 'opus':
+        return
+
+    proxy = meditation.meditationfile
+    fs = proxy.fs
+    oldId = proxy.grid_id
+
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            sourcePath = os.path.join(workdir, 'source')
+            oggPath = os.path.join(workdir, 'meditation.ogg')
+
+            # copy the original out of GridFS a chunk at a time
+            original = proxy.get()
+            with open(sourcePath, 'wb') as source:
+                shutil.copyfileobj(original, source, 255 * 1024)
+
+            duration, peaks = transcode(sourcePath, oggPath)
+
+            with open(oggPath, 'rb') as ogg:
+                newId = fs.put(ogg, content_type='audio/ogg', filename=f'{meditationId}.ogg')
+    except Exception:
+        app.logger.exception(f"could not transcode meditation {meditationId}")
+        return
+
+    # Point the meditation at the new file, but only if nobody replaced the
+    # recording while this was running. Then delete whichever file lost.
+    result = Meditation._get_collection().update_one(
+        {'_id': meditation.id, 'meditationfile': oldId},
+        {'$set': {
+            'meditationfile': newId,
+            'audio_format': 'opus',
+            'duration': round(duration, 2),
+            'peaks': peaks,
+        }},
+    )
+    if result.modified_count:
+        fs.delete(oldId)
+        # the list page shows the duration
+        invalidate('meditation')
+    else:
+        fs.delete(newId)
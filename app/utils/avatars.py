@@ -0,0 +1,40 @@
+# Profile pictures are shown small everywhere on the site, so a fixed-size JPEG
+# thumbnail is made once when the picture is uploaded and stored next to it in
+# GridFS. /user/<userID>/avatar serves the thumbnail. Pictures uploaded before
+# thumbnails existed get theirs from
+#
+#     flask users thumbnails
+
+from io import BytesIO
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# the largest size any template shows a profile picture at
+AVATAR_SIZE = (240, 240)
+# what Pillow raises for a file that isn't a picture it can read
+BAD_IMAGE = (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError)
+
+
+def makeThumbnail(stream):
+    image = Image.open(stream)
+    # phones save the rotation separately, apply it before throwing it away
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail(AVATAR_SIZE)
+    image = image.convert('RGB')
+
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=85, optimize=True)
+    buffer.seek(0)
+    return buffer
+
+
+def saveThumbnail(user, thumbnail=None):
+    # (re)build the thumbnail from the full size image that is already stored.
+    # Raises one of BAD_IMAGE before writing anything if it isn't a picture.
+    if thumbnail is None:
+        thumbnail = makeThumbnail(user.image.get())
+    if user.thumbnail:
+        user.thumbnail.replace(thumbnail, content_type='image/jpeg')
+    else:
+        user.thumbnail.put(thumbnail, content_type='image/jpeg')
+    user.save()
@@ -0,0 +1,126 @@
+# Loads a file of clinics into the directory for 'flask clinics import'.
+#
+# The file is read one row at a time (CSV with a header row, or JSON Lines), so a
+# large file never has to fit in memory. A JSON array (.json) works too but is read
+# whole. Every row is checked with the same rules
+# as ClinicForm, and good rows are written with insert_many a batch at a time.
+#
+# Each imported clinic gets an import_key of "file name:row number" with a unique
+# index on it, and the number of rows finished is written to FILE.progress after
+# every batch. If an import stops part way it can be run again with --resume and
+# picks up after the last finished batch; a batch that was written but not yet
+# recorded is skipped by the unique index instead of being added twice. Clinics
+# from such a batch still get geocoded if they haven't been yet.
+
+import csv
+import datetime as dt
+import json
+import os
+
+from pymongo.errors import BulkWriteError
+from werkzeug.datastructures import MultiDict
+
+from app import app
+from app.classes.data import Clinic, User
+from app.classes.forms import ClinicForm
+
+CLINIC_FIELDS = ['name', 'streetAddress', 'city', 'state', 'zipcode', 'description']
+DUPLICATE_KEY = 11000
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'json'}
+
+
+def fileFormat(path, format=None):
+    # raises ValueError for a file name that doesn't say what it is
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError(f"can't tell the format of {os.path.basename(path)} from its name, "
+                         f"use --format ({', '.join(sorted(set(FORMATS.values())))})")
+    return FORMATS[extension]
+
+
+def readRows(stream, format):
+    # yields (row number, dict of strings). Row 1 is the first clinic, not the header.
+    if format == 'csv':
+        for number, row in enumerate(csv.DictReader(stream), 1):
+            yield number, row
+    elif format == 'jsonl':
+        number = 0
+        for line in stream:
+            if line.strip():
+                number += 1
+                yield number, json.loads(line)
+    else:
+        # a plain JSON array has to be read whole
+        yield from enumerate(json.load(stream), 1)
+
+
+def validateRow(row):
+    # Returns (fields, None) or (None, errors) using ClinicForm's validators.
+    # Blank strings count as missing the same way they do on the web form.
+    data = MultiDict({
+        field: str(row.get(field) or '').strip() for field in CLINIC_FIELDS
+    })
+    with app.test_request_context():
+        form = ClinicForm(formdata=data, meta={'csrf': False})
+        if not form.validate():
+            errors = {field: messages for field, messages in form.errors.items() if field != 'submit'}
+            if errors:
+                return None, errors
+    return {field: data[field] for field in CLINIC_FIELDS}, None
+
+
+def progressPath(path):
+    return path + '.progress'
+
+
+def readProgress(path):
+    try:
+        with open(progressPath(path)) as progress:
+            return json.load(progress)['rows']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def writeProgress(path, rows):
+    # write to a temporary file first so a crash can't leave half a progress file
+    temporary = progressPath(path) + '.tmp'
+    with open(temporary, 'w') as progress:
+        json.dump({'rows': rows, 'updated': dt.datetime.utcnow().isoformat()}, progress)
+    os.replace(temporary, progressPath(path))
+
+
+def clearProgress(path):
+    try:
+        os.remove(progressPath(path))
+    except FileNotFoundError:
+        pass
+
+
+def insertBatch(batch, author=None):
+    # batch is a list of (import key, fields). Returns (number added, clinics in the
+    # batch that have no location yet). The second includes rows an earlier run
+    # added but stopped before geocoding.
+    now = dt.datetime.utcnow()
+    docs = []
+    for key, fields in batch:
+        clinic = Clinic(import_key=key, author=author, createdate=now, modifydate=now, **fields)
+        clinic.validate()
+        docs.append(clinic.to_mongo().to_dict())
+
+    try:
+        added = len(Clinic._get_collection().insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as error:
+        if any(problem['code'] != DUPLICATE_KEY for problem in error.details['writeErrors']):
+            raise
+        added = error.details['nInserted']
+
+    keys = [key for key, fields in batch]
+    return added, list(Clinic.objects(import_key__in=keys, location=None).only(*CLINIC_FIELDS))
+
+
+def findAuthor(email):
+    if not email:
+        return None
+    return User.objects.get(email=email).id
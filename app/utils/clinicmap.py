@@ -0,0 +1,96 @@
+# Builds the GeoJSON that the clinic map loads as you move around it.
+#
+# Only clinics inside the part of the map on screen (the bounding box) are
+# returned, using the 2dsphere index on Clinic.location. When zoomed out, nearby
+# clinics are grouped into one "cluster" point by MongoDB so the browser gets a
+# handful of points instead of every clinic in the city.
+
+from app.classes.data import Clinic
+
+# at this zoom level and closer every clinic is sent on its own
+CLUSTER_MAX_ZOOM = 13
+# roughly how many cluster cells fit across one 256px map tile
+CELLS_PER_TILE = 4
+# the most single clinics sent for one view
+MAX_FEATURES = 1000
+
+POPUP_FIELDS = ['name', 'streetAddress', 'city', 'state', 'zipcode', 'description']
+
+
+def parseBbox(value):
+    # "minLon,minLat,maxLon,maxLat" the way Leaflet's map.getBounds().toBBoxString() writes it
+    minLon, minLat, maxLon, maxLat = [float(part) for part in value.split(',')]
+    minLon, maxLon = max(minLon, -180.0), min(maxLon, 180.0)
+    minLat, maxLat = max(minLat, -85.0), min(maxLat, 85.0)
+    if minLon >= maxLon or minLat >= maxLat:
+        raise ValueError("bbox is empty")
+    return minLon, minLat, maxLon, maxLat
+
+
+def bboxMatch(bbox):
+    minLon, minLat, maxLon, maxLat = bbox
+    # A polygon that covers half the world or more can't be used with a 2dsphere
+    # query, and at that size every clinic is on screen anyway.
+    if maxLon - minLon >= 180:
+        return {'location': {'$exists': True}}
+    ring = [[minLon, minLat], [maxLon, minLat], [maxLon, maxLat], [minLon, maxLat], [minLon, minLat]]
+    return {'location': {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}}}
+
+
+def clinicFeature(clinicId, coordinates, properties):
+    properties = dict(properties, id=str(clinicId))
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': coordinates},
+        'properties': properties,
+    }
+
+
+def singleFeatures(bbox):
+    projection = dict.fromkeys(POPUP_FIELDS + ['location'], 1)
+    docs = Clinic._get_collection().find(bboxMatch(bbox), projection).limit(MAX_FEATURES)
+    return [
+        clinicFeature(doc['_id'], doc['location']['coordinates'],
+                      {field: doc.get(field) for field in POPUP_FIELDS})
+        for doc in docs
+    ]
+
+
+def clusterFeatures(bbox, zoom):
+    cell = 360.0 / (2 ** zoom) / CELLS_PER_TILE
+    lon = {'$arrayElemAt': ['$location.coordinates', 0]}
+    lat = {'$arrayElemAt': ['$location.coordinates', 1]}
+    pipeline = [
+        {'$match': bboxMatch(bbox)},
+        {'$group': {
+            '_id': {'x': {'$floor': {'$divide': [lon, cell]}}, 'y': {'$floor': {'$divide': [lat, cell]}}},
+            'count': {'$sum': 1},
+            'lon': {'$avg': lon},
+            'lat': {'$avg': lat},
+            # kept so a cell with a single clinic can be sent as that clinic
+            'clinicId': {'$first': '$_id'},
+            'location': {'$first': '$location.coordinates'},
+            **{field: {'$first': f'${field}'} for field in POPUP_FIELDS},
+        }},
+    ]
+
+    features = []
+    for row in Clinic.objects.aggregate(pipeline):
+        if row['count'] == 1:
+            features.append(clinicFeature(row['clinicId'], row['location'],
+                                          {field: row.get(field) for field in POPUP_FIELDS}))
+        else:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [row['lon'], row['lat']]},
+                'properties': {'cluster': True, 'count': row['count']},
+            })
+    return features
+
+
+def clinicGeoJson(bbox, zoom):
+    if zoom < CLUSTER_MAX_ZOOM:
+        features = clusterFeatures(bbox, zoom)
+    else:
+        features = singleFeatures(bbox)
+    return {'type': 'FeatureCollection', 'features': features}
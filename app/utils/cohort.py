@@ -0,0 +1,102 @@
+# The numbers behind the teacher dashboard.
+#
+# One aggregation on the Sleep collection groups every night by student, joins
+# each student's User with $lookup to keep only students who have consented, and
+# writes the result over the CohortSleep collection with $out. The dashboard then
+# just reads that small collection, one row per student, instead of going
+# through everyone's sleeps while the teacher waits.
+#
+# Run it nightly, for example from cron:
+#
+#     0 3 * * *  cd /path/to/app && FLASK_APP=main.py flask cohort build
+
+import datetime as dt
+
+from app.classes.data import Sleep, User, CohortSleep, CONSENTING_STUDENTS, consentingStudents
+
+RECENT_DAYS = 7
+
+
+def _hours():
+    # hours from start and end; anything that isn't between 0 and 24 is left out
+    hours = {'$divide': [{'$subtract': ['$end', '$start']}, 60 * 60 * 1000]}
+    return {'$cond': [{'$and': [{'$gt': [hours, 0]}, {'$lte': [hours, 24]}]}, hours, None]}
+
+
+def _round(expression, places=2):
+    return {'$round': [expression, places]}
+
+
+def cohortPipeline(now=None):
+    now = now or dt.datetime.utcnow()
+    recent = {'$gte': ['$start', now - dt.timedelta(days=RECENT_DAYS)]}
+    return [
+        {'$match': {'start': {'$ne': None}}},
+        # group first so the $lookup below runs once per student, not once per night
+        {'$group': {
+            '_id': '$sleeper',
+            'nights': {'$sum': 1},
+            'mean_hours': {'$avg': _hours()},
+            'mean_rating': {'$avg': '$rating'},
+            'mean_feel': {'$avg': '$feel'},
+            'mean_minstosleep': {'$avg': '$minstosleep'},
+            'recent_nights': {'$sum': {'$cond': [recent, 1, 0]}},
+            'recent_hours': {'$avg': {'$cond': [recent, _hours(), None]}},
+            'last_sleep': {'$max': '$start'},
+        }},
+        {'$lookup': {
+            'from': User._get_collection_name(),
+            'let': {'sleeper': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$eq': ['$_id', '$$sleeper']}, **CONSENTING_STUDENTS}},
+                {'$project': {'fname': 1, 'lname': 1, 'email': 1}},
+            ],
+            'as': 'student',
+        }},
+        # students without consent have nothing to join, so $unwind drops them
+        {'$unwind': '$student'},
+        {'$project': {
+            'fname': '$student.fname',
+            'lname': '$student.lname',
+            'email': '$student.email',
+            'nights': 1,
+            'mean_hours': _round('$mean_hours'),
+            'mean_rating': _round('$mean_rating'),
+            'mean_feel': _round('$mean_feel'),
+            'mean_minstosleep': _round('$mean_minstosleep', 1),
+            'recent_nights': 1,
+            'recent_hours': _round('$recent_hours'),
+            'last_sleep': 1,
+            'build_date': {'$literal': now},
+        }},
+        # replaces the collection in one step, so readers never see half a build
+        {'$out': CohortSleep._get_collection_name()},
+    ]
+
+
+def buildCohort():
+    # returns how many students made it into the cohort
+    Sleep._get_collection().aggregate(cohortPipeline(), allowDiskUse=True)
+    return CohortSleep.objects.count()
+
+
+def _weighted(rows, field, weight):
+    pairs = [(row[field], row[weight]) for row in rows if row[field] is not None and row[weight]]
+    total = sum(count for value, count in pairs)
+    return round(sum(value * count for value, count in pairs) / total, 2) if total else None
+
+
+def cohortDashboard():
+    # The rows from the last build, minus anyone who has taken back their consent
+    # since then, and totals for the whole cohort.
+    rows = list(CohortSleep._get_collection().find().sort([('lname', 1), ('fname', 1)]))
+    consenting = set(consentingStudents().filter(id__in=[row['_id'] for row in rows]).distinct('id'))
+    rows = [row for row in rows if row['_id'] in consenting]
+    return {
+        'students': rows,
+        'buildDate': rows[0]['build_date'] if rows else None,
+        'nights': sum(row['nights'] for row in rows),
+        'meanHours': _weighted(rows, 'mean_hours', 'nights'),
+        'meanRating': _weighted(rows, 'mean_rating', 'nights'),
+        'recentHours': _weighted(rows, 'recent_hours', 'recent_nights'),
+    }
@@ -0,0 +1,322 @@
+# Command line tools for looking after the app. They run through the flask command:
+#
+#     flask explain
+#     flask clinics backfill-locations
+#     flask clinics import FILE
+#     flask sleeps rebuild-summaries
+#     flask meditations orphans
+#     flask cohort build
+#     flask assets build
+#     flask users thumbnails
+#
+# (set FLASK_APP=main.py first)
+
+import datetime as dt
+import os
+import sys
+import time
+
+import click
+from flask.cli import AppGroup
+from pymongo import UpdateOne
+
+from app import app
+from app.classes.data import User, Sleep, Emoji, Meditation, Clinic, SleepSummary, CohortSleep, visibleOwners
+from app.utils.sleepstats import sleepStatsPipeline
+from app.utils.pagination import seekQuery
+from app.utils.clinicmap import bboxMatch
+from app.utils.clinicimport import (
+    fileFormat, readRows, validateRow, readProgress, writeProgress, clearProgress,
+    insertBatch, findAuthor,
+)
+from app.utils.geocode import geocodeMany, pendingJobs, worker
+from app.utils.sleepsummary import rebuildSummary
+from app.utils.sleepanalytics import columnsCursor, userMatch
+from app.utils.cohort import buildCohort
+from app.utils.emojitimeline import timelinePipeline
+from app.utils.assets import buildAssets
+from app.utils.pagecache import invalidate
+from app.utils.avatars import saveThumbnail, BAD_IMAGE
+
+
+def winningPlans(explain):
+    # the winning plan can be nested in different places depending on the server
+    # version and whether it was a find or an aggregate, so just look everywhere
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                yield value
+            else:
+                yield from winningPlans(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from winningPlans(value)
+
+
+def planStages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from planStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from planStages(value)
+
+
+def explainAggregate(document, pipeline):
+    collection = document._get_collection()
+    return collection.database.command(
+        'explain',
+        {'aggregate': collection.name, 'pipeline': pipeline, 'cursor': {}},
+        verbosity='queryPlanner',
+    )
+
+
+def explainPage(queryset, sortField):
+    # the first page of a list, built exactly the way paginate() builds it
+    size = app.config['PAGE_SIZE']
+    return seekQuery(queryset, sortField).limit(size + 1).explain()
+
+
+# One entry per route that queries a collection. Keep this in step with the routes
+# so that a new query without an index shows up here.
+def routeQueries(user):
+    return [
+        ('/sleeps', lambda: explainPage(Sleep.objects.for_user(user), 'start')),
+        ('/sleepgraph.png', lambda: explainAggregate(Sleep, sleepStatsPipeline(user.id))),
+        ('/sleep/stats', lambda: explainAggregate(Sleep, sleepStatsPipeline(user.id, bucket='week'))),
+        ('/sleep/analytics', lambda: columnsCursor(userMatch(user.id)).explain()),
+        ('/teacher/dashboard', lambda: CohortSleep._get_collection().find()
+            .sort([('lname', 1), ('fname', 1)]).explain()),
+        ('/emojis', lambda: explainPage(Emoji.objects.for_user(user), 'create_date')),
+        ('/emoji/timeline', lambda: explainAggregate(Emoji, timelinePipeline(
+            visibleOwners(user), dt.datetime.utcnow() - dt.timedelta(days=365)))),
+        ('/meditations', lambda: explainPage(Meditation.objects.for_user(user), 'create_date')),
+        ('/clinic/list', lambda: explainPage(Clinic.objects(), 'createdate')),
+        ('/clinic/geojson', lambda: Clinic._get_collection().find(
+            bboxMatch((-122.3, 37.8, -122.2, 37.9))).explain()),
+        ('/clinic/nearest', lambda: explainAggregate(Clinic, [
+            {'$geoNear': {'near': {'type': 'Point', 'coordinates': [-122.2576, 37.8323]},
+                          'key': 'location', 'distanceField': 'distance', 'spherical': True}},
+            {'$limit': 5},
+        ])),
+    ]
+
+
+@app.cli.command('explain')
+@click.option('--email', help="Explain the queries as this user. Defaults to the first user.")
+def explainCommand(email):
+    """Show the query plan for every route's query and flag any COLLSCAN."""
+    if email:
+        user = User.objects(email=email).first()
+    else:
+        user = User.objects.first()
+    if not user:
+        click.echo("No users in the database to run the queries as.")
+        sys.exit(1)
+
+    collscans = 0
+    for route, explain in routeQueries(user):
+        stages = []
+        for plan in winningPlans(explain()):
+            stages.extend(planStages(plan))
+        if 'COLLSCAN' in stages:
+            collscans += 1
+            status = 'COLLSCAN'
+        else:
+            status = 'ok'
+        click.echo(f"{route:<20} {status:<9} {' <- '.join(stages)}")
+
+    if collscans:
+        click.echo(f"{collscans} route(s) scan a whole collection.")
+        sys.exit(1)
+
+
+clinics = AppGroup('clinics', help="Tools for the clinic directory.")
+app.cli.add_command(clinics)
+
+
+@clinics.command('backfill-locations')
+@click.option('--batch-size', default=500, show_default=True)
+def backfillLocations(batch_size):
+    """Fill in Clinic.location for clinics that only have lat/lon."""
+    collection = Clinic._get_collection()
+    missing = collection.find(
+        {'lat': {'$ne': None}, 'lon': {'$ne': None}, 'location': {'$exists': False}},
+        {'lat': 1, 'lon': 1},
+    )
+    updates = []
+    done = 0
+    for doc in missing:
+        point = {'type': 'Point', 'coordinates': [doc['lon'], doc['lat']]}
+        updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'location': point}}))
+        if len(updates) == batch_size:
+            collection.bulk_write(updates, ordered=False)
+            done += len(updates)
+            updates = []
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+        done += len(updates)
+    click.echo(f"Added a location to {done} clinic(s).")
+
+
+@clinics.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(['csv', 'jsonl', 'json']),
+              help="Defaults to csv for .csv, JSON Lines for .jsonl and .ndjson and a JSON array for .json files.")
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--author', help="Email of the user the clinics belong to.")
+@click.option('--resume', is_flag=True, help="Carry on after the last finished batch of an earlier run.")
+@click.option('--wait', is_flag=True, help="Geocode the new clinics here and wait for them to finish.")
+def importClinics(path, format, batch_size, author, resume, wait):
+    """Add the clinics in a CSV or JSON file to the directory."""
+    try:
+        format = fileFormat(path, format)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    author = findAuthor(author)
+    name = os.path.basename(path)
+    skip = readProgress(path) if resume else 0
+    if skip:
+        click.echo(f"Resuming after row {skip}.")
+
+    added = rejected = cached = queued = 0
+    newIds = []
+    batch = []
+    done = skip
+
+    def flush():
+        nonlocal added, cached, queued, batch
+        new, clinics = insertBatch(batch, author) if batch else (0, [])
+        hits, jobs = geocodeMany(clinics) if clinics else (0, 0)
+        added += new
+        cached += hits
+        queued += jobs
+        newIds.extend(clinic.id for clinic in clinics)
+        batch = []
+        writeProgress(path, done)
+        click.echo(f"row {done}: {added} added, {rejected} rejected, "
+                   f"{cached} located from the cache, {queued} waiting to be geocoded")
+
+    with open(path, newline='', encoding='utf-8-sig') as stream:
+        for number, row in readRows(stream, format):
+            if number <= skip:
+                continue
+            fields, errors = validateRow(row)
+            if errors:
+                rejected += 1
+                problems = '; '.join(f"{field}: {', '.join(messages)}" for field, messages in errors.items())
+                click.echo(f"row {number} skipped: {problems}", err=True)
+            else:
+                batch.append((f'{name}:{number}', fields))
+            done = number
+            if len(batch) == batch_size:
+                flush()
+    flush()
+    clearProgress(path)
+    click.echo(f"Finished {name}: {added} clinic(s) added, {rejected} row(s) rejected.")
+
+    # includes jobs an earlier, interrupted run left waiting
+    waiting = pendingJobs(newIds) if newIds else 0
+    if waiting and wait:
+        # the same worker the web app runs, so the shared rate limit still applies
+        worker.start()
+        worker.notify()
+        with click.progressbar(length=waiting, label="Geocoding") as bar:
+            left = waiting
+            while left:
+                time.sleep(2)
+                now = pendingJobs(newIds)
+                bar.update(left - now)
+                left = now
+        worker.stop()
+    elif waiting:
+        click.echo(f"{waiting} clinic(s) will be geocoded in the background by the web app.")
+
+
+sleeps = AppGroup('sleeps', help="Tools for sleep data.")
+app.cli.add_command(sleeps)
+
+
+@sleeps.command('rebuild-summaries')
+@click.option('--email', help="Only rebuild this user's summary.")
+def rebuildSummaries(email):
+    """Work out every SleepSummary again from the Sleep collection."""
+    if email:
+        sleeperIds = [User.objects.get(email=email).id]
+    else:
+        # everyone with sleeps, plus anyone with a summary left over from deleted sleeps
+        sleeperIds = set(Sleep._get_collection().distinct('sleeper'))
+        sleeperIds.update(SleepSummary._get_collection().distinct('sleeper'))
+    rebuilt = removed = 0
+    for sleeperId in sleeperIds:
+        if sleeperId is None:
+            continue
+        if rebuildSummary(sleeperId):
+            rebuilt += 1
+        else:
+            removed += 1
+    click.echo(f"Rebuilt {rebuilt} summary(ies), removed {removed}.")
+
+
+meditations = AppGroup('meditations', help="Tools for meditations.")
+app.cli.add_command(meditations)
+
+
+@meditations.command('orphans')
+@click.option('--author', help="Email of the user to give them to.")
+def meditationOrphans(author):
+    """Find meditations saved without an author. Nobody can see those until they have one."""
+    orphans = Meditation.objects(author=None)
+    count = orphans.count()
+    click.echo(f"{count} meditation(s) have no author.")
+    if count and author:
+        owner = User.objects.get(email=author)
+        updated = orphans.update(set__author=owner)
+        click.echo(f"Gave {updated} meditation(s) to {owner.email}.")
+        invalidate('meditation')
+
+
+cohort = AppGroup('cohort', help="The teacher dashboard.")
+app.cli.add_command(cohort)
+
+
+@cohort.command('build')
+def cohortBuild():
+    """Work out the teacher dashboard numbers again. Run this nightly."""
+    students = buildCohort()
+    click.echo(f"The cohort has {students} consenting student(s).")
+
+
+assets = AppGroup('assets', help="Static files.")
+app.cli.add_command(assets)
+
+
+@assets.command('build')
+@click.option('--clean', is_flag=True, help="Delete hashed files that are no longer in the manifest.")
+def assetsBuild(clean):
+    """Make the fingerprinted, compressed and WebP copies of app/static. Run this on every deploy."""
+    built, removed = buildAssets(clean=clean)
+    click.echo(f"{len(built['files'])} file(s) in the manifest, {len(built['variants'])} with smaller copies.")
+    if removed:
+        click.echo(f"Removed {removed} old file(s).")
+
+
+users = AppGroup('users', help="Tools for user accounts.")
+app.cli.add_command(users)
+
+
+@users.command('thumbnails')
+def userThumbnails():
+    """Make the small profile pictures for users who uploaded one before thumbnails existed."""
+    made = failed = 0
+    for user in User.objects(__raw__={'image': {'$ne': None}, 'thumbnail': None}).only('email', 'image', 'thumbnail'):
+        try:
+            saveThumbnail(user)
+        except BAD_IMAGE as error:
+            failed += 1
+            click.echo(f"{user.email}: the picture couldn't be read ({error})", err=True)
+            continue
+        made += 1
+    click.echo(f"Made {made} thumbnail(s), {failed} picture(s) couldn't be read.")
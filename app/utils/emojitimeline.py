@@ -0,0 +1,115 @@
+# Emoji moods over the week: how many check-ins there were at each hour of each
+# day of the week, and which emojis they were.
+#
+# One aggregation on Emoji.create_date does the counting. The match uses the
+# (author, -create_date) index and $hour / $dayOfWeek turn the stored UTC time into
+# local time with EMOJI_TIMEZONE, so only 7 x 24 x (emojis used) small rows come
+# back however many check-ins there are. The heatmap PNG drawn from those rows is
+# cached for a few minutes.
+
+import datetime as dt
+
+from app import app
+from app.classes.data import Emoji, visibleOwners
+from app.utils.cache import LRUCache
+from app.utils.plotting import newFigure, pngBytes
+from app.utils.pagecache import visibilityGeneration
+
+app.config.setdefault('EMOJI_TIMEZONE', 'America/Los_Angeles')
+
+DEFAULT_DAYS = 365
+MAX_DAYS = 3 * 365
+TIMELINE_TTL = 5 * 60
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+timelineCache = LRUCache(maxsize=256, ttl=TIMELINE_TTL)
+
+
+def invalidateEmojiTimeline(userId):
+    userId = str(userId)
+    timelineCache.popWhere(lambda key: key[1] == userId)
+
+
+def timelinePipeline(owners, since):
+    local = {'date': '$create_date', 'timezone': app.config['EMOJI_TIMEZONE']}
+    if len(owners) == 1:
+        match = {'author': owners[0]}
+    else:
+        match = {'author': {'$in': owners}}
+    match['create_date'] = {'$gte': since}
+    return [
+        {'$match': match},
+        {'$group': {
+            # $isoDayOfWeek is 1 for Monday through 7 for Sunday
+            '_id': {
+                'day': {'$isoDayOfWeek': local},
+                'hour': {'$hour': local},
+                'emote': '$emote',
+            },
+            'count': {'$sum': 1},
+        }},
+    ]
+
+
+def emojiTimeline(viewer, days=DEFAULT_DAYS):
+    # Returns counts[day][hour] (Monday first) and for every cell that has any
+    # check-ins the number of each emoji, most used first.
+    days = max(1, min(days, MAX_DAYS))
+    key = ('json', str(viewer.id), days, visibilityGeneration())
+    timeline = timelineCache.get(key)
+    if timeline is not None:
+        return timeline
+
+    since = dt.datetime.utcnow() - dt.timedelta(days=days)
+    owners = visibleOwners(viewer)
+    counts = [[0] * 24 for day in WEEKDAYS]
+    emotes = {}
+    for row in Emoji.objects.aggregate(timelinePipeline(owners, since)):
+        day, hour = row['_id']['day'] - 1, row['_id']['hour']
+        counts[day][hour] += row['count']
+        emotes.setdefault((day, hour), {})[row['_id']['emote']] = row['count']
+
+    cells = [
+        {
+            'day': WEEKDAYS[day],
+            'hour': hour,
+            'count': counts[day][hour],
+            'emotes': sorted(emotes[(day, hour)].items(), key=lambda item: -item[1]),
+        }
+        for day, hour in sorted(emotes)
+    ]
+    timeline = {
+        'timezone': app.config['EMOJI_TIMEZONE'],
+        'days': days,
+        'since': since.isoformat(),
+        'total': sum(map(sum, counts)),
+        'weekdays': WEEKDAYS,
+        'counts': counts,
+        'cells': cells,
+    }
+    timelineCache.set(key, timeline)
+    return timeline
+
+
+def renderHeatmap(timeline):
+    fig = newFigure((10, 3.5))
+    ax = fig.subplots()
+    image = ax.imshow(timeline['counts'], aspect='auto', cmap='YlOrRd', interpolation='nearest')
+    ax.set_yticks(range(7))
+    ax.set_yticklabels(timeline['weekdays'])
+    ax.set_xticks(range(0, 24, 2))
+    ax.set_xticklabels([f'{hour}:00' for hour in range(0, 24, 2)])
+    ax.set_title(f"Check-ins by hour ({timeline['timezone']}, last {timeline['days']} days)")
+    fig.colorbar(image, ax=ax, label='check-ins')
+
+    return pngBytes(fig)
+
+
+def emojiHeatmapPng(viewer, days=DEFAULT_DAYS):
+    days = max(1, min(days, MAX_DAYS))
+    key = ('png', str(viewer.id), days, visibilityGeneration())
+    png = timelineCache.get(key)
+    if png is None:
+        png = renderHeatmap(emojiTimeline(viewer, days))
+        timelineCache.set(key, png)
+    return png
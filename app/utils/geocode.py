@@ -0,0 +1,396 @@
+# Looks up clinic addresses (lat/lon) in the background.
+#
+# Creating or editing a clinic only adds a GeocodeJob to MongoDB and returns. A
+# dispatcher thread in each worker process claims jobs that are due and hands them
+# to a small thread pool. Each lookup:
+#   - waits its turn at a RateGate shared by all processes (Nominatim allows one
+#     request a second),
+#   - has a timeout, so a slow maps site can't hang anything, and
+#   - on failure is tried again later, waiting twice as long each time, until
+#     MAX_ATTEMPTS is reached.
+# Because the jobs live in MongoDB, anything left over when the app stops is
+# picked up again the next time it starts.
+#
+# Answers are kept in GeocodeCache, keyed by a normalized address, with an
+# in-process LRU in front of it. An address that has been looked up before (even
+# one that wasn't found) never goes to Nominatim again until its entry expires.
+#
+# Tests can swap the real lookup for StubGeocoder with setGeocoder().
+
+import datetime as dt
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Semaphore, Thread
+
+import requests
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app import app
+from app.classes.data import Clinic, GeocodeJob, GeocodeCache, RateGate
+from app.utils.cache import LRUCache
+from app.utils.pagecache import invalidate
+from app.utils.secrets import getSecrets
+from app.utils.workers import processLocal
+
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+# seconds to wait for (connecting, reading) a response
+NOMINATIM_TIMEOUT = (3.05, 10)
+# Nominatim's usage policy: no more than one request per second
+NOMINATIM_INTERVAL = 1.0
+
+MAX_ATTEMPTS = 5
+# the first retry waits this many seconds, then it doubles
+RETRY_DELAY = 30
+# how long a claimed job belongs to one worker before someone else may take it
+LEASE = dt.timedelta(minutes=2)
+# how often the dispatcher looks for due jobs when it hasn't been woken up
+POLL_INTERVAL = 15
+WORKER_THREADS = 2
+
+# how long answers are remembered. Addresses that weren't found are tried again
+# sooner in case the maps data gets better.
+FOUND_TTL = dt.timedelta(days=180)
+NOT_FOUND_TTL = dt.timedelta(days=7)
+# the in-process copy is only kept briefly so expiry in MongoDB is respected
+LOCAL_CACHE_SIZE = 2048
+LOCAL_CACHE_TTL = 10 * 60
+
+
+class GeocodeError(Exception):
+    # a lookup that failed in a way that is worth trying again
+    pass
+
+
+class NominatimGeocoder:
+    def __init__(self, email, session=None):
+        self.email = email
+        self.session = session or requests.Session()
+        self.session.headers['User-Agent'] = f'clinic-locator ({email})'
+
+    def geocode(self, street, city, state, zipcode):
+        # returns (lat, lon), or None when the address can't be found
+        params = {
+            'street': street,
+            'city': city,
+            'state': state,
+            'postalcode': zipcode,
+            'format': 'json',
+            'addressdetails': 1,
+            'email': self.email,
+        }
+        try:
+            r = self.session.get(NOMINATIM_URL, params=params, timeout=NOMINATIM_TIMEOUT)
+            r.raise_for_status()
+            results = r.json()
+        except (requests.RequestException, ValueError) as error:
+            raise GeocodeError(str(error)) from error
+        if not results:
+            return None
+        return float(results[0]['lat']), float(results[0]['lon'])
+
+
+class StubGeocoder:
+    # Answers from a dict instead of the internet. Keys are (street, city, state,
+    # zipcode). Anything not in the dict is "not found".
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.calls = []
+
+    def geocode(self, street, city, state, zipcode):
+        address = (street, city, state, zipcode)
+        self.calls.append(address)
+        return self.results.get(address)
+
+
+class SharedRateLimiter:
+    # Blocks until this process may make the next request. The "next request
+    # allowed at" time is one document in MongoDB, moved forward atomically, so
+    # every worker process shares it.
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = dt.timedelta(seconds=interval)
+
+    def wait(self):
+        collection = RateGate._get_collection()
+        while True:
+            now = dt.datetime.utcnow()
+            try:
+                # this only matches (or creates) the gate if it is open right now
+                collection.find_one_and_update(
+                    {'_id': self.name, 'next_allowed': {'$lte': now}},
+                    {'$set': {'next_allowed': now + self.interval}},
+                    upsert=True,
+                )
+                return
+            except DuplicateKeyError:
+                # the gate exists and isn't open yet
+                gate = collection.find_one({'_id': self.name}) or {}
+                nextAllowed = gate.get('next_allowed', now)
+                time.sleep(min(max((nextAllowed - now).total_seconds(), 0.05), self.interval.total_seconds()))
+
+
+_geocoder = None
+nominatimGate = SharedRateLimiter('nominatim', NOMINATIM_INTERVAL)
+
+
+def setGeocoder(geocoder):
+    global _geocoder
+    _geocoder = geocoder
+
+
+def geocoder():
+    global _geocoder
+    if _geocoder is None:
+        _geocoder = NominatimGeocoder(getSecrets()['MY_EMAIL_ADDRESS'])
+    return _geocoder
+
+
+def lookup(clinic):
+    # the real geocoder has to wait its turn, the stub doesn't
+    if isinstance(geocoder(), NominatimGeocoder):
+        nominatimGate.wait()
+    return geocoder().geocode(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode)
+
+
+# what the caches hold for an address that was looked up and not found
+NOT_FOUND = 'not found'
+localCache = LRUCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+
+# shorter spellings so "123 Main Street" and "123 main st." are the same address
+ABBREVIATIONS = {
+    'street': 'st', 'avenue': 'ave', 'boulevard': 'blvd', 'road': 'rd', 'drive': 'dr',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'suite': 'ste', 'north': 'n',
+    'south': 's', 'east': 'e', 'west': 'w', 'california': 'ca',
+}
+
+
+def _normalizePart(value):
+    words = re.sub(r'[^a-z0-9#]+', ' ', (value or '').lower()).split()
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def addressKey(street, city, state, zipcode):
+    zipcode = re.sub(r'[^0-9]', '', zipcode or '')[:5]
+    return '|'.join([_normalizePart(street), _normalizePart(city), _normalizePart(state), zipcode])
+
+
+def clinicKey(clinic):
+    return addressKey(clinic.streetAddress, clinic.city, clinic.state, clinic.zipcode)
+
+
+def cachedGeocode(key):
+    # Returns (lat, lon), NOT_FOUND, or None when the address isn't in either cache
+    answer = localCache.get(key)
+    if answer is not None:
+        return answer
+    entry = GeocodeCache.objects(key=key, expires__gt=dt.datetime.utcnow()).first()
+    if entry is None:
+        return None
+    answer = (entry.lat, entry.lon) if entry.found else NOT_FOUND
+    localCache.set(key, answer)
+    return answer
+
+
+def storeGeocode(key, latLon):
+    now = dt.datetime.utcnow()
+    if latLon:
+        GeocodeCache.objects(key=key).update_one(
+            upsert=True, set__found=True, set__lat=latLon[0], set__lon=latLon[1],
+            set__create_date=now, set__expires=now + FOUND_TTL)
+    else:
+        GeocodeCache.objects(key=key).update_one(
+            upsert=True, set__found=False, unset__lat=True, unset__lon=True,
+            set__create_date=now, set__expires=now + NOT_FOUND_TTL)
+    localCache.set(key, latLon or NOT_FOUND)
+
+
+def saveLatLon(clinic, latLon):
+    lat, lon = latLon
+    Clinic.objects(id=clinic.id).update_one(set__lat=lat, set__lon=lon, set__location=[lon, lat])
+    # also makes every worker rebuild its nearest-clinic tree, see nearest.py
+    invalidate('clinic')
+
+
+def runJob(job):
+    clinic = Clinic.objects(id=job.clinic.id).first() if job.clinic else None
+    now = dt.datetime.utcnow()
+    if clinic is None:
+        job.update(set__status='done', set__last_error='clinic was deleted', set__modify_date=now)
+        return
+
+    # another job may have looked up the same address while this one waited
+    key = clinicKey(clinic)
+    answer = cachedGeocode(key)
+    if answer is not None:
+        if answer != NOT_FOUND:
+            saveLatLon(clinic, answer)
+        job.update(set__status='done', set__modify_date=now)
+        return
+
+    try:
+        latLon = lookup(clinic)
+    except GeocodeError as error:
+        attempts = job.attempts + 1
+        if attempts >= MAX_ATTEMPTS:
+            job.update(set__status='failed', set__attempts=attempts, set__last_error=str(error),
+                       set__modify_date=now)
+        else:
+            retryAt = now + dt.timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+            job.update(set__status='pending', set__attempts=attempts, set__next_run=retryAt,
+                       set__last_error=str(error), set__modify_date=now)
+        return
+
+    storeGeocode(key, latLon)
+    if latLon:
+        saveLatLon(clinic, latLon)
+        job.update(set__status='done', set__attempts=job.attempts + 1, set__modify_date=now)
+    else:
+        job.update(set__status='done', set__attempts=job.attempts + 1,
+                   set__last_error='address not found', set__modify_date=now)
+
+
+def claimJob():
+    # atomically take one job that is due, or one whose worker has gone away
+    now = dt.datetime.utcnow()
+    due = GeocodeJob.objects(status='pending', next_run__lte=now)
+    job = due.order_by('next_run').modify(
+        set__status='running', set__lease_until=now + LEASE, set__modify_date=now, new=True)
+    if job is None:
+        stale = GeocodeJob.objects(status='running', lease_until__lt=now)
+        job = stale.modify(set__lease_until=now + LEASE, set__modify_date=now, new=True)
+    return job
+
+
+def releaseJob(job):
+    # hand a claimed job back so the next worker can take it straight away
+    GeocodeJob.objects(id=job.id, status='running').update_one(
+        set__status='pending', unset__lease_until=True, set__modify_date=dt.datetime.utcnow())
+
+
+class GeocodeWorker:
+    def __init__(self, threads=WORKER_THREADS):
+        self.threads = threads
+        self.wake = Event()
+        self.stopping = Event()
+        self.lock = Lock()
+        self.pool = None
+        self.slots = None
+        # one dispatcher per process. Threads don't survive a fork so a new worker
+        # process starts its own, see app/utils/workers.py
+        self.start = processLocal(self.startDispatcher)
+
+    def startDispatcher(self):
+        with self.lock:
+            self.stopping.clear()
+            self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='geocode')
+            # never claim more jobs than there are threads to run them
+            self.slots = Semaphore(self.threads)
+            Thread(target=self.dispatch, name='geocode-dispatcher', daemon=True).start()
+
+    def notify(self):
+        self.wake.set()
+
+    def stop(self, wait=True):
+        # under the lock so the dispatcher can't hand a job to a pool that is shut down
+        with self.lock:
+            self.stopping.set()
+            self.wake.set()
+            pool = self.pool
+        if pool:
+            pool.shutdown(wait=wait)
+
+    def dispatch(self):
+        while not self.stopping.is_set():
+            self.slots.acquire()
+            try:
+                job = claimJob()
+            except Exception:
+                app.logger.exception("could not claim a geocode job")
+                job = None
+            if job is None:
+                self.slots.release()
+                self.wake.wait(POLL_INTERVAL)
+                self.wake.clear()
+                continue
+            with self.lock:
+                # stop() may have been called while claimJob() was waiting on MongoDB
+                if not self.stopping.is_set():
+                    self.pool.submit(self.run, job)
+                    continue
+            self.slots.release()
+            try:
+                releaseJob(job)
+            except Exception:
+                app.logger.exception(f"could not hand back geocode job {job.id}")
+
+    def run(self, job):
+        try:
+            runJob(job)
+        except Exception:
+            app.logger.exception(f"geocode job {job.id} crashed")
+        finally:
+            self.slots.release()
+
+
+worker = GeocodeWorker()
+
+
+def enqueueGeocode(clinic):
+    # Only one waiting job per clinic. Editing a clinic twice quickly just makes its
+    # waiting job due now; the job reads the address when it runs.
+    now = dt.datetime.utcnow()
+    GeocodeJob.objects(clinic=clinic.id, status='pending').update_one(
+        upsert=True,
+        set__next_run=now,
+        set__modify_date=now,
+        set_on_insert__attempts=0,
+        set_on_insert__create_date=now,
+    )
+    worker.start()
+    worker.notify()
+
+
+def geocodeMany(clinics):
+    # The batch version of updateLatLon for imports. Addresses already in the
+    # geocode cache are filled in with one bulk write, the rest become jobs with one
+    # insert. Clinics that already have a job waiting don't get another. Returns
+    # (number filled in from the cache, number of jobs queued).
+    keys = {clinic.id: clinicKey(clinic) for clinic in clinics}
+    now = dt.datetime.utcnow()
+    waiting = set(GeocodeJob._get_collection().distinct(
+        'clinic', {'clinic': {'$in': list(keys)}, 'status': {'$in': ['pending', 'running']}}))
+    known = {
+        entry.key: entry
+        for entry in GeocodeCache.objects(key__in=list(set(keys.values())), expires__gt=now)
+    }
+
+    updates = []
+    jobs = []
+    for clinic in clinics:
+        entry = known.get(keys[clinic.id])
+        if entry is None:
+            if clinic.id in waiting:
+                continue
+            jobs.append(GeocodeJob(clinic=clinic.id, next_run=now, modify_date=now).to_mongo())
+        elif entry.found:
+            point = {'type': 'Point', 'coordinates': [entry.lon, entry.lat]}
+            updates.append(UpdateOne({'_id': clinic.id},
+                                     {'$set': {'lat': entry.lat, 'lon': entry.lon, 'location': point}}))
+    if updates:
+        Clinic._get_collection().bulk_write(updates, ordered=False)
+        invalidate('clinic')
+    if jobs:
+        GeocodeJob._get_collection().insert_many(jobs, ordered=False)
+    return len(updates), len(jobs)
+
+
+def pendingJobs(clinicIds):
+    return GeocodeJob.objects(clinic__in=clinicIds, status__in=['pending', 'running']).count()
+
+
+# pick up jobs left over from the last time the app ran
+@app.before_first_request
+def startGeocodeWorker():
+    worker.start()
@@ -0,0 +1,86 @@
+# Sends a file stored in GridFS to the browser a piece at a time.
+#
+# The file is never read into memory whole: the response body is a generator that
+# reads CHUNK_SIZE bytes from GridFS at a time. Range requests ("give me bytes
+# 1000000-") get a 206 with just that part, which is what lets an <audio> player
+# seek, and ETag/Last-Modified let the browser revalidate with a 304.
+
+import datetime as dt
+import mimetypes
+
+from flask import request, Response
+from werkzeug.http import is_resource_modified
+
+# GridFS stores files in 255kB chunks so reading about that much at a time means
+# roughly one chunk query per read
+CHUNK_SIZE = 255 * 1024
+
+
+def iterGridFile(gridout, start, stop):
+    gridout.seek(start)
+    remaining = stop - start
+    try:
+        while remaining > 0:
+            chunk = gridout.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        gridout.close()
+
+
+def guessMimetype(gridout, default='application/octet-stream'):
+    if gridout.content_type:
+        return gridout.content_type
+    if gridout.filename:
+        return mimetypes.guess_type(gridout.filename)[0] or default
+    return default
+
+
+def _rangeAllowed(etag, lastModified):
+    # If-Range means "only send me a part if the file hasn't changed"
+    ifRange = request.if_range
+    if ifRange.etag:
+        return ifRange.etag == etag
+    if ifRange.date:
+        return lastModified <= ifRange.date
+    return True
+
+
+def gridFileResponse(proxy, mimetype=None, maxAge=3600):
+    gridout = proxy.get()
+    length = gridout.length
+    etag = str(proxy.grid_id)
+    # GridFS dates are naive UTC with milliseconds, HTTP dates are whole seconds
+    lastModified = gridout.upload_date.replace(tzinfo=dt.timezone.utc, microsecond=0)
+    mimetype = mimetype or guessMimetype(gridout)
+
+    def headers(response):
+        response.set_etag(etag)
+        response.last_modified = lastModified
+        response.accept_ranges = 'bytes'
+        response.cache_control.private = True
+        response.cache_control.max_age = maxAge
+        return response
+
+    if not is_resource_modified(request.environ, etag=etag, last_modified=lastModified):
+        gridout.close()
+        return headers(Response(status=304))
+
+    if request.range and _rangeAllowed(etag, lastModified):
+        span = request.range.range_for_length(length)
+        if span is None:
+            gridout.close()
+            response = Response(status=416)
+            response.headers['Content-Range'] = f'bytes */{length}'
+            return headers(response)
+        start, stop = span
+        response = Response(iterGridFile(gridout, start, stop), status=206, mimetype=mimetype)
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    else:
+        start, stop = 0, length
+        response = Response(iterGridFile(gridout, start, stop), mimetype=mimetype)
+
+    response.content_length = stop - start
+    return headers(response)
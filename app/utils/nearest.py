@@ -0,0 +1,147 @@
+# Finds the clinics closest to a point.
+#
+# Normally this is one $geoNear aggregation on the 2dsphere index on
+# Clinic.location, which MongoDB answers without looking at clinics that are far
+# away. Where $geoNear isn't available (test databases like mongomock, or
+# NEAREST_BACKEND = 'kdtree') the same answer comes from a k-d tree built in Python
+# over every clinic's coordinates. The tree is kept in memory for a few minutes,
+# and each worker builds it again as soon as the page cache's 'clinic' generation
+# moves on. Everything that adds, moves or deletes a clinic calls
+# invalidate('clinic'), and with the filesystem backend every worker sees it.
+#
+# Both return a list of dicts with the clinic's fields and 'distance' in meters.
+
+import heapq
+import math
+import time
+from threading import Lock
+
+from pymongo.errors import OperationFailure
+
+from app import app
+from app.classes.data import Clinic
+from app.utils.pagecache import tagGeneration
+
+app.config.setdefault('NEAREST_BACKEND', 'mongo')
+
+EARTH_RADIUS = 6371008.8
+MAX_K = 50
+# how long the k-d tree is used before it is rebuilt from the database
+TREE_TTL = 5 * 60
+
+RESULT_FIELDS = ['name', 'streetAddress', 'city', 'state', 'zipcode', 'description']
+
+
+def unitVector(lat, lon):
+    # Points on the globe as (x, y, z) on a sphere of radius 1. The straight-line
+    # distance between two of these always sorts the same way as the distance
+    # along the ground, so an ordinary k-d tree can be used.
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chordToMeters(chord):
+    return 2 * EARTH_RADIUS * math.asin(min(chord / 2, 1.0))
+
+
+class KDTree:
+    # A plain 3-d tree. Each node splits its points in half on one axis.
+    def __init__(self, points):
+        # points is a list of (xyz, item)
+        self.root = self._build(list(points), 0)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        middle = len(points) // 2
+        return (
+            points[middle],
+            axis,
+            self._build(points[:middle], depth + 1),
+            self._build(points[middle + 1:], depth + 1),
+        )
+
+    def nearest(self, target, k):
+        # Returns [(chord distance, item), ...] closest first. Keeps the best k in a
+        # max-heap and skips any branch that can't beat the worst of them.
+        best = []
+        counter = 0
+
+        def visit(node):
+            nonlocal counter
+            if node is None:
+                return
+            (xyz, item), axis, left, right = node
+            distance = math.dist(xyz, target)
+            counter += 1
+            if len(best) < k:
+                heapq.heappush(best, (-distance, counter, item))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, counter, item))
+
+            gap = target[axis] - xyz[axis]
+            near, far = (left, right) if gap < 0 else (right, left)
+            visit(near)
+            if len(best) < k or abs(gap) < -best[0][0]:
+                visit(far)
+
+        visit(self.root)
+        return [(-negDistance, item) for negDistance, _, item in sorted(best, reverse=True)]
+
+
+_tree = None
+_treeBuilt = 0
+_treeVersion = None
+_treeLock = Lock()
+
+
+def clinicTree():
+    global _tree, _treeBuilt, _treeVersion
+    version = tagGeneration('clinic')
+    with _treeLock:
+        if _tree is None or _treeVersion != version or time.monotonic() - _treeBuilt > TREE_TTL:
+            projection = dict.fromkeys(RESULT_FIELDS + ['lat', 'lon'], 1)
+            docs = Clinic._get_collection().find({'lat': {'$ne': None}, 'lon': {'$ne': None}}, projection)
+            _tree = KDTree((unitVector(doc['lat'], doc['lon']), doc) for doc in docs)
+            _treeBuilt = time.monotonic()
+            _treeVersion = version
+        return _tree
+
+
+def _result(doc, distance):
+    result = {field: doc.get(field) for field in RESULT_FIELDS}
+    result.update(id=str(doc['_id']), lat=doc.get('lat'), lon=doc.get('lon'), distance=round(distance, 1))
+    return result
+
+
+def nearestByTree(lat, lon, k):
+    matches = clinicTree().nearest(unitVector(lat, lon), k)
+    return [_result(doc, chordToMeters(chord)) for chord, doc in matches]
+
+
+def nearestByGeoNear(lat, lon, k):
+    pipeline = [
+        {'$geoNear': {
+            'near': {'type': 'Point', 'coordinates': [lon, lat]},
+            'key': 'location',
+            'distanceField': 'distance',
+            'spherical': True,
+        }},
+        {'$limit': k},
+        {'$project': dict.fromkeys(RESULT_FIELDS + ['lat', 'lon', 'distance'], 1)},
+    ]
+    # straight to pymongo because $geoNear has to be the very first stage
+    docs = Clinic._get_collection().aggregate(pipeline)
+    return [_result(doc, doc['distance']) for doc in docs]
+
+
+def nearestClinics(lat, lon, k=5):
+    k = max(1, min(k, MAX_K))
+    if app.config['NEAREST_BACKEND'] == 'kdtree':
+        return nearestByTree(lat, lon, k)
+    try:
+        return nearestByGeoNear(lat, lon, k)
+    except (OperationFailure, NotImplementedError):
+        return nearestByTree(lat, lon, k)
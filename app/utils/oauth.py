@@ -0,0 +1,152 @@
+# The Google login client.
+#
+# Logging in used to fetch Google's discovery document on both /login and
+# /login/callback and open a new connection for every request. Now:
+#   - all requests go through one requests.Session per worker process, so the
+#     connections to Google are kept open and reused,
+#   - the discovery document is kept until its Cache-Control max-age runs out
+#     (and fetched once when the app starts so the first login doesn't wait), and
+#     an old copy is used if Google can't be reached,
+#   - every request has a timeout, and
+#   - userinfo is parsed once into a dict.
+#
+# Tests can point OAUTH_DISCOVERY_URL at a fake identity provider running locally
+# or swap the provider with setProvider(). oauthlib refuses plain http unless
+# OAUTHLIB_INSECURE_TRANSPORT=1 is set in the environment.
+
+import re
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from oauthlib.oauth2 import OAuth2Error, WebApplicationClient
+
+from app import app
+from app.utils.secrets import getSecrets
+from app.utils.workers import processLocal
+
+secrets = getSecrets()
+
+app.config.setdefault('OAUTH_DISCOVERY_URL', secrets['GOOGLE_DISCOVERY_URL'])
+
+# seconds to wait for (connecting, reading) a response
+OAUTH_TIMEOUT = (3.05, 10)
+# how long to keep the discovery document when the response doesn't say
+DEFAULT_MAX_AGE = 60 * 60
+POOL_SIZE = 10
+SCOPES = ["openid", "email", "profile"]
+
+
+class OAuthError(Exception):
+    pass
+
+
+def newSession():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# connections can't be shared with a forked process, so each worker process
+# makes its own session, see app/utils/workers.py
+httpSession = processLocal(newSession)
+
+
+def maxAge(response):
+    cacheControl = response.headers.get('Cache-Control', '')
+    if re.search(r'\b(no-store|no-cache)\b', cacheControl):
+        return 0
+    match = re.search(r'\bmax-age=(\d+)', cacheControl)
+    if match:
+        return int(match.group(1))
+    return DEFAULT_MAX_AGE
+
+
+class OAuthProvider:
+    def __init__(self, discoveryUrl, clientId, clientSecret, session=None):
+        self.discoveryUrl = discoveryUrl
+        self.clientId = clientId
+        self.clientSecret = clientSecret
+        self.session = session
+        self._config = None
+        self._expires = 0
+        self._lock = Lock()
+
+    def http(self):
+        return self.session or httpSession()
+
+    def config(self):
+        with self._lock:
+            if self._config is not None and time.monotonic() < self._expires:
+                return self._config
+            try:
+                r = self.http().get(self.discoveryUrl, timeout=OAUTH_TIMEOUT)
+                r.raise_for_status()
+                self._config = r.json()
+                self._expires = time.monotonic() + maxAge(r)
+            except (requests.RequestException, ValueError) as e:
+                # an old discovery document is better than no login at all
+                if self._config is None:
+                    raise OAuthError(f"could not load {self.discoveryUrl}: {e}") from e
+                app.logger.warning(f"using an old copy of {self.discoveryUrl}: {e}")
+            return self._config
+
+    def authorizationUrl(self, redirectUri, state=None):
+        return WebApplicationClient(self.clientId).prepare_request_uri(
+            self.config()["authorization_endpoint"],
+            redirect_uri=redirectUri,
+            scope=SCOPES,
+            state=state,
+            prompt="select_account",
+        )
+
+    def userinfo(self, authorizationResponse, redirectUrl, code):
+        # Trades the code Google sent back for a token and returns the user's
+        # profile as a dict. A new client each time because it holds the token.
+        client = WebApplicationClient(self.clientId)
+        config = self.config()
+        try:
+            tokenUrl, headers, body = client.prepare_token_request(
+                config["token_endpoint"],
+                authorization_response=authorizationResponse,
+                redirect_url=redirectUrl,
+                code=code,
+            )
+            r = self.http().post(tokenUrl, headers=headers, data=body,
+                                 auth=(self.clientId, self.clientSecret), timeout=OAUTH_TIMEOUT)
+            r.raise_for_status()
+            client.parse_request_body_response(r.text)
+
+            uri, headers, body = client.add_token(config["userinfo_endpoint"])
+            r = self.http().get(uri, headers=headers, data=body, timeout=OAUTH_TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+        except (requests.RequestException, ValueError, OAuth2Error) as e:
+            raise OAuthError(str(e)) from e
+
+
+_provider = None
+
+
+def setProvider(provider):
+    global _provider
+    _provider = provider
+
+
+def provider():
+    global _provider
+    if _provider is None:
+        _provider = OAuthProvider(app.config['OAUTH_DISCOVERY_URL'],
+                                  secrets['GOOGLE_CLIENT_ID'], secrets['GOOGLE_CLIENT_SECRET'])
+    return _provider
+
+
+@app.before_first_request
+def prefetchDiscovery():
+    try:
+        provider().config()
+    except OAuthError:
+        app.logger.exception("could not load the login discovery document")
@@ -0,0 +1,329 @@
+# Caches whole pages and pieces of pages (like the navbar) so they aren't rendered
+# again for every request.
+#
+#     @app.route('/emojis')
+#     @login_required
+#     @cachedPage('emoji')
+#     def emojiList(): ...
+#
+#     {{ cachedInclude('includes/_navbar.html') }}
+#
+# Every entry is kept per user, because the navbar at the top of every page shows
+# who is logged in. Entries are also tagged with the kinds of data they show
+# ('emoji', 'sleep', ...). The create/edit/delete routes call invalidate('emoji')
+# and so on, which moves that tag's generation forward. The generation is part of
+# the cache key, so every page showing emojis misses from then on and the old
+# entries age out of the LRU.
+#
+# Every entry is also tagged 'visibility'. Which records a user may see depends on
+# other users' consent, adult_email and role (see visibleOwners in data.py), so a
+# change to any of those calls invalidateVisibility() and every cached page and
+# include misses, whatever data it shows. See app/utils/visibility.py.
+#
+# Entries are kept in memory in each worker process. With
+# PAGE_CACHE_BACKEND = 'filesystem' they are also written to PAGE_CACHE_DIR, so
+# all the worker processes on one machine share both the pages and the tag
+# generations. That means an invalidation in one worker is seen by the others.
+# The memory backend only works for a single process: another worker would keep
+# showing an old list after a new record is saved. gunicorn.conf.py turns on the
+# filesystem backend through the PAGE_CACHE_BACKEND environment variable.
+#
+# Requests that have flashed messages waiting are never cached or served from the
+# cache, because the messages are part of the page. Hits and misses for each
+# route are at /cache/stats.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from functools import wraps
+from threading import Lock
+
+from flask import request, make_response, render_template, get_flashed_messages
+from flask_login import current_user
+from markupsafe import Markup
+
+from app import app
+from app.utils.cache import LRUCache
+
+app.config.setdefault('PAGE_CACHE_ENABLED', os.environ.get('PAGE_CACHE_ENABLED', '1') != '0')
+app.config.setdefault('PAGE_CACHE_BACKEND', os.environ.get('PAGE_CACHE_BACKEND', 'memory'))
+app.config.setdefault('PAGE_CACHE_DIR', os.path.join(app.instance_path, 'page-cache'))
+app.config.setdefault('PAGE_CACHE_SIZE', 1024)
+app.config.setdefault('PAGE_CACHE_TTL', 5 * 60)
+
+# how often each worker clears out old files when using the filesystem backend
+PRUNE_INTERVAL = 60
+# the longest a file is kept when PAGE_CACHE_TTL is None
+MAX_FILE_TTL = 24 * 60 * 60
+TEMP_PREFIX = '.tmp-'
+VISIBILITY_TAG = 'visibility'
+
+
+class MemoryBackend:
+    def __init__(self, maxsize, ttl):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.generations = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        self.entries.set(key, value, ttl)
+
+    def generation(self, tag):
+        return self.generations.get(tag, 0)
+
+    def bump(self, tag):
+        with self.lock:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+
+
+class FileBackend:
+    # One file per entry: a line of JSON with when it expires, its mimetype and the
+    # tag generations it was made with, then the body. It is written to a temporary
+    # name and renamed so a reader never sees half a file, and its modified time is
+    # set to when it expires so old files can be found without opening them.
+    #
+    # A tag's generation is the size of its file in 'tags', and bumping it appends
+    # one byte. Appends are atomic, so two workers bumping at once both count.
+    #
+    # Nothing in the directory is ever run or unpickled, and the directory is only
+    # readable by the user the app runs as. Every PRUNE_INTERVAL seconds a worker
+    # deletes the entries that have expired or that an invalidation has replaced.
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl if ttl is not None else MAX_FILE_TTL
+        self.lastPrune = 0
+        for path in (directory, os.path.join(directory, 'tags')):
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            if os.stat(path).st_uid != os.getuid():
+                raise RuntimeError(f"{path} belongs to another user, not using it for the page cache")
+            os.chmod(path, 0o700)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def _tagPath(self, tag):
+        return os.path.join(self.directory, 'tags', hashlib.sha1(tag.encode()).hexdigest())
+
+    def _read(self, path, headerOnly=False):
+        with open(path, 'rb') as entry:
+            header = json.loads(entry.readline())
+            body = None if headerOnly else entry.read()
+        return header, body
+
+    def get(self, key):
+        try:
+            header, body = self._read(self._path(key))
+        except (OSError, ValueError):
+            return None
+        if header['expires'] <= time.time():
+            return None
+        return body, header['mimetype']
+
+    def set(self, key, value, ttl, generations=None):
+        body, mimetype = value
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        header = {'expires': expires, 'mimetype': mimetype, 'generations': generations or {}}
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        with os.fdopen(handle, 'wb') as entry:
+            entry.write(json.dumps(header).encode() + b'\n')
+            entry.write(body)
+        os.utime(temporary, (expires, expires))
+        os.replace(temporary, self._path(key))
+        if time.time() - self.lastPrune > PRUNE_INTERVAL:
+            self.prune()
+
+    def generation(self, tag):
+        try:
+            return os.stat(self._tagPath(tag)).st_size
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, tag):
+        with open(self._tagPath(tag), 'ab') as generations:
+            generations.write(b'.')
+
+    def prune(self):
+        self.lastPrune = now = time.time()
+        current = {}
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                try:
+                    if entry.name.startswith(TEMP_PREFIX):
+                        # left behind by a worker that died while writing
+                        stale = entry.stat().st_mtime < now - PRUNE_INTERVAL
+                    elif entry.stat().st_mtime <= now:
+                        stale = True
+                    else:
+                        header, _ = self._read(entry.path, headerOnly=True)
+                        stale = any(
+                            current.setdefault(tag, self.generation(tag)) != generation
+                            for tag, generation in header['generations'].items()
+                        )
+                    if stale:
+                        os.remove(entry.path)
+                        removed += 1
+                except (OSError, ValueError):
+                    # another worker got to it first
+                    continue
+        return removed
+
+
+class PageCache:
+    def __init__(self):
+        self.local = MemoryBackend(app.config['PAGE_CACHE_SIZE'], app.config['PAGE_CACHE_TTL'])
+        self.shared = None
+        if app.config['PAGE_CACHE_BACKEND'] == 'filesystem':
+            self.shared = FileBackend(app.config['PAGE_CACHE_DIR'], app.config['PAGE_CACHE_TTL'])
+        self.stats = {}
+        self.statsLock = Lock()
+
+    def statsReport(self):
+        # hit and miss counts for this worker process since it started
+        with self.statsLock:
+            routes = {name: dict(counts) for name, counts in self.stats.items()}
+        hits = sum(counts['hits'] for counts in routes.values())
+        misses = sum(counts['misses'] for counts in routes.values())
+        return {
+            'pid': os.getpid(),
+            'backend': app.config['PAGE_CACHE_BACKEND'],
+            'entries': len(self.local.entries),
+            'hits': hits,
+            'misses': misses,
+            'hitRate': round(hits / (hits + misses), 3) if hits + misses else None,
+            'routes': routes,
+        }
+
+    def count(self, name, outcome):
+        with self.statsLock:
+            counts = self.stats.setdefault(name, {'hits': 0, 'misses': 0, 'bypassed': 0})
+            counts[outcome] += 1
+
+    def generations(self, tags):
+        backend = self.shared or self.local
+        return tuple(backend.generation(tag) for tag in tags)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, None)
+        return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        # value is (body bytes, mimetype); tags are the ones the key's generations are for
+        self.local.set(key, value, ttl)
+        if self.shared:
+            self.shared.set(key, value, ttl, dict(zip(tags, key[-1])))
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.local.bump(tag)
+            if self.shared:
+                self.shared.bump(tag)
+
+
+pageCache = PageCache()
+
+
+def invalidate(*tags):
+    pageCache.invalidate(*tags)
+
+
+def invalidateUserPages(userId):
+    # the navbar and profile show the user's name, role and picture
+    pageCache.invalidate(f'user:{userId}')
+
+
+def tagGeneration(tag):
+    # goes up with every invalidate(tag), in every worker when the backend is shared.
+    # Other caches put it in their keys to be thrown away along with the pages.
+    return pageCache.generations((tag,))[0]
+
+
+def userPagesGeneration(userId):
+    return tagGeneration(f'user:{userId}')
+
+
+def invalidateVisibility():
+    pageCache.invalidate(VISIBILITY_TAG)
+
+
+def visibilityGeneration():
+    return tagGeneration(VISIBILITY_TAG)
+
+
+def _viewer():
+    if current_user and current_user.is_authenticated:
+        return str(current_user.id)
+    return 'anonymous'
+
+
+def _tags(tags):
+    return tuple(tags) + (VISIBILITY_TAG, f'user:{_viewer()}')
+
+
+def _bypass():
+    # Flashed messages are shown once, so a page carrying them can't be reused.
+    # get_flashed_messages() keeps returning this request's messages after the
+    # template has taken them out of the session, so this works after rendering.
+    return not app.config['PAGE_CACHE_ENABLED'] or bool(get_flashed_messages())
+
+
+def cachedPage(*tags, ttl=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            name = request.endpoint
+            if request.method not in ('GET', 'HEAD') or _bypass():
+                pageCache.count(name, 'bypassed')
+                return view(*args, **kwargs)
+
+            allTags = _tags(tags)
+            key = ('page', request.full_path, _viewer(), pageCache.generations(allTags))
+            cached = pageCache.get(key)
+            if cached is not None:
+                pageCache.count(name, 'hits')
+                body, mimetype = cached
+                response = make_response(body)
+                response.mimetype = mimetype
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            pageCache.count(name, 'misses')
+            response = make_response(view(*args, **kwargs))
+            # flash() may have been called by the view
+            if response.status_code == 200 and not response.direct_passthrough and not _bypass():
+                pageCache.set(key, (response.get_data(), response.mimetype), ttl, allTags)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+@app.template_global()
+def cachedInclude(templateName, *tags, ttl=None):
+    # like {% include %} but the rendered HTML is kept per user
+    name = f'include:{templateName}'
+    if not app.config['PAGE_CACHE_ENABLED']:
+        pageCache.count(name, 'bypassed')
+        return Markup(render_template(templateName))
+    allTags = _tags(tags)
+    key = ('include', templateName, _viewer(), pageCache.generations(allTags))
+    cached = pageCache.get(key)
+    if cached is None:
+        pageCache.count(name, 'misses')
+        html = render_template(templateName)
+        pageCache.set(key, (html.encode(), 'text/html'), ttl, allTags)
+    else:
+        pageCache.count(name, 'hits')
+        html = cached[0].decode()
+    return Markup(html)
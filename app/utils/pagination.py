@@ -0,0 +1,116 @@
+# Keyset ("cursor") pagination shared by all of the list pages.
+#
+# Instead of skipping N documents, each page remembers the sort value and _id of
+# its first and last rows. The next page asks for rows that sort after the last
+# one and the previous page for rows that sort before the first one. MongoDB can
+# jump straight there with the (sort field, _id) index, so page 200 costs the same
+# as page 1.
+#
+# In a route:
+#     page = paginate(Emoji.objects(), 'create_date')
+#     return render_template('emojis.html', emojis=page.items, page=page)
+# and in the template:
+#     {% include 'includes/_pager.html' %}
+
+import base64
+import datetime as dt
+import json
+
+from bson.objectid import ObjectId
+from flask import request, url_for, abort
+from mongoengine.queryset.visitor import Q
+
+from app import app
+
+app.config.setdefault('PAGE_SIZE', 25)
+app.config.setdefault('MAX_PAGE_SIZE', 100)
+
+
+def encodeCursor(document, sortField):
+    value = document[sortField]
+    if isinstance(value, dt.datetime):
+        value = {'$date': value.isoformat()}
+    raw = json.dumps([value, str(document.id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decodeCursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, docId = json.loads(raw)
+        if isinstance(value, dict):
+            value = dt.datetime.fromisoformat(value['$date'])
+        return value, ObjectId(docId)
+    except Exception:
+        abort(400, "That page link is broken.")
+
+
+def seekQuery(queryset, sortField, descending=True, cursor=None, before=False):
+    # "forward" is the direction the page is shown in. Going back to the previous
+    # page walks the index the other way and the rows get flipped afterwards.
+    forward = descending != before
+    sign = '-' if forward else ''
+    op = 'lt' if forward else 'gt'
+
+    # documents without a sort value can't be placed relative to a cursor
+    queryset = queryset.filter(**{f'{sortField}__ne': None})
+    if cursor:
+        value, docId = cursor
+        queryset = queryset.filter(
+            Q(**{f'{sortField}__{op}': value}) |
+            Q(**{sortField: value, f'id__{op}': docId})
+        )
+    return queryset.order_by(f'{sign}{sortField}', f'{sign}id')
+
+
+class Page:
+    def __init__(self, items, nextCursor=None, prevCursor=None, size=None):
+        self.items = items
+        self.nextCursor = nextCursor
+        self.prevCursor = prevCursor
+        self.size = size
+
+    def _url(self, **cursor):
+        args = dict(request.view_args or {})
+        if 'size' in request.args:
+            args['size'] = self.size
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    @property
+    def nextUrl(self):
+        if self.nextCursor:
+            return self._url(after=self.nextCursor)
+
+    @property
+    def prevUrl(self):
+        if self.prevCursor:
+            return self._url(before=self.prevCursor)
+
+
+def pageSize():
+    size = request.args.get('size', app.config['PAGE_SIZE'], type=int)
+    return max(1, min(size, app.config['MAX_PAGE_SIZE']))
+
+
+def paginate(queryset, sortField, descending=True):
+    size = pageSize()
+    after = request.args.get('after')
+    before = request.args.get('before')
+    cursor = decodeCursor(before or after) if (before or after) else None
+
+    query = seekQuery(queryset, sortField, descending, cursor, before=bool(before))
+    # ask for one extra row to find out if there is another page past this one
+    items = list(query.limit(size + 1))
+    hasMore = len(items) > size
+    items = items[:size]
+
+    if before:
+        items.reverse()
+        nextCursor = encodeCursor(items[-1], sortField) if items else None
+        prevCursor = encodeCursor(items[0], sortField) if hasMore else None
+    else:
+        nextCursor = encodeCursor(items[-1], sortField) if hasMore else None
+        prevCursor = encodeCursor(items[0], sortField) if after and items else None
+
+    return Page(items, nextCursor, prevCursor, size)
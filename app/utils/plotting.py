@@ -0,0 +1,22 @@
+# Drawing the PNGs the site shows (the sleep graph, the emoji heatmap).
+#
+# Each figure is a Figure with its own FigureCanvasAgg instead of one made with
+# pyplot, so requests on different threads never share pyplot's global "current
+# figure".
+
+from io import BytesIO
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+def newFigure(figsize):
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def pngBytes(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', bbox_inches='tight')
+    return buffer.getvalue()
@@ -0,0 +1,43 @@
+# Loads the users referenced by a page of documents in one query.
+#
+# A ReferenceField like Emoji.author is fetched from MongoDB the first time a
+# template touches it (emoji.author.fname), which means one extra query per row.
+# prefetchUsers() collects all the referenced ids first, loads just the fields
+# the page shows with a single $in query and puts the users back on the documents,
+# so the template never has to go back to the database.
+#
+#     page = paginate(Emoji.objects(), 'create_date')
+#     prefetchUsers(page.items, 'author')
+
+from bson.dbref import DBRef
+from bson.objectid import ObjectId
+
+from app.classes.data import User
+
+# the user fields the list pages show
+LIST_USER_FIELDS = ('fname', 'lname')
+
+
+def _refId(value):
+    # None for references that are empty or already loaded
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, ObjectId):
+        return value
+    return None
+
+
+def prefetchUsers(documents, field, fields=LIST_USER_FIELDS):
+    # _data holds the raw reference without dereferencing it
+    refs = [doc._data.get(field) for doc in documents]
+    ids = {_refId(ref) for ref in refs} - {None}
+    if not ids:
+        return documents
+
+    users = {user.id: user for user in User.objects(id__in=list(ids)).only(*fields)}
+
+    for doc, ref in zip(documents, refs):
+        user = users.get(_refId(ref))
+        if user is not None:
+            doc._data[field] = user
+    return documents
@@ -0,0 +1,207 @@
+# Sleep analytics done with NumPy on whole columns at once.
+#
+# The sleeps are read with one query that only asks for the fields used here and
+# turned into arrays (one per field). Everything after that is array math with no
+# Python loop per night:
+#   - sleep debt: how far below SLEEP_TARGET_HOURS the user has fallen, carried
+#     from night to night and never below zero,
+#   - how minstosleep goes with rating and with feel (Pearson correlation),
+#   - weekday effects: average hours and rating for each night of the week
+#     compared with the average over all nights, and
+#   - bedtime: the average time of going to bed and how much it moves around.
+#
+# Results for one user are cached on (user, sleep_version) like the sleep graph.
+# The whole school (every student who has consented) is cached for a few minutes.
+
+import datetime as dt
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from app.classes.data import Sleep, consentingStudents, sleepVersion
+from app.utils.cache import LRUCache
+from app.utils.pagecache import visibilityGeneration
+
+# recommended for teenagers
+SLEEP_TARGET_HOURS = 9
+# how many nights the short-term debt adds up
+RECENT_DEBT_NIGHTS = 7
+# A night runs from noon to noon, the same as app/utils/sleepsummary.py
+NIGHT_STARTS = np.timedelta64(12, 'h')
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+SCHOOL_TTL = 5 * 60
+READ_BATCH = 10000
+
+FIELDS = ['sleeper', 'start', 'end', 'rating', 'feel', 'minstosleep']
+
+analyticsCache = LRUCache(maxsize=256)
+
+
+def invalidateSleepAnalytics(userId):
+    userId = str(userId)
+    analyticsCache.popWhere(lambda key: key[0] == userId)
+
+
+def userMatch(userId):
+    return {'sleeper': ObjectId(str(userId)), 'start': {'$ne': None}}
+
+
+def columnsCursor(match):
+    projection = dict.fromkeys(FIELDS, 1)
+    projection['_id'] = 0
+    return Sleep._get_collection().find(match, projection).sort('start', 1).batch_size(READ_BATCH)
+
+
+def loadColumns(match):
+    # One projected query, then one array per field. Missing numbers become nan
+    # and missing times become NaT.
+    docs = list(columnsCursor(match))
+    columns = {
+        'sleeper': np.array([str(doc.get('sleeper')) for doc in docs]),
+        'start': np.array([doc.get('start') for doc in docs], dtype='datetime64[s]'),
+        'end': np.array([doc.get('end') for doc in docs], dtype='datetime64[s]'),
+    }
+    for field in ['rating', 'feel', 'minstosleep']:
+        columns[field] = np.array([doc.get(field) for doc in docs], dtype=float)
+
+    # worked out from start and end instead of the stored hours, which older
+    # versions of sleepNew saved wrong
+    hours = (columns['end'] - columns['start']) / np.timedelta64(1, 'h')
+    hours[(hours <= 0) | (hours > 24)] = np.nan
+    columns['hours'] = hours
+    columns['night'] = (columns['start'] - NIGHT_STARTS).astype('datetime64[D]')
+    return columns
+
+
+def _number(value, digits=2):
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+def _numbers(values, digits=2):
+    return [_number(value, digits) for value in values]
+
+
+def correlation(x, y):
+    both = ~np.isnan(x) & ~np.isnan(y)
+    if both.sum() < 3:
+        return None
+    x, y = x[both], y[both]
+    if x.std() == 0 or y.std() == 0:
+        return None
+    return _number(np.corrcoef(x, y)[0, 1], 3)
+
+
+def sleepDebt(night, hours, target=SLEEP_TARGET_HOURS):
+    # Adds up the hours of each logged night (naps and split nights count
+    # together), then carries the shortfall forward: debt = S(t) - min(0, lowest
+    # S so far) where S is the running total of (target - hours). That is the same
+    # as "debt += target - hours, but never below zero" without a loop.
+    logged = ~np.isnan(hours) & ~np.isnat(night)
+    if not logged.any():
+        return {'nights': [], 'hours': [], 'debt': [], 'recentDebt': [], 'current': None}
+    nights, which = np.unique(night[logged], return_inverse=True)
+    nightly = np.bincount(which, weights=hours[logged], minlength=len(nights))
+    shortfall = target - nightly
+    running = np.cumsum(shortfall)
+    debt = running - np.minimum(np.minimum.accumulate(running), 0)
+    recent = np.convolve(shortfall, np.ones(RECENT_DEBT_NIGHTS))[:len(shortfall)]
+    return {
+        'nights': [str(day) for day in nights],
+        'hours': _numbers(nightly),
+        'debt': _numbers(debt),
+        'recentDebt': _numbers(recent),
+        'current': _number(debt[-1]) if len(debt) else None,
+    }
+
+
+def _groupMeans(groups, values, size):
+    counted = ~np.isnan(values)
+    counts = np.bincount(groups[counted], minlength=size)
+    sums = np.bincount(groups[counted], weights=values[counted], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sums / counts
+
+
+def weekdayEffects(night, hours, rating):
+    known = ~np.isnat(night)
+    # 1970-01-01 was a Thursday, so this makes Monday 0
+    weekday = (night[known].astype('int64') + 3) % 7
+    hours, rating = hours[known], rating[known]
+    counts, meanHours = _groupMeans(weekday, hours, 7)
+    _, meanRating = _groupMeans(weekday, rating, 7)
+    overallHours = np.nanmean(hours) if (~np.isnan(hours)).any() else np.nan
+    overallRating = np.nanmean(rating) if (~np.isnan(rating)).any() else np.nan
+    return [
+        {
+            'day': WEEKDAYS[day],
+            'nights': int(counts[day]),
+            'meanHours': _number(meanHours[day]),
+            'meanRating': _number(meanRating[day]),
+            'hoursEffect': _number(meanHours[day] - overallHours),
+            'ratingEffect': _number(meanRating[day] - overallRating),
+        }
+        for day in range(7)
+    ]
+
+
+def bedtimes(start, night, sleeper):
+    # minutes after noon on the day the night began, so 22:30 and 00:30 are two
+    # hours apart and not 22
+    known = ~np.isnat(start)
+    minutes = (start[known] - (night[known] + NIGHT_STARTS)) / np.timedelta64(1, 'm')
+    if not len(minutes):
+        return {'mean': None, 'stdMinutes': None, 'meanUserStdMinutes': None}
+    mean = minutes.mean()
+    clock = (dt.datetime(2000, 1, 1, 12) + dt.timedelta(minutes=float(mean))).strftime('%H:%M')
+
+    # how much each person's own bedtime moves, averaged over people
+    people, which = np.unique(sleeper[known], return_inverse=True)
+    counts = np.bincount(which, minlength=len(people))
+    sums = np.bincount(which, weights=minutes, minlength=len(people))
+    squares = np.bincount(which, weights=minutes ** 2, minlength=len(people))
+    variance = np.maximum(squares / counts - (sums / counts) ** 2, 0)
+    return {
+        'mean': clock,
+        'stdMinutes': _number(minutes.std(), 1),
+        'meanUserStdMinutes': _number(np.sqrt(variance).mean(), 1),
+    }
+
+
+def analyze(columns, debt=True):
+    result = {
+        'nights': int(len(columns['start'])),
+        'targetHours': SLEEP_TARGET_HOURS,
+        'correlations': {
+            'minstosleepRating': correlation(columns['minstosleep'], columns['rating']),
+            'minstosleepFeel': correlation(columns['minstosleep'], columns['feel']),
+        },
+        'weekdays': weekdayEffects(columns['night'], columns['hours'], columns['rating']),
+        'bedtime': bedtimes(columns['start'], columns['night'], columns['sleeper']),
+    }
+    if debt:
+        # a running debt only makes sense for one person
+        result['sleepDebt'] = sleepDebt(columns['night'], columns['hours'])
+    return result
+
+
+def userAnalytics(user):
+    key = (str(user.id), sleepVersion(user.id))
+    result = analyticsCache.get(key)
+    if result is None:
+        columns = loadColumns(userMatch(user.id))
+        result = analyze(columns)
+        analyticsCache.set(key, result)
+    return result
+
+
+def schoolAnalytics():
+    key = ('school', visibilityGeneration())
+    result = analyticsCache.get(key)
+    if result is None:
+        consenting = consentingStudents().distinct('id')
+        columns = loadColumns({'sleeper': {'$in': consenting}, 'start': {'$ne': None}})
+        result = analyze(columns, debt=False)
+        result['sleepers'] = int(len(np.unique(columns['sleeper'])))
+        analyticsCache.set(key, result, ttl=SCHOOL_TTL)
+    return result
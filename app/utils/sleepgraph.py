@@ -0,0 +1,70 @@
+# Renders a user's sleep graph into memory instead of a shared file in app/static.
+# The PNG bytes are cached per user and keyed on User.sleep_version, which goes up
+# whenever one of their Sleep documents is created, edited or deleted. Because the
+# version lives in the database every worker process agrees on it, so a cached graph
+# is only ever served for the exact data it was drawn from.
+
+import datetime as dt
+
+from app.utils.cache import LRUCache
+from app.utils.plotting import newFigure, pngBytes
+from app.utils.sleepstats import sleepStats
+
+# how many rendered graphs each worker keeps around
+GRAPH_CACHE_SIZE = 256
+
+graphCache = LRUCache(maxsize=GRAPH_CACHE_SIZE)
+
+
+def invalidateSleepGraph(userId):
+    userId = str(userId)
+    # old versions can never be asked for again so free the memory now
+    graphCache.popWhere(lambda key: key[0] == userId)
+
+
+def ratingColor(rating):
+    if rating is None:
+        return 'gray'
+    if rating >= 4:
+        return 'green'
+    elif rating >= 3:
+        return 'yellow'
+    return 'red'
+
+
+def renderSleepGraph(userId):
+    # one point per night, already averaged by the database
+    days = sleepStats(userId, bucket='day')
+
+    hours = []
+    dates = []
+    colors = []
+    for day in days:
+        if day['meanHours'] is None:
+            continue
+        hours.append(day['meanHours'])
+        dates.append(dt.datetime.strptime(day['bucket'], '%Y-%m-%d').date())
+        colors.append(ratingColor(day['meanRating']))
+
+    fig = newFigure((10, 5))
+    ax = fig.subplots()
+    ax.scatter(dates, hours, marker='o', c=colors)
+    ax.set_yticks(hours)
+    ax.set_xticks(dates)
+    ax.tick_params(axis='x', labelrotation=45)
+
+    return pngBytes(fig)
+
+
+# version comes from sleepVersion() in data.py, read once per request
+def sleepGraphEtag(userId, version):
+    return f"sleep-{userId}-{version}"
+
+
+def sleepGraphPng(userId, version):
+    key = (str(userId), version)
+    png = graphCache.get(key)
+    if png is None:
+        png = renderSleepGraph(userId)
+        graphCache.set(key, png)
+    return png
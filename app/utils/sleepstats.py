@@ -0,0 +1,106 @@
+# Sleep statistics computed inside MongoDB with aggregation pipelines instead of
+# pulling every Sleep document into Python. Only one small row per day (or week)
+# comes back, so the cost depends on the number of buckets and not on how many
+# nights a user has logged.
+
+import datetime as dt
+
+from bson.objectid import ObjectId
+
+from app.classes.data import Sleep
+
+# $dateToString formats for each kind of bucket. %G-W%V is the ISO year and week.
+BUCKET_FORMATS = {
+    'day': '%Y-%m-%d',
+    'week': '%G-W%V',
+}
+
+
+def _counted(field):
+    # 1 when the field holds a value, 0 when it is missing or null. Used to
+    # average fields that are not filled in on every night.
+    return {'$cond': [{'$gt': [field, None]}, 1, 0]}
+
+
+def _hours():
+    # hours from start and end rather than the stored hours, which older entries
+    # got wrong; anything that isn't between 0 and 24 is left out
+    hours = {'$divide': [{'$subtract': ['$end', '$start']}, 60 * 60 * 1000]}
+    return {'$cond': [{'$and': [{'$gt': [hours, 0]}, {'$lte': [hours, 24]}]}, hours, None]}
+
+
+def sleepStatsPipeline(userId, start=None, end=None, bucket='day'):
+    if bucket not in BUCKET_FORMATS:
+        raise ValueError(f"bucket must be one of {', '.join(BUCKET_FORMATS)}")
+
+    # the pipeline goes straight to pymongo so the reference has to be an ObjectId
+    match = {'sleeper': ObjectId(str(userId)), 'start': {'$ne': None}}
+    if start:
+        match['start']['$gte'] = start
+    if end:
+        match['start']['$lt'] = end
+
+    bucketKey = {'$dateToString': {'format': BUCKET_FORMATS[bucket], 'date': '$start'}}
+
+    return [
+        {'$match': match},
+        {'$addFields': {'hours': _hours()}},
+        # first group by bucket and rating so the rating distribution can be
+        # built without pushing every night into an array
+        {'$group': {
+            '_id': {'bucket': bucketKey, 'rating': '$rating'},
+            'nights': {'$sum': 1},
+            'hours': {'$sum': '$hours'},
+            'hoursCount': {'$sum': _counted('$hours')},
+            'mins': {'$sum': '$minstosleep'},
+            'minsCount': {'$sum': _counted('$minstosleep')},
+        }},
+        {'$group': {
+            '_id': '$_id.bucket',
+            'nights': {'$sum': '$nights'},
+            'hours': {'$sum': '$hours'},
+            'hoursCount': {'$sum': '$hoursCount'},
+            'mins': {'$sum': '$mins'},
+            'minsCount': {'$sum': '$minsCount'},
+            'ratings': {'$push': {'rating': '$_id.rating', 'nights': '$nights'}},
+        }},
+        {'$sort': {'_id': 1}},
+    ]
+
+
+def _mean(total, count):
+    if not count:
+        return None
+    return round(total / count, 2)
+
+
+def sleepStats(userId, start=None, end=None, bucket='day'):
+    rows = Sleep.objects.aggregate(sleepStatsPipeline(userId, start, end, bucket))
+
+    stats = []
+    for row in rows:
+        ratings = {}
+        ratingTotal = 0
+        ratingCount = 0
+        for r in row['ratings']:
+            if r['rating'] is None:
+                continue
+            ratings[str(r['rating'])] = r['nights']
+            ratingTotal += r['rating'] * r['nights']
+            ratingCount += r['nights']
+        stats.append({
+            'bucket': row['_id'],
+            'nights': row['nights'],
+            'meanHours': _mean(row['hours'], row['hoursCount']),
+            'meanRating': _mean(ratingTotal, ratingCount),
+            'meanMinsToSleep': _mean(row['mins'], row['minsCount']),
+            'ratings': ratings,
+        })
+    return stats
+
+
+def parseStatsDate(value):
+    # dates come in from the query string as YYYY-MM-DD
+    if not value:
+        return None
+    return dt.datetime.strptime(value, '%Y-%m-%d')
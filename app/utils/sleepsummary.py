@@ -0,0 +1,222 @@
+# Keeps one SleepSummary document per user up to date so the profile and overview
+# pages can show sleep totals without reading every Sleep the user has.
+#
+# Adding a sleep is one atomic update: $inc the count, hours and rating histogram,
+# and $push the night into 'recent' (kept sorted, newest 30 only). The streak is
+# moved forward by a second small update. Editing or deleting $incs the
+# difference and then reloads the newest 30 nights, and the streaks if they could
+# have changed, from the (sleeper, -start) index.
+#
+# A user who had sleeps before summaries existed has no SleepSummary yet. Theirs is
+# worked out from all of their sleeps the first time it is read or one of their
+# sleeps changes, so it never starts counting from the wrong place.
+# 'flask sleeps rebuild-summaries' works everything out again for everyone.
+
+import datetime as dt
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from app.classes.data import Sleep, SleepSummary
+
+RECENT_NIGHTS = 30
+# A night runs from noon to noon, so going to bed after midnight still counts as
+# the night before.
+NIGHT_STARTS = dt.timedelta(hours=12)
+ONE_DAY = dt.timedelta(days=1)
+
+
+def nightOf(start):
+    return dt.datetime.combine((start - NIGHT_STARTS).date(), dt.time())
+
+
+def recentEntry(sleep):
+    return {
+        'start': sleep.start,
+        'hours': float(sleep.hours or 0),
+        'rating': int(sleep.rating) if sleep.rating is not None else None,
+    }
+
+
+def _collection():
+    return SleepSummary._get_collection()
+
+
+def _id(sleeperId):
+    return ObjectId(str(sleeperId))
+
+
+def streakFields(sleeperId):
+    # only 'start' is read, so this is answered from the (sleeper, -start) index
+    starts = Sleep._get_collection().find(
+        {'sleeper': _id(sleeperId), 'start': {'$ne': None}}, {'start': 1, '_id': 0})
+    nights = sorted({nightOf(doc['start']) for doc in starts})
+    current = longest = 0
+    previous = None
+    for night in nights:
+        current = current + 1 if previous is not None and night - previous == ONE_DAY else 1
+        longest = max(longest, current)
+        previous = night
+    return {'last_night': previous, 'current_streak': current, 'longest_streak': longest}
+
+
+def recentFields(sleeperId):
+    newest = (Sleep.objects(sleeper=sleeperId, start__ne=None)
+              .order_by('-start').only('start', 'hours', 'rating').limit(RECENT_NIGHTS))
+    return {'recent': [recentEntry(sleep) for sleep in newest]}
+
+
+def refreshSummary(sleeperId, streaks=True):
+    fields = recentFields(sleeperId)
+    if streaks:
+        fields.update(streakFields(sleeperId))
+    fields['modify_date'] = dt.datetime.utcnow()
+    _collection().update_one({'sleeper': _id(sleeperId)}, {'$set': fields})
+
+
+def _advanceStreak(sleeperId, night):
+    # Adds one night that is the same as or after the newest night so far. If a
+    # newer night showed up in the meantime the filter won't match and the
+    # streaks are worked out again instead.
+    result = _collection().update_one(
+        {'sleeper': _id(sleeperId), '$or': [{'last_night': {'$lte': night}}, {'last_night': None}]},
+        [
+            {'$set': {
+                'current_streak': {'$switch': {
+                    'branches': [
+                        {'case': {'$eq': ['$last_night', night]}, 'then': '$current_streak'},
+                        {'case': {'$eq': ['$last_night', night - ONE_DAY]},
+                         'then': {'$add': ['$current_streak', 1]}},
+                    ],
+                    'default': 1,
+                }},
+                'last_night': night,
+            }},
+            {'$set': {'longest_streak': {'$max': ['$longest_streak', '$current_streak']}}},
+        ],
+    )
+    if not result.matched_count:
+        refreshSummary(sleeperId)
+
+
+def _hasSummary(sleeperId):
+    return _collection().count_documents({'sleeper': _id(sleeperId)}, limit=1) > 0
+
+
+# These are called after the Sleep has been saved, changed or deleted, so a summary
+# rebuilt here already includes the change.
+def summaryAdd(sleeperId, sleep):
+    if not _hasSummary(sleeperId):
+        rebuildSummary(sleeperId)
+        return
+    entry = recentEntry(sleep)
+    inc = {'count': 1, 'total_hours': entry['hours']}
+    if entry['rating'] is not None:
+        inc[f"ratings.{entry['rating']}"] = 1
+    update = {
+        '$inc': inc,
+        '$push': {'recent': {'$each': [entry], '$sort': {'start': -1}, '$slice': RECENT_NIGHTS}},
+        '$set': {'modify_date': dt.datetime.utcnow()},
+    }
+    try:
+        before = _collection().find_one_and_update(
+            {'sleeper': _id(sleeperId)}, update, projection={'last_night': 1}, upsert=True)
+    except DuplicateKeyError:
+        # two first sleeps at once both tried to make the summary; now it exists
+        before = _collection().find_one_and_update(
+            {'sleeper': _id(sleeperId)}, update, projection={'last_night': 1})
+    if not entry['start']:
+        return
+    night = nightOf(entry['start'])
+    lastNight = before.get('last_night') if before else None
+    if lastNight is not None and night < lastNight:
+        # filling in an older night can join two streaks together
+        refreshSummary(sleeperId)
+    else:
+        _advanceStreak(sleeperId, night)
+
+
+def summaryChange(sleeperId, old, new):
+    # old and new are recentEntry() dicts from before and after the edit
+    if not _hasSummary(sleeperId):
+        rebuildSummary(sleeperId)
+        return
+    inc = {'total_hours': new['hours'] - old['hours']}
+    if old['rating'] != new['rating']:
+        if old['rating'] is not None:
+            inc[f"ratings.{old['rating']}"] = -1
+        if new['rating'] is not None:
+            inc[f"ratings.{new['rating']}"] = 1
+    _collection().update_one({'sleeper': _id(sleeperId)}, {'$inc': inc})
+    moved = old['start'] is None or new['start'] is None or nightOf(old['start']) != nightOf(new['start'])
+    refreshSummary(sleeperId, streaks=moved)
+
+
+def summaryRemove(sleeperId, sleep):
+    if not _hasSummary(sleeperId):
+        rebuildSummary(sleeperId)
+        return
+    entry = recentEntry(sleep)
+    inc = {'count': -1, 'total_hours': -entry['hours']}
+    if entry['rating'] is not None:
+        inc[f"ratings.{entry['rating']}"] = -1
+    _collection().update_one({'sleeper': _id(sleeperId)}, {'$inc': inc})
+    refreshSummary(sleeperId)
+
+
+def rebuildSummary(sleeperId):
+    # Works out one user's summary from all of their sleeps. Returns False if they
+    # have none, in which case their summary is removed.
+    groups = list(Sleep._get_collection().aggregate([
+        {'$match': {'sleeper': _id(sleeperId)}},
+        {'$group': {'_id': '$rating', 'nights': {'$sum': 1}, 'hours': {'$sum': '$hours'}}},
+    ]))
+    if not groups:
+        _collection().delete_one({'sleeper': _id(sleeperId)})
+        return False
+    fields = {
+        'count': sum(group['nights'] for group in groups),
+        'total_hours': float(sum(group['hours'] or 0 for group in groups)),
+        'ratings': {str(group['_id']): group['nights'] for group in groups if group['_id'] is not None},
+        'modify_date': dt.datetime.utcnow(),
+    }
+    fields.update(recentFields(sleeperId))
+    fields.update(streakFields(sleeperId))
+    _collection().update_one({'sleeper': _id(sleeperId)}, {'$set': fields}, upsert=True)
+    return True
+
+
+def _average(nights, key):
+    values = [night[key] for night in nights if night.get(key) is not None]
+    return round(sum(values) / len(values), 2) if values else None
+
+
+def summaryStats(sleeperId, now=None):
+    # What the pages show, from the one summary document. None if there isn't one.
+    summary = SleepSummary.objects(sleeper=sleeperId).first()
+    if summary is None and rebuildSummary(sleeperId):
+        summary = SleepSummary.objects(sleeper=sleeperId).first()
+    if summary is None or not summary.count:
+        return None
+    now = now or dt.datetime.now()
+    ratings = {rating: summary.ratings.get(str(rating), 0) for rating in range(1, 6)}
+    rated = sum(ratings.values())
+
+    # a streak is still going if last night or the night before was logged
+    current = summary.current_streak or 0
+    if summary.last_night is None or summary.last_night < nightOf(now) - ONE_DAY:
+        current = 0
+
+    return {
+        'count': summary.count,
+        'totalHours': round(summary.total_hours, 1),
+        'meanHours': round(summary.total_hours / summary.count, 2),
+        'meanRating': round(sum(r * n for r, n in ratings.items()) / rated, 2) if rated else None,
+        'ratings': ratings,
+        'hours7': _average(summary.recent[:7], 'hours'),
+        'hours30': _average(summary.recent[:30], 'hours'),
+        'rating7': _average(summary.recent[:7], 'rating'),
+        'rating30': _average(summary.recent[:30], 'rating'),
+        'currentStreak': current,
+        'longestStreak': summary.longest_streak or 0,
+    }
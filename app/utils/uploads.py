@@ -0,0 +1,79 @@
+# Resumable uploads for meditation recordings.
+#
+# The recorder on meditationform.html sends the recording in pieces while it is
+# still recording. Each piece says where in the file it starts (its offset). A piece
+# is only accepted if it starts exactly where the last one ended, so after a dropped
+# connection the browser asks how much arrived and carries on from there. Pieces
+# are stored as MeditationUploadChunk documents and joined into one GridFS file
+# when the meditation is saved. The server never holds more than one piece of an
+# upload in memory.
+
+import datetime as dt
+
+import mongoengine.errors
+
+from app.classes.data import MeditationUpload, MeditationUploadChunk
+
+# the biggest piece accepted in one request
+MAX_CHUNK_SIZE = 1024 * 1024
+# the biggest recording accepted in total
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+
+
+def startUpload(user, contentType=None):
+    upload = MeditationUpload(author=user.id, content_type=contentType)
+    upload.save()
+    return upload
+
+
+def appendChunk(upload, offset, data):
+    # Returns (accepted, received). 'received' is how many bytes the server has
+    # now, which is where the browser should send from next.
+    end = offset + len(data)
+
+    # the same piece again, because the browser never heard back the first time
+    if end <= upload.received:
+        return True, upload.received
+    if offset != upload.received or end > MAX_UPLOAD_SIZE:
+        return False, upload.received
+
+    # Store the piece first. If the same piece is already there from an attempt
+    # that died before the counter below moved, the unique index says so and the
+    # stored copy is used.
+    try:
+        MeditationUploadChunk(upload=upload.id, offset=offset, data=data).save()
+    except mongoengine.errors.NotUniqueError:
+        pass
+
+    # only move the counter if nobody else moved it first
+    moved = MeditationUpload.objects(id=upload.id, received=offset).update_one(
+        set__received=end,
+        set__modify_date=dt.datetime.utcnow(),
+    )
+    upload.reload()
+    return bool(moved) or upload.received >= end, upload.received
+
+
+def finishUpload(upload, fileProxy):
+    # Copy the pieces, in order, into the GridFS file behind fileProxy (for
+    # example newMeditation.meditationfile) and then delete them. Only a couple of
+    # pieces are fetched from MongoDB at a time.
+    chunks = MeditationUploadChunk.objects(upload=upload.id).order_by('offset').batch_size(2)
+
+    fileProxy.new_file(content_type=upload.content_type)
+    written = 0
+    for chunk in chunks:
+        if chunk.offset != written:
+            fileProxy.close()
+            fileProxy.delete()
+            raise ValueError(f"upload {upload.id} is missing bytes {written}-{chunk.offset}")
+        fileProxy.write(chunk.data)
+        written += len(chunk.data)
+    fileProxy.close()
+    if written != upload.received:
+        fileProxy.delete()
+        raise ValueError(f"upload {upload.id} has {written} of {upload.received} bytes")
+
+    MeditationUploadChunk.objects(upload=upload.id).delete()
+    upload.delete()
+    return written
@@ -0,0 +1,52 @@
+# Keeps logged in users in memory so Flask-Login doesn't have to load the User
+# from MongoDB on every request.
+#
+# Entries only live for USER_CACHE_TTL seconds. Anything that changes a user calls
+# invalidateUser(), which also moves the user's page cache generation forward
+# (see app/utils/pagecache.py). Entries are kept under that generation, so with the
+# shared page cache backend every worker process sees the change at once. Only the
+# fields in USER_CACHE_FIELDS are loaded (set it to None to load the whole
+# document). Routes that need anything else should load the user themselves.
+#
+# sleep_version is left out on purpose: things versioned on it must read it from
+# the database with sleepVersion(), never from a copy that may be out of date.
+#
+# The cache holds the raw document and every call gets a new User made from it, so
+# requests on different threads never share or change the same object.
+
+from app import app
+from app.classes.data import User
+from app.utils.cache import LRUCache
+from app.utils.pagecache import invalidateUserPages, userPagesGeneration
+
+app.config.setdefault('USER_CACHE_TTL', 30)
+app.config.setdefault('USER_CACHE_SIZE', 1024)
+# the fields the templates and routes read from current_user
+app.config.setdefault('USER_CACHE_FIELDS', (
+    'role', 'gname', 'fname', 'lname', 'email', 'image',
+    'consent', 'adult_fname', 'adult_lname', 'adult_email',
+))
+
+userCache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+
+def cachedUser(userId):
+    # raises mongoengine's DoesNotExist like User.objects.get does
+    userId = str(userId)
+    fields = app.config['USER_CACHE_FIELDS']
+    key = (userId, userPagesGeneration(userId))
+    son = userCache.get(key)
+    if son is None:
+        query = User.objects
+        if fields:
+            query = query.only(*fields)
+        son = query.get(pk=userId).to_mongo()
+        userCache.set(key, son)
+    return User._from_son(son, only_fields=list(fields or []))
+
+
+def invalidateUser(userId):
+    userId = str(userId)
+    userCache.popWhere(lambda key: key[0] == userId)
+    # cached pages show the user's name and role in the navbar
+    invalidateUserPages(userId)
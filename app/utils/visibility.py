@@ -0,0 +1,27 @@
+# Who can see whose sleeps, emojis and meditations depends on each user's consent,
+# adult_email and role (see visibleOwners in data.py). When any of those change,
+# call visibilityChanged(userId) so nothing cached keeps showing (or hiding) their
+# records: the cached pages, the emoji timelines, the school analytics and the
+# user's row on the teacher dashboard.
+#
+# The timelines and the school analytics are kept in each worker, so their keys
+# carry visibilityGeneration() from the page cache. With the filesystem backend
+# the other workers see the new generation and stop using their old entries too.
+
+from app.classes.data import CohortSleep
+from app.utils.emojitimeline import timelineCache
+from app.utils.pagecache import invalidateVisibility
+from app.utils.sleepanalytics import analyticsCache
+from app.utils.usercache import invalidateUser
+
+
+def visibilityChanged(userId):
+    invalidateUser(userId)
+    # every cached page misses, including the sleep, emoji and meditation lists
+    invalidateVisibility()
+    # old entries can't be reached any more; this just frees them in this worker
+    timelineCache.clear()
+    analyticsCache.popWhere(lambda key: key[0] == 'school')
+    # the dashboard only shows rows for students who still consent, so dropping
+    # the row is enough; it comes back with the next 'flask cohort build'
+    CohortSleep.objects(id=userId).delete()
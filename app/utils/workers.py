@@ -0,0 +1,30 @@
+# Things each worker process has to make for itself.
+#
+# Gunicorn imports the app once and then forks the workers. Threads don't survive
+# a fork and a connection pool can't be shared with a forked process, so thread
+# pools, background threads and HTTP sessions are made the first time they are
+# used in each process:
+#
+#     executor = processLocal(lambda: ThreadPoolExecutor(max_workers=1))
+#     executor().submit(work)
+#
+# executor() calls the factory once per process and hands back the same object
+# after that.
+
+import os
+from threading import Lock
+
+
+def processLocal(factory):
+    lock = Lock()
+    made = {}
+
+    def get():
+        pid = os.getpid()
+        with lock:
+            if made.get('pid') != pid:
+                made['value'] = factory()
+                made['pid'] = pid
+            return made['value']
+
+    return get
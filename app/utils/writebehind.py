@@ -0,0 +1,183 @@
+# Write-behind for Emoji check-ins.
+#
+# When a whole class checks in at once, saving every emoji on its own means
+# hundreds of single inserts in a few seconds. With EMOJI_WRITE_BEHIND turned on,
+# emojiNew() hands the new Emoji to a buffer in the worker process instead. The
+# buffer writes everything it holds with one insert_many when it reaches
+# EMOJI_BUFFER_SIZE documents or when EMOJI_FLUSH_INTERVAL seconds have passed,
+# whichever comes first, and once more when the process exits.
+#
+# Each emoji gets its ObjectId before it is buffered, so the user can be sent to
+# /emoji/<id> straight away. emoji() looks in the buffer (and, in case the next
+# request lands on another worker process, in the user's session) before
+# MongoDB, so the person who checked in always sees their emoji.
+#
+# Off by default: a worker that is killed outright (not shut down) loses whatever
+# it has not flushed yet, at most one interval's worth.
+
+import atexit
+import datetime as dt
+from threading import Event, Lock, Thread
+
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+from flask import session
+
+from app import app
+from app.classes.data import Emoji, visibleOwners
+from app.utils.pagecache import invalidate
+from app.utils.emojitimeline import invalidateEmojiTimeline
+from app.utils.workers import processLocal
+
+app.config.setdefault('EMOJI_WRITE_BEHIND', False)
+app.config.setdefault('EMOJI_BUFFER_SIZE', 200)
+app.config.setdefault('EMOJI_FLUSH_INTERVAL', 1.0)
+
+DUPLICATE_KEY = 11000
+
+
+class WriteBehindBuffer:
+    def __init__(self, document, maxSize, interval, onFlush=None):
+        self.document = document
+        self.maxSize = maxSize
+        self.interval = interval
+        # called with the documents once they are in MongoDB
+        self.onFlush = onFlush
+        self.pending = {}
+        self.lock = Lock()
+        # only one insert_many at a time so a retry can't overtake the first try
+        self.flushLock = Lock()
+        self.wake = Event()
+        # threads don't survive a fork, so each worker process starts its own
+        self.start = processLocal(self.startWriter)
+
+    def startWriter(self):
+        with self.lock:
+            self.pending = {}
+        Thread(target=self.run, name=f'{self.document.__name__}-writer', daemon=True).start()
+
+    def add(self, doc):
+        if doc.id is None:
+            doc.id = ObjectId()
+        doc.validate()
+        self.start()
+        with self.lock:
+            self.pending[doc.id] = doc
+            full = len(self.pending) >= self.maxSize
+        if full:
+            self.wake.set()
+        return doc
+
+    def get(self, docId):
+        try:
+            docId = ObjectId(str(docId))
+        except Exception:
+            return None
+        with self.lock:
+            return self.pending.get(docId)
+
+    def flush(self):
+        with self.flushLock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            docs = [doc.to_mongo().to_dict() for doc in batch.values()]
+            try:
+                self.document._get_collection().insert_many(docs, ordered=False)
+            except BulkWriteError as error:
+                # a duplicate means an earlier try got through after all
+                for problem in error.details['writeErrors']:
+                    if problem['code'] != DUPLICATE_KEY:
+                        app.logger.error(f"could not save buffered {self.document.__name__}: {problem['errmsg']}")
+            except ConnectionFailure:
+                # keep them for the next flush; newer documents win if ids clash
+                app.logger.exception(f"could not flush {len(batch)} buffered {self.document.__name__}(s)")
+                with self.lock:
+                    batch.update(self.pending)
+                    self.pending = batch
+                return 0
+            if self.onFlush:
+                self.onFlush(list(batch.values()))
+            return len(docs)
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception(f"{self.document.__name__} writer crashed while flushing")
+
+
+def emojisWritten(emojis):
+    # Pages and timelines rendered while these were in the buffer don't have them,
+    # so they have to go now that the emojis can be read back.
+    invalidate('emoji')
+    for authorId in {getattr(emoji._data.get('author'), 'id', emoji._data.get('author')) for emoji in emojis}:
+        invalidateEmojiTimeline(authorId)
+
+
+emojiBuffer = WriteBehindBuffer(Emoji, app.config['EMOJI_BUFFER_SIZE'], app.config['EMOJI_FLUSH_INTERVAL'],
+                                onFlush=emojisWritten)
+
+
+def saveEmoji(emoji):
+    # emoji.save(), or into the buffer when write-behind is on
+    if not app.config['EMOJI_WRITE_BEHIND']:
+        return emoji.save()
+    emojiBuffer.add(emoji)
+    # a copy for the user's next request in case it goes to another worker process
+    session['pendingEmoji'] = {
+        'id': str(emoji.id),
+        'emote': emoji.emote,
+        'location': emoji.location,
+        'create_date': emoji.create_date.isoformat(),
+    }
+    return emoji
+
+
+def bufferedEmoji(emojiId, viewer):
+    # the emoji if it is still in this process's buffer and the viewer may see it
+    emoji = emojiBuffer.get(emojiId)
+    if emoji is None:
+        return None
+    author = emoji._data.get('author')
+    authorId = getattr(author, 'id', author)
+    return emoji if authorId in visibleOwners(viewer) else None
+
+
+def sessionEmoji(emojiId, viewer):
+    # the copy saveEmoji() left in the session, for when the emoji was buffered by
+    # another worker process that hasn't flushed yet
+    saved = session.get('pendingEmoji')
+    if not saved or saved['id'] != str(emojiId):
+        return None
+    return Emoji(
+        id=ObjectId(saved['id']),
+        author=viewer.id,
+        emote=saved['emote'],
+        location=saved['location'],
+        create_date=dt.datetime.fromisoformat(saved['create_date']),
+    )
+
+
+def forgetSessionEmoji(emojiId):
+    saved = session.get('pendingEmoji')
+    if saved and saved['id'] == str(emojiId):
+        session.pop('pendingEmoji')
+
+
+def flushEmojis():
+    return emojiBuffer.flush()
+
+
+def flushIfPending(emojiId):
+    # an edit or delete of an emoji that is still in the buffer has to wait for it
+    if emojiBuffer.get(emojiId) is not None:
+        emojiBuffer.flush()
+
+
+atexit.register(flushEmojis)
@@ -0,0 +1,191 @@
+# Requests per second against the number of Gunicorn workers.
+#
+#     python benchmark.py --workers 1 --workers 2 --workers 4 --workers 8 --as student@example.com
+#
+# For each worker count this starts Gunicorn with gunicorn.conf.py on a local port,
+# waits for it to answer, sends requests from --clients threads for --seconds and
+# then stops it with SIGTERM (the same graceful shutdown as a deploy). It prints
+# one row per worker count. Use --url to measure a server that is already running
+# instead.
+#
+# Anonymous pages like / and /aboutme come straight out of the page cache and never
+# touch MongoDB, so on their own they only measure Flask and Gunicorn. With --as
+# EMAIL the requests are logged in as that user and go to /emojis, /sleeps and
+# /sleep/stats. The sleep stats are an aggregation run on every request. Add
+# --no-page-cache to make the list pages query MongoDB every time too.
+#
+# Logging in works by signing a session cookie with FLASK_SECRET_KEY, so this
+# imports the app (and connects to the database in secrets.py) to look the user
+# up. The Gunicorn it starts gets the same key. With --url the server has to have
+# been started with the FLASK_SECRET_KEY that is set here.
+#
+# Run it on the machine (and against the database) you care about; numbers from a
+# laptop talking to a remote cluster mostly measure the network.
+
+import http.client
+import os
+import secrets
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+import click
+
+
+def waitForServer(host, port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def sessionCookie(email):
+    # a signed Flask session for the user, the same as logging in with Google would make
+    os.environ.setdefault('FLASK_SECRET_KEY', secrets.token_hex(32))
+    from flask_login.utils import _create_identifier
+    from app import app
+    from app.classes.data import User
+
+    user = User.objects.get(email=email)
+    # Flask-Login ties the session to the client's address and User-Agent, and
+    # http.client sends no User-Agent
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '127.0.0.1'}):
+        identifier = _create_identifier()
+    session = {'_user_id': str(user.id), '_fresh': True, '_id': identifier}
+    value = app.session_interface.get_signing_serializer(app).dumps(session)
+    return f'{app.session_cookie_name}={value}'
+
+
+def load(host, port, paths, clients, seconds, headers=None):
+    # every client thread keeps one connection open and sends requests one after
+    # another, the way a browser with keep-alive would
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = time.time() + seconds
+
+    def client(number):
+        connection = http.client.HTTPConnection(host, port, timeout=30)
+        mine, failed, request = [], 0, number
+        while time.time() < stop:
+            path = paths[request % len(paths)]
+            request += 1
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                # a redirect here means the login didn't work
+                if response.status >= 300:
+                    failed += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=30)
+                continue
+            mine.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed,
+        'p50': statistics.median(latencies) * 1000 if latencies else None,
+        'p95': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+    }
+
+
+def startGunicorn(workers, threads, port, pageCache=True):
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads),
+               GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_LOGLEVEL='warning')
+    if not pageCache:
+        env['PAGE_CACHE_ENABLED'] = '0'
+    # no access log, writing it would be part of what gets measured
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'wsgi:app'],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+
+def stopGunicorn(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def row(label, result):
+    p50 = f"{result['p50']:.1f}" if result['p50'] is not None else '-'
+    p95 = f"{result['p95']:.1f}" if result['p95'] is not None else '-'
+    return f"{label:>8} {result['rps']:>10.1f} {p50:>9} {p95:>9} {result['requests']:>9} {result['errors']:>7}"
+
+
+@click.command()
+@click.option('--workers', multiple=True, type=int, help="Worker counts to try (repeat it). Default: 1 2 4 and 2 x CPUs + 1.")
+@click.option('--threads', default=4, show_default=True, help="Threads in each worker.")
+@click.option('--path', 'paths', multiple=True,
+              help="Paths to request in turn (repeat it). Default: / or, with --as, /emojis /sleeps /sleep/stats")
+@click.option('--as', 'email', help="Email of a user to make the requests as.")
+@click.option('--no-page-cache', is_flag=True, help="Turn the page cache off in the Gunicorn it starts.")
+@click.option('--clients', default=32, show_default=True, help="Requests in flight at once.")
+@click.option('--seconds', default=20, show_default=True, help="How long to measure each worker count.")
+@click.option('--warmup', default=3, show_default=True, help="Seconds of requests before measuring.")
+@click.option('--port', default=8765, show_default=True, help="Local port for the Gunicorn it starts.")
+@click.option('--url', help="Measure this running server instead of starting Gunicorn.")
+def benchmark(workers, threads, paths, email, no_page_cache, clients, seconds, warmup, port, url):
+    """Measure requests per second for different numbers of Gunicorn workers."""
+    headers = {}
+    if email:
+        headers['Cookie'] = sessionCookie(email)
+        paths = list(paths) or ['/emojis', '/sleeps', '/sleep/stats']
+    else:
+        paths = list(paths) or ['/']
+    click.echo(f"{'workers':>8} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'requests':>9} {'errors':>7}")
+
+    if url:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or 80
+        if warmup:
+            load(host, port, paths, clients, warmup, headers)
+        click.echo(row('-', load(host, port, paths, clients, seconds, headers)))
+        return
+
+    counts = workers or sorted({1, 2, 4, os.cpu_count() * 2 + 1})
+    for count in counts:
+        server = startGunicorn(count, threads, port, pageCache=not no_page_cache)
+        try:
+            if not waitForServer('127.0.0.1', port, timeout=60):
+                raise click.ClickException(f"Gunicorn with {count} worker(s) did not start")
+            if warmup:
+                # fills the page cache and opens every worker's MongoDB connections
+                load('127.0.0.1', port, paths, clients, warmup, headers)
+            click.echo(row(str(count), load('127.0.0.1', port, paths, clients, seconds, headers)))
+        finally:
+            stopGunicorn(server)
+
+
+if __name__ == '__main__':
+    benchmark()
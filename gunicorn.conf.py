@@ -0,0 +1,67 @@
+# Gunicorn settings for production:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:app
+#
+# The app is loaded once in the master process and then forked into the workers,
+# so the import, the index check and the template setup only happen once. Each
+# worker runs a few threads, which keeps it busy while it waits on MongoDB.
+#
+# MongoClient can't be shared across a fork, so the master drops its connection
+# once the app is loaded and every worker opens its own in post_fork. On shutdown
+# (SIGTERM, or a worker reaching max_requests) a worker stops taking requests,
+# finishes the ones it has, writes out buffered emojis and lets running geocode
+# jobs finish before it exits.
+#
+# Most settings can be changed with environment variables, e.g.
+#     WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py wsgi:app
+
+import multiprocessing
+import os
+
+# Cached pages have to be shared by the workers, or a worker that didn't handle a
+# save keeps showing the old list. This is read when the app is loaded.
+os.environ.setdefault('PAGE_CACHE_BACKEND', 'filesystem')
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+
+# a request that takes longer than this gets its worker restarted
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# how long a worker gets to finish its requests after being told to stop
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# restart workers now and then so a slow leak can't grow forever
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
+
+# only when Gunicorn faces browsers itself instead of sitting behind a proxy
+certfile = os.environ.get('GUNICORN_CERTFILE')
+keyfile = os.environ.get('GUNICORN_KEYFILE')
+
+
+def when_ready(server):
+    # the master never talks to MongoDB again after loading the app
+    from mongoengine import disconnect
+    disconnect()
+
+
+def post_fork(server, worker):
+    from app import connectDb
+    connectDb()
+    server.log.info(f"worker {worker.pid} connected to MongoDB")
+
+
+def worker_exit(server, worker):
+    from app.utils.writebehind import flushEmojis
+    from app.utils.geocode import worker as geocodeWorker
+    flushed = flushEmojis()
+    if flushed:
+        server.log.info(f"worker {worker.pid} wrote {flushed} buffered emoji(s)")
+    geocodeWorker.stop()
@@ -5,6 +5,9 @@ import os
 if __name__ == "__main__":
     
     os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
-    
+
+    # The development server only. Set FLASK_DEBUG=1 to get the debugger and the
+    # reloader. In production run wsgi.py with Gunicorn (see gunicorn.conf.py).
+    debug = os.environ.get('FLASK_DEBUG') == '1'
     # app.run(debug="True", ssl_context='adhoc')
-    app.run(debug="True",use_reloader=True, ssl_context=('cert.pem', 'key.pem'))
\ No newline at end of file
+    app.run(debug=debug, use_reloader=debug, ssl_context=('cert.pem', 'key.pem'))
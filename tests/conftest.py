@@ -0,0 +1,112 @@
+# The tests run the app against a MongoDB server they are allowed to fill and
+# drop. Point MONGO_TEST_HOST at one and run them from the top folder:
+#
+#     MONGO_TEST_HOST=mongodb://localhost:27017 python -m pytest tests
+#
+# Without MONGO_TEST_HOST they run against mongomock, an in-memory imitation of
+# MongoDB, and the tests that count the commands sent to the server are skipped.
+# The app's own secrets.py is never read, so the tests can't touch the real
+# database; they use a new database each run.
+
+import os
+import sys
+import threading
+import types
+import uuid
+
+import pytest
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+TEST_HOST = os.environ.get('MONGO_TEST_HOST')
+MOCK_HOST = 'mongomock://localhost'
+TEST_DB = f'test-{uuid.uuid4().hex[:12]}'
+
+
+class CommandCounter(monitoring.CommandListener):
+    # Records the commands sent by the thread that is counting, so the app's
+    # background threads (geocoding, write-behind) don't get mixed in.
+    def __init__(self):
+        self.thread = None
+        self.commands = []
+
+    def start(self):
+        self.commands = []
+        self.thread = threading.get_ident()
+
+    def stop(self):
+        self.thread = None
+        return self.commands
+
+    def started(self, event):
+        if threading.get_ident() == self.thread:
+            self.commands.append((event.command_name, event.command.get(event.command_name)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+commandCounter = CommandCounter()
+
+
+def testSecrets():
+    return {
+        'MONGO_DB_NAME': TEST_DB,
+        'MONGO_HOST': TEST_HOST or MOCK_HOST,
+        'MONGO_TLS': False,
+        'GOOGLE_CLIENT_ID': 'test',
+        'GOOGLE_CLIENT_SECRET': 'test',
+        # nothing listens here, so logging in is never attempted for real
+        'GOOGLE_DISCOVERY_URL': 'http://127.0.0.1:9/',
+        'MY_EMAIL_ADDRESS': 'test@example.com',
+    }
+
+
+@pytest.fixture(scope='session')
+def app():
+    if TEST_HOST:
+        try:
+            MongoClient(TEST_HOST, serverSelectionTimeoutMS=2000).admin.command('ping')
+        except PyMongoError as error:
+            pytest.skip(f"can't reach MongoDB at {TEST_HOST}: {error}")
+        # listeners only hear clients made after they are registered, so before the app connects
+        monitoring.register(commandCounter)
+    else:
+        # GridFS (profile pictures, recordings) only works on mongomock once this is on
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+    secretsModule = types.ModuleType('app.utils.secrets')
+    secretsModule.getSecrets = testSecrets
+    sys.modules['app.utils.secrets'] = secretsModule
+
+    from app import app
+    from app.utils.geocode import StubGeocoder, setGeocoder, worker
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, PAGE_CACHE_ENABLED=False)
+    # Nothing is looked up on the internet, and geocode jobs are only run by the
+    # tests that want them run, never by the app's background dispatcher.
+    setGeocoder(StubGeocoder())
+    worker.start = lambda: None
+    yield app
+    if TEST_HOST:
+        MongoClient(TEST_HOST).drop_database(TEST_DB)
+
+
+@pytest.fixture
+def realMongo(app):
+    # mongomock sends no commands, so there is nothing to count
+    if not TEST_HOST:
+        pytest.skip("set MONGO_TEST_HOST to count the commands sent to MongoDB")
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def logIn(client, user):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
@@ -0,0 +1,70 @@
+# LRUCache in app/utils/cache.py: least recently used entries go first, and
+# entries with a ttl are gone once it has passed.
+
+import pytest
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    from app.utils import cache
+
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def testLeastRecentlyUsedGoesFirst(app):
+    from app.utils.cache import LRUCache
+
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    # reading 'a' makes 'b' the oldest
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def testSettingAgainMovesToTheEnd(app):
+    from app.utils.cache import LRUCache
+
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('a', 10)
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 10
+
+
+def testEntriesExpire(app, clock):
+    from app.utils.cache import LRUCache
+
+    cache = LRUCache(maxsize=10, ttl=60)
+    cache.set('default', 1)
+    cache.set('short', 2, ttl=5)
+    cache.set('kept', 3)
+    clock[0] += 5
+    assert cache.get('short') is None
+    assert cache.get('default') == 1
+    clock[0] += 55
+    assert cache.get('default', 'gone') == 'gone'
+    # an expired entry is removed when it is read
+    assert 'default' not in cache
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def testPopWhere(app):
+    from app.utils.cache import LRUCache
+
+    cache = LRUCache()
+    for key in [('1', 1), ('1', 2), ('2', 1)]:
+        cache.set(key, True)
+    cache.popWhere(lambda key: key[0] == '1')
+    assert len(cache) == 1
+    assert ('2', 1) in cache
+    assert cache.pop(('2', 1)) is True
+    assert cache.pop(('2', 1), 'missing') == 'missing'
@@ -0,0 +1,207 @@
+# Geocoding clinics in the background (app/utils/geocode.py) with StubGeocoder
+# answering instead of Nominatim.
+
+import datetime as dt
+import time
+
+import pytest
+
+ADDRESS = ('1 Main Street', 'Oakland', 'CA', '94612')
+LAT_LON = (37.8, -122.27)
+
+
+@pytest.fixture
+def stub(app):
+    from app.classes.data import Clinic, GeocodeJob, GeocodeCache, RateGate
+    from app.utils.geocode import StubGeocoder, setGeocoder, localCache
+
+    for document in (Clinic, GeocodeJob, GeocodeCache, RateGate):
+        document.objects.delete()
+    localCache.clear()
+    geocoder = StubGeocoder({ADDRESS: LAT_LON})
+    setGeocoder(geocoder)
+    yield geocoder
+    setGeocoder(StubGeocoder())
+
+
+def newClinic(street=ADDRESS[0], city=ADDRESS[1], state=ADDRESS[2], zipcode=ADDRESS[3]):
+    from app.classes.data import Clinic
+
+    return Clinic(name='Clinic', streetAddress=street, city=city, state=state, zipcode=zipcode).save()
+
+
+def updateLatLon(app, clinic):
+    from flask import get_flashed_messages
+    from app.routes.clinic import updateLatLon
+
+    with app.test_request_context('/clinic/new', method='POST'):
+        updateLatLon(clinic)
+        return get_flashed_messages()
+
+
+def runDueJobs():
+    from app.utils.geocode import claimJob, runJob
+
+    ran = 0
+    job = claimJob()
+    while job is not None:
+        runJob(job)
+        ran += 1
+        job = claimJob()
+    return ran
+
+
+def testEditingTwiceQueuesOneJob(app, stub):
+    from app.classes.data import GeocodeJob
+
+    clinic = newClinic()
+    updateLatLon(app, clinic)
+    updateLatLon(app, clinic)
+    assert GeocodeJob.objects(clinic=clinic.id, status='pending').count() == 1
+    # nothing is looked up until the job runs
+    assert stub.calls == []
+
+    assert runDueJobs() == 1
+    clinic.reload()
+    assert (clinic.lat, clinic.lon) == LAT_LON
+    assert clinic.location['coordinates'] == [LAT_LON[1], LAT_LON[0]]
+    assert GeocodeJob.objects(clinic=clinic.id).get().status == 'done'
+
+
+def testImportSkipsClinicsThatAlreadyHaveAJob(app, stub):
+    from app.classes.data import GeocodeJob
+    from app.utils.geocode import geocodeMany
+
+    clinics = [newClinic(), newClinic(street='2 Main St')]
+    updateLatLon(app, clinics[0])
+    assert geocodeMany(clinics) == (0, 1)
+    assert GeocodeJob.objects(status='pending').count() == 2
+
+
+def testSameAddressIsOnlyLookedUpOnce(app, stub):
+    from app.classes.data import GeocodeCache
+
+    first = newClinic()
+    # spelled differently, but the same address once normalized
+    second = newClinic(street='1 main st.', city='OAKLAND', zipcode='94612-1234')
+    updateLatLon(app, first)
+    updateLatLon(app, second)
+    assert runDueJobs() == 2
+    assert stub.calls == [ADDRESS]
+    assert GeocodeCache.objects.count() == 1
+    second.reload()
+    assert (second.lat, second.lon) == LAT_LON
+
+    # from now on the cache answers straight away and no job is needed
+    third = newClinic(street='1 Main Street ')
+    assert updateLatLon(app, third) == ["clinic lat/lon updated"]
+    third.reload()
+    assert (third.lat, third.lon) == LAT_LON
+    assert stub.calls == [ADDRESS]
+
+
+def testAddressThatIsNotFound(app, stub):
+    from app.classes.data import GeocodeJob, GeocodeCache
+
+    clinic = newClinic(street='nowhere')
+    updateLatLon(app, clinic)
+    runDueJobs()
+    job = GeocodeJob.objects(clinic=clinic.id).get()
+    assert (job.status, job.last_error) == ('done', 'address not found')
+    assert GeocodeCache.objects.get().found is False
+    # remembered, so it isn't asked again
+    assert updateLatLon(app, clinic) == ['unable to retrieve lat/lon']
+    assert len(stub.calls) == 1
+
+
+def testFailuresAreTriedAgainLater(app, stub):
+    from app.classes.data import GeocodeJob
+    from app.utils.geocode import GeocodeError, RETRY_DELAY, MAX_ATTEMPTS, claimJob, runJob, setGeocoder
+
+    class BrokenGeocoder:
+        def geocode(self, street, city, state, zipcode):
+            raise GeocodeError('timed out')
+
+    setGeocoder(BrokenGeocoder())
+    clinic = newClinic()
+    updateLatLon(app, clinic)
+
+    before = dt.datetime.utcnow()
+    runJob(claimJob())
+    job = GeocodeJob.objects(clinic=clinic.id).get()
+    assert (job.status, job.attempts, job.last_error) == ('pending', 1, 'timed out')
+    assert job.next_run >= before + dt.timedelta(seconds=RETRY_DELAY) - dt.timedelta(seconds=1)
+    # not due yet
+    assert claimJob() is None
+
+    for attempt in range(2, MAX_ATTEMPTS + 1):
+        job.update(set__next_run=dt.datetime.utcnow())
+        runJob(claimJob())
+        job.reload()
+        assert job.attempts == attempt
+    assert job.status == 'failed'
+
+
+def testJobsLeftByACrashedWorkerAreTakenAgain(app, stub):
+    from app.classes.data import GeocodeJob
+    from app.utils.geocode import claimJob, runJob
+
+    now = dt.datetime.utcnow()
+    crashed = GeocodeJob(clinic=newClinic().id, status='running', lease_until=now - dt.timedelta(seconds=1)).save()
+    # another worker is still busy with this one
+    GeocodeJob(clinic=newClinic().id, status='running', lease_until=now + dt.timedelta(minutes=1)).save()
+
+    job = claimJob()
+    assert job.id == crashed.id
+    assert job.lease_until > now
+    assert claimJob() is None
+
+    runJob(job)
+    assert GeocodeJob.objects(id=crashed.id).get().status == 'done'
+
+
+def testImportRunTwiceQueuesEachClinicOnce(app, stub):
+    # an import that stopped part way is run again over the same clinics
+    from app.classes.data import GeocodeJob
+    from app.utils.geocode import geocodeMany, pendingJobs
+
+    clinics = [newClinic(), newClinic(street='nowhere')]
+    assert geocodeMany(clinics) == (0, 2)
+    assert geocodeMany(clinics) == (0, 0)
+    assert pendingJobs([clinic.id for clinic in clinics]) == 2
+    runDueJobs()
+    assert pendingJobs([clinic.id for clinic in clinics]) == 0
+    assert GeocodeJob.objects(status='done').count() == 2
+
+
+def testRateGateSpacesOutRequests(app, stub):
+    from app.utils.geocode import SharedRateLimiter
+
+    gate = SharedRateLimiter('test', 0.2)
+    started = time.monotonic()
+    for _ in range(3):
+        gate.wait()
+    # the first goes straight through, the next two each wait their turn
+    assert time.monotonic() - started >= 0.35
+
+
+def testWorkerRunsQueuedJobs(app, stub):
+    from app.classes.data import GeocodeJob
+    from app.utils.geocode import GeocodeWorker
+
+    clinics = [newClinic(), newClinic(street='nowhere')]
+    for clinic in clinics:
+        updateLatLon(app, clinic)
+
+    worker = GeocodeWorker(threads=1)
+    worker.start()
+    worker.notify()
+    try:
+        deadline = time.monotonic() + 10
+        while GeocodeJob.objects(status__in=['pending', 'running']).count() and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        worker.stop()
+    assert GeocodeJob.objects(status='done').count() == 2
+    clinics[0].reload()
+    assert (clinics[0].lat, clinics[0].lon) == LAT_LON
@@ -0,0 +1,86 @@
+# Range requests against gridFileResponse (app/utils/gridfsstream.py). The
+# recording here is a plain object with the parts of GridOut that are used, so no
+# database is needed.
+
+import datetime as dt
+from io import BytesIO
+
+import pytest
+
+DATA = bytes(range(256)) * 4
+
+
+class StoredFile(BytesIO):
+    length = len(DATA)
+    content_type = 'audio/ogg'
+    filename = 'meditation.ogg'
+    upload_date = dt.datetime(2024, 1, 1, 12, 0, 0, 500000)
+
+    def __init__(self):
+        super().__init__(DATA)
+
+
+class Proxy:
+    grid_id = 'recording-1'
+
+    def get(self):
+        return StoredFile()
+
+
+def fetch(app, headers=None):
+    from app.utils.gridfsstream import gridFileResponse
+
+    with app.test_request_context('/recording', headers=headers or {}):
+        response = gridFileResponse(Proxy())
+        response.direct_passthrough = False
+        return response.status_code, response.headers, response.get_data()
+
+
+def testWholeFile(app):
+    status, headers, body = fetch(app)
+    assert status == 200
+    assert body == DATA
+    assert headers['Accept-Ranges'] == 'bytes'
+    assert headers['Content-Type'] == 'audio/ogg'
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=0-99', 0, 100),
+    # open ended: from 1000 to the end
+    ('bytes=1000-', 1000, len(DATA)),
+    # suffix: the last 24 bytes
+    ('bytes=-24', len(DATA) - 24, len(DATA)),
+    # past the end is cut down to the end
+    ('bytes=1020-5000', 1020, len(DATA)),
+])
+def testRanges(app, header, start, stop):
+    status, headers, body = fetch(app, {'Range': header})
+    assert status == 206
+    assert body == DATA[start:stop]
+    assert headers['Content-Range'] == f'bytes {start}-{stop - 1}/{len(DATA)}'
+    assert int(headers['Content-Length']) == stop - start
+
+
+def testUnsatisfiableRange(app):
+    status, headers, body = fetch(app, {'Range': f'bytes={len(DATA)}-'})
+    assert status == 416
+    assert headers['Content-Range'] == f'bytes */{len(DATA)}'
+    assert body == b''
+
+
+def testIfRangeWithAnOldEtagSendsTheWholeFile(app):
+    status, headers, body = fetch(app, {'Range': 'bytes=0-9', 'If-Range': '"an-older-file"'})
+    assert status == 200
+    assert body == DATA
+
+
+def testIfRangeWithTheCurrentEtag(app):
+    status, headers, body = fetch(app, {'Range': 'bytes=0-9', 'If-Range': '"recording-1"'})
+    assert status == 206
+    assert body == DATA[:10]
+
+
+def testNotModified(app):
+    status, headers, body = fetch(app, {'If-None-Match': '"recording-1"'})
+    assert status == 304
+    assert body == b''
@@ -0,0 +1,134 @@
+# Logging in with Google (app/routes/login.py and app/utils/oauth.py) against a
+# fake identity provider: the real OAuthProvider, with an HTTP session that
+# answers from a dict instead of the network.
+
+import json
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+DISCOVERY_URL = 'https://accounts.example.com/.well-known/openid-configuration'
+DISCOVERY = {
+    'authorization_endpoint': 'https://accounts.example.com/auth',
+    'token_endpoint': 'https://accounts.example.com/token',
+    'userinfo_endpoint': 'https://accounts.example.com/userinfo',
+}
+PROFILE = {
+    'sub': '1234',
+    'email': 'new.student@example.com',
+    'email_verified': True,
+    'name': 'New Student',
+    'given_name': 'New',
+    'family_name': 'Student',
+    'picture': 'https://example.com/picture.jpg',
+}
+
+
+class FakeResponse:
+    def __init__(self, body, headers=None):
+        self.text = json.dumps(body)
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeIdentityProvider:
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(('GET', url))
+        if url == DISCOVERY_URL:
+            return FakeResponse(DISCOVERY, {'Cache-Control': 'public, max-age=3600'})
+        if url == DISCOVERY['userinfo_endpoint']:
+            assert kwargs['headers']['Authorization'] == 'Bearer fake-token'
+            return FakeResponse(PROFILE)
+        raise AssertionError(f"unexpected GET {url}")
+
+    def post(self, url, data=None, **kwargs):
+        self.requests.append(('POST', url))
+        assert url == DISCOVERY['token_endpoint']
+        assert 'code=the-code' in data
+        return FakeResponse({'access_token': 'fake-token', 'token_type': 'Bearer'})
+
+
+@pytest.fixture
+def identityProvider(app):
+    from app.classes.data import User
+    from app.utils.oauth import OAuthProvider, setProvider
+
+    User.objects.delete()
+    fake = FakeIdentityProvider()
+    setProvider(OAuthProvider(DISCOVERY_URL, 'client-id', 'client-secret', session=fake))
+    yield fake
+    setProvider(None)
+
+
+def startLogin(client):
+    response = client.get('/login', base_url='https://localhost')
+    assert response.status_code == 302
+    query = parse_qs(urlsplit(response.location).query)
+    assert query['redirect_uri'] == ['https://localhost/login/callback']
+    return query['state'][0]
+
+
+def testLoginMakesTheUserAndLogsThemIn(app, client, identityProvider):
+    from app.classes.data import User
+    from app.utils.usercache import userCache
+
+    state = startLogin(client)
+    response = client.get(f'/login/callback?code=the-code&state={state}', base_url='https://localhost')
+    assert response.status_code == 302
+    assert response.location.endswith('/myprofile')
+
+    user = User.objects.get(email=PROFILE['email'])
+    assert (user.gid, user.fname, user.lname) == ('1234', 'New', 'Student')
+    with client.session_transaction() as session:
+        assert session['_user_id'] == str(user.id)
+        # a state can only be used once
+        assert 'oauthState' not in session
+
+    # the discovery document was fetched once, then the code traded for a token
+    # and the token for the profile
+    assert identityProvider.requests == [
+        ('GET', DISCOVERY_URL),
+        ('POST', DISCOVERY['token_endpoint']),
+        ('GET', DISCOVERY['userinfo_endpoint']),
+    ]
+
+    assert client.get('/myprofile', base_url='https://localhost').status_code == 200
+    # the next requests find the user in the cache
+    assert any(key[0] == str(user.id) for key in userCache._data)
+
+
+def testDiscoveryIsCached(app, client, identityProvider):
+    startLogin(client)
+    startLogin(client)
+    assert identityProvider.requests == [('GET', DISCOVERY_URL)]
+
+
+def testCallbackWithTheWrongStateIsTurnedAway(app, client, identityProvider):
+    from app.classes.data import User
+
+    startLogin(client)
+    response = client.get('/login/callback?code=the-code&state=made-up', base_url='https://localhost')
+    assert response.status_code == 302
+    assert urlsplit(response.location).path == '/'
+    assert User.objects(email=PROFILE['email']).count() == 0
+    # the code was never traded for a token
+    assert ('POST', DISCOVERY['token_endpoint']) not in identityProvider.requests
+    with client.session_transaction() as session:
+        assert '_user_id' not in session
+        assert 'oauthState' not in session
+
+
+def testCallbackWithoutALoginIsTurnedAway(app, client, identityProvider):
+    from app.classes.data import User
+
+    response = client.get('/login/callback?code=the-code&state=anything', base_url='https://localhost')
+    assert response.status_code == 302
+    assert User.objects(email=PROFILE['email']).count() == 0
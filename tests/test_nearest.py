@@ -0,0 +1,48 @@
+# The k-d tree in app/utils/nearest.py has to give the same clinics, in the same
+# order, as measuring the distance to every one of them.
+
+import math
+import random
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    from app.utils.nearest import EARTH_RADIUS
+
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def testTreeMatchesBruteForce(app):
+    from app.utils.nearest import KDTree, unitVector, chordToMeters
+
+    generator = random.Random(5)
+    # bunched up like clinics in one city, plus a few anywhere on the globe
+    points = [(37.8 + generator.uniform(-0.3, 0.3), -122.2 + generator.uniform(-0.3, 0.3)) for _ in range(300)]
+    points += [(generator.uniform(-90, 90), generator.uniform(-180, 180)) for _ in range(50)]
+    tree = KDTree((unitVector(lat, lon), number) for number, (lat, lon) in enumerate(points))
+
+    for _ in range(50):
+        target = (37.8 + generator.uniform(-0.5, 0.5), -122.2 + generator.uniform(-0.5, 0.5))
+        for k in (1, 5, 20):
+            found = tree.nearest(unitVector(*target), k)
+            expected = sorted(range(len(points)), key=lambda number: haversine(*target, *points[number]))[:k]
+            assert [number for chord, number in found] == expected
+            for chord, number in found:
+                assert math.isclose(chordToMeters(chord), haversine(*target, *points[number]), rel_tol=1e-6)
+
+
+def testTreeAcrossTheDateLine(app):
+    from app.utils.nearest import KDTree, unitVector
+
+    points = {'west': (0, 179.9), 'east': (0, -179.9), 'far': (0, 170)}
+    tree = KDTree((unitVector(*point), name) for name, point in points.items())
+    assert [name for chord, name in tree.nearest(unitVector(0, 180), 2)] in (['west', 'east'], ['east', 'west'])
+
+
+def testFewerClinicsThanAskedFor(app):
+    from app.utils.nearest import KDTree, unitVector
+
+    tree = KDTree([(unitVector(10, 10), 'only')])
+    assert [name for chord, name in tree.nearest(unitVector(0, 0), 5)] == ['only']
+    assert KDTree([]).nearest(unitVector(0, 0), 5) == []
@@ -0,0 +1,79 @@
+# Keyset pagination (app/utils/pagination.py): cursors survive the round trip and
+# rows that share a sort value are neither skipped nor shown twice.
+
+import datetime as dt
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+
+@pytest.fixture
+def emojis(app):
+    from app.classes.data import User, Emoji
+
+    for document in (User, Emoji):
+        document.objects.delete()
+    author = User(fname='Page', lname='Test', email='pages@example.com').save()
+    # pairs of emojis saved at the same moment, so pages split ties
+    moment = dt.datetime(2024, 1, 1, 12, 0, 0, 123000)
+    return [
+        Emoji(author=author, emote='😀', create_date=moment + dt.timedelta(minutes=number // 2)).save()
+        for number in range(7)
+    ]
+
+
+def pageThrough(app, queryset, size, before=None, after=None):
+    from app.utils.pagination import paginate
+
+    args = {'size': size}
+    if before:
+        args['before'] = before
+    if after:
+        args['after'] = after
+    with app.test_request_context('/emojis', query_string=args):
+        return paginate(queryset, 'create_date')
+
+
+def testCursorRoundTrip(app, emojis):
+    from app.utils.pagination import encodeCursor, decodeCursor
+
+    emoji = emojis[0]
+    value, docId = decodeCursor(encodeCursor(emoji, 'create_date'))
+    assert value == emoji.create_date
+    assert docId == emoji.id
+
+
+def testBrokenCursorIsABadRequest(app):
+    from app.utils.pagination import decodeCursor
+
+    with pytest.raises(BadRequest):
+        decodeCursor('not a cursor')
+
+
+def testPagesSplitTies(app, emojis):
+    from app.classes.data import Emoji
+
+    seen = []
+    after = None
+    while True:
+        page = pageThrough(app, Emoji.objects, 2, after=after)
+        seen.extend(page.items)
+        if not page.nextCursor:
+            break
+        after = page.nextCursor
+
+    # newest first, and the later id first among emojis saved at the same moment
+    expected = sorted(emojis, key=lambda emoji: (emoji.create_date, emoji.id), reverse=True)
+    assert [emoji.id for emoji in seen] == [emoji.id for emoji in expected]
+
+
+def testPreviousPageComesBackInOrder(app, emojis):
+    from app.classes.data import Emoji
+
+    first = pageThrough(app, Emoji.objects, 3)
+    second = pageThrough(app, Emoji.objects, 3, after=first.nextCursor)
+    back = pageThrough(app, Emoji.objects, 3, before=second.prevCursor)
+    assert [emoji.id for emoji in back.items] == [emoji.id for emoji in first.items]
+    # the first page has nothing before it
+    assert back.prevCursor is None
+    assert back.nextCursor
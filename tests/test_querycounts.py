@@ -0,0 +1,51 @@
+# Every list page should cost two finds however many rows it shows: one for the
+# page itself and one for the users on it (see app/utils/prefetch.py).
+
+import datetime as dt
+
+import pytest
+
+from conftest import commandCounter, logIn
+
+
+@pytest.fixture
+def teacher(app):
+    from app.classes.data import User, Sleep, Emoji, Meditation
+
+    for document in (User, Sleep, Emoji, Meditation):
+        document.objects.delete()
+    teacher = User(role='Teacher', fname='Tea', lname='Cher', email='teacher@example.com').save()
+    students = [
+        User(role='Student', fname=f'Student{number}', lname='Test', email=f'student{number}@example.com',
+             consent=True).save()
+        for number in range(3)
+    ]
+    start = dt.datetime(2024, 1, 1, 22)
+    for number, author in enumerate([teacher] + students * 2):
+        night = start + dt.timedelta(days=number)
+        Emoji(author=author, emote='😀', location='home').save()
+        Sleep(sleeper=author, start=night, end=night + dt.timedelta(hours=8), sleep_date=night,
+              hours=8, rating=3).save()
+        Meditation(author=author, name='breathing', starttime=night, endtime=night + dt.timedelta(minutes=10)).save()
+    return teacher
+
+
+@pytest.mark.parametrize('path, collection', [
+    ('/emojis', 'emoji'),
+    ('/sleeps', 'sleep'),
+    ('/meditations', 'meditation'),
+])
+def testListPageFinds(realMongo, client, teacher, path, collection):
+    logIn(client, teacher)
+    # the first request loads the logged in user and runs the first-request hooks
+    assert client.get(path).status_code == 200
+
+    commandCounter.start()
+    response = client.get(path)
+    commands = commandCounter.stop()
+
+    assert response.status_code == 200
+    # all seven rows were shown, by four different authors
+    assert response.data.count(b'Student0') == 2
+    finds = [target for name, target in commands if name == 'find']
+    assert finds == [collection, 'user']
@@ -0,0 +1,88 @@
+# The SleepSummary kept up to date with $inc (app/utils/sleepsummary.py) has to
+# come out the same as working it out again from all of the user's sleeps.
+
+import datetime as dt
+
+import pytest
+
+
+@pytest.fixture
+def sleeper(app):
+    from app.classes.data import User, Sleep, SleepSummary
+
+    for document in (User, Sleep, SleepSummary):
+        document.objects.delete()
+    return User(fname='Sleepy', lname='Head', email='sleeper@example.com').save()
+
+
+def addSleep(sleeper, night, hours, rating):
+    from app.classes.data import Sleep
+    from app.utils.sleepsummary import summaryAdd
+
+    start = dt.datetime(2024, 1, 1, 22) + dt.timedelta(days=night)
+    sleep = Sleep(sleeper=sleeper, start=start, end=start + dt.timedelta(hours=hours), hours=hours,
+                  rating=rating).save()
+    summaryAdd(sleeper.id, sleep)
+    return sleep
+
+
+def counters(sleeperId):
+    from app.classes.data import SleepSummary
+
+    summary = SleepSummary._get_collection().find_one({'sleeper': sleeperId})
+    ratings = {rating: count for rating, count in summary['ratings'].items() if count}
+    return summary['count'], round(summary['total_hours'], 6), ratings
+
+
+def rebuilt(sleeperId):
+    from app.utils.sleepsummary import rebuildSummary
+
+    rebuildSummary(sleeperId)
+    return counters(sleeperId)
+
+
+def testAddChangeRemove(app, sleeper):
+    from app.utils.sleepsummary import recentEntry, summaryChange, summaryRemove
+
+    first = addSleep(sleeper, 0, 8, 3)
+    addSleep(sleeper, 1, 6.5, 4)
+    addSleep(sleeper, 2, 7, 3)
+    assert counters(sleeper.id) == (3, 21.5, {'3': 2, '4': 1})
+
+    before = recentEntry(first)
+    first.update(hours=9, rating=5)
+    first.reload()
+    summaryChange(sleeper.id, before, recentEntry(first))
+    assert counters(sleeper.id) == (3, 22.5, {'3': 1, '4': 1, '5': 1})
+
+    first.delete()
+    summaryRemove(sleeper.id, first)
+    assert counters(sleeper.id) == (2, 13.5, {'3': 1, '4': 1})
+    assert counters(sleeper.id) == rebuilt(sleeper.id)
+
+
+def testUnratedNightsOnlyCountHours(app, sleeper):
+    from app.utils.sleepsummary import recentEntry, summaryChange
+
+    sleep = addSleep(sleeper, 0, 8, None)
+    assert counters(sleeper.id) == (1, 8, {})
+    before = recentEntry(sleep)
+    sleep.update(rating=2)
+    sleep.reload()
+    summaryChange(sleeper.id, before, recentEntry(sleep))
+    assert counters(sleeper.id) == (1, 8, {'2': 1})
+    assert counters(sleeper.id) == rebuilt(sleeper.id)
+
+
+def testStatsFromTheSummary(app, sleeper):
+    from app.utils.sleepsummary import summaryStats
+
+    for night, (hours, rating) in enumerate([(8, 4), (6, 2), (7, 3)]):
+        addSleep(sleeper, night, hours, rating)
+    stats = summaryStats(sleeper.id, now=dt.datetime(2024, 1, 4, 9))
+    assert stats['count'] == 3
+    assert stats['meanHours'] == 7
+    assert stats['meanRating'] == 3
+    assert stats['hours7'] == 7
+    assert stats['currentStreak'] == 3
+    assert stats['longestStreak'] == 3
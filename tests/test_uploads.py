@@ -0,0 +1,80 @@
+# Resumable uploads (app/utils/uploads.py): a piece is only taken if it starts
+# where the last one ended, a piece sent twice is stored once, and the finished
+# file is the pieces in order.
+
+import pytest
+
+
+@pytest.fixture
+def upload(app):
+    from app.classes.data import User, MeditationUpload, MeditationUploadChunk
+    from app.utils.uploads import startUpload
+
+    for document in (User, MeditationUpload, MeditationUploadChunk):
+        document.objects.delete()
+    user = User(fname='Up', lname='Loader', email='uploader@example.com').save()
+    return startUpload(user, 'audio/webm')
+
+
+def testPiecesMustFollowOn(app, upload):
+    from app.utils.uploads import appendChunk
+
+    assert appendChunk(upload, 0, b'abc') == (True, 3)
+    # a gap, and an overlap that isn't a plain repeat, are both turned away
+    assert appendChunk(upload, 5, b'xyz') == (False, 3)
+    assert appendChunk(upload, 2, b'cdef') == (False, 3)
+    assert appendChunk(upload, 3, b'def') == (True, 6)
+
+
+def testRepeatedPieceIsStoredOnce(app, upload):
+    from app.classes.data import MeditationUploadChunk
+    from app.utils.uploads import appendChunk
+
+    appendChunk(upload, 0, b'abc')
+    # the browser never heard back, so it sends the same piece again
+    assert appendChunk(upload, 0, b'abc') == (True, 3)
+    assert MeditationUploadChunk.objects(upload=upload.id).count() == 1
+
+
+def testResumeAfterACrashBeforeTheCounterMoved(app, upload):
+    from app.classes.data import MeditationUploadChunk
+    from app.utils.uploads import appendChunk
+
+    # the piece got stored but the request died before 'received' was moved on
+    MeditationUploadChunk(upload=upload.id, offset=0, data=b'abc').save()
+    assert upload.received == 0
+    assert appendChunk(upload, 0, b'abc') == (True, 3)
+    assert MeditationUploadChunk.objects(upload=upload.id).count() == 1
+    assert appendChunk(upload, 3, b'def') == (True, 6)
+
+
+def testTooBig(app, upload, monkeypatch):
+    from app.utils import uploads
+
+    monkeypatch.setattr(uploads, 'MAX_UPLOAD_SIZE', 4)
+    assert uploads.appendChunk(upload, 0, b'abc') == (True, 3)
+    assert uploads.appendChunk(upload, 3, b'de') == (False, 3)
+
+
+def testFinishJoinsPiecesInOrder(app, upload):
+    from app.classes.data import Meditation, MeditationUpload, MeditationUploadChunk
+    from app.utils.uploads import appendChunk, finishUpload
+
+    for offset, piece in [(0, b'one '), (4, b'two '), (8, b'three')]:
+        appendChunk(upload, offset, piece)
+    meditation = Meditation(name='joined')
+    assert finishUpload(upload, meditation.meditationfile) == 13
+    assert meditation.meditationfile.read() == b'one two three'
+    assert MeditationUploadChunk.objects(upload=upload.id).count() == 0
+    assert MeditationUpload.objects(id=upload.id).count() == 0
+
+
+def testFinishRefusesMissingBytes(app, upload):
+    from app.classes.data import Meditation, MeditationUploadChunk
+    from app.utils.uploads import appendChunk, finishUpload
+
+    appendChunk(upload, 0, b'abc')
+    appendChunk(upload, 3, b'def')
+    MeditationUploadChunk.objects(upload=upload.id, offset=0).delete()
+    with pytest.raises(ValueError):
+        finishUpload(upload, Meditation(name='broken').meditationfile)
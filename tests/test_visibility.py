@@ -0,0 +1,51 @@
+# Changing consent, adult_email or role changes whose records other users may
+# see, so pages cached before the change must not be shown after it.
+
+import datetime as dt
+
+import pytest
+
+from conftest import logIn
+
+
+@pytest.fixture
+def cachedPages(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_CACHE_ENABLED', True)
+
+
+@pytest.fixture
+def classroom(app):
+    from app.classes.data import User, Sleep
+
+    for document in (User, Sleep):
+        document.objects.delete()
+    teacher = User(role='Teacher', fname='Tea', lname='Cher', email='teacher@example.com').save()
+    student = User(role='Student', fname='Consenting', lname='Student', email='student@example.com',
+                   consent=True).save()
+    night = dt.datetime(2024, 1, 1, 22)
+    Sleep(sleeper=student, start=night, end=night + dt.timedelta(hours=8), sleep_date=night,
+          hours=8, rating=3).save()
+    return teacher, student
+
+
+def testRevokedConsentHidesCachedSleeps(app, client, cachedPages, classroom):
+    teacher, student = classroom
+    logIn(client, teacher)
+    assert b'Consenting' in client.get('/sleeps').data
+    cached = client.get('/sleeps')
+    assert cached.headers['X-Cache'] == 'HIT'
+    assert b'Consenting' in cached.data
+
+    studentClient = app.test_client()
+    logIn(studentClient, student)
+    response = studentClient.post('/consent', data={
+        'consent': 'False',
+        'adult_fname': 'Grown',
+        'adult_lname': 'Up',
+        'adult_email': 'adult@example.com',
+    })
+    assert response.status_code == 302
+
+    after = client.get('/sleeps')
+    assert after.headers['X-Cache'] == 'MISS'
+    assert b'Consenting' not in after.data
@@ -0,0 +1,85 @@
+# WriteBehindBuffer (app/utils/writebehind.py): one insert_many per flush, in the
+# order the documents were added, and nothing lost when the database is away.
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+
+class Collection:
+    # records insert_many calls, and fails the ones it is told to
+    def __init__(self):
+        self.inserted = []
+        self.calls = 0
+        self.failures = 0
+
+    def insert_many(self, docs, ordered=True):
+        self.calls += 1
+        if self.failures:
+            self.failures -= 1
+            raise AutoReconnect('the database went away')
+        self.inserted.extend(doc['_id'] for doc in docs)
+
+
+@pytest.fixture
+def buffer(app):
+    from app.utils.writebehind import WriteBehindBuffer
+
+    collection = Collection()
+
+    class Emojis:
+        # the buffer only asks the document class for its name and collection
+        @staticmethod
+        def _get_collection():
+            return collection
+
+    flushed = []
+    # the background writer never wakes up on its own during a test
+    buffer = WriteBehindBuffer(Emojis, maxSize=1000, interval=3600, onFlush=flushed.extend)
+    buffer.collection = collection
+    buffer.flushed = flushed
+    return buffer
+
+
+def newEmoji(emote):
+    from app.classes.data import Emoji
+
+    return Emoji(emote=emote, location='home')
+
+
+def testFlushWritesInOrder(app, buffer):
+    emojis = [buffer.add(newEmoji(emote)) for emote in '😀😢😡😴']
+    # ids are given out straight away so the page can link to them
+    assert all(emoji.id for emoji in emojis)
+    assert buffer.get(emojis[1].id) is emojis[1]
+
+    assert buffer.flush() == 4
+    assert buffer.collection.calls == 1
+    assert buffer.collection.inserted == [emoji.id for emoji in emojis]
+    assert buffer.flushed == emojis
+    assert buffer.get(emojis[1].id) is None
+    # nothing left to write
+    assert buffer.flush() == 0
+    assert buffer.collection.calls == 1
+
+
+def testFailedFlushKeepsEverything(app, buffer):
+    first = [buffer.add(newEmoji(emote)) for emote in '😀😢']
+    buffer.collection.failures = 1
+    assert buffer.flush() == 0
+    assert buffer.flushed == []
+    assert buffer.get(first[0].id) is first[0]
+
+    later = buffer.add(newEmoji('😴'))
+    assert buffer.flush() == 3
+    # the ones that waited are still written first
+    assert buffer.collection.inserted == [emoji.id for emoji in first + [later]]
+
+
+def testInvalidEmojiIsRefused(app, buffer):
+    from mongoengine.errors import ValidationError
+
+    emoji = newEmoji('😀')
+    emoji.location = 12
+    with pytest.raises(ValidationError):
+        buffer.add(emoji)
+    assert buffer.flush() == 0
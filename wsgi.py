@@ -0,0 +1,12 @@
+# The entry point for production. Run it with Gunicorn:
+#
+#     gunicorn -c gunicorn.conf.py wsgi:app
+#
+# main.py is only for the development server on your own computer.
+
+import os
+
+# Google sometimes gives back the scopes in a different order than we asked
+os.environ.setdefault('OAUTHLIB_RELAX_TOKEN_SCOPE', '1')
+
+from app import app